@@ -8,12 +8,12 @@ import argparse
 import sys
 from xystitch.pto.project import PTOProject
 from xystitch.optimizer import pto2icm
+from xystitch.residual import Residuals
 #from xystitch.pto.util import *
 from xystitch.util import IOTimestamp, IOLog
 from xystitch.benchmark import Benchmark
 
 import os
-import math
 import matplotlib.pyplot as plt
 
 
@@ -21,35 +21,21 @@ def pto2cps(pto):
     '''
     Enumerate all control point differences
     Map to a dictionary of (n, N) lists containing (dx, dy) tuples
-    Also create an index of all the entries?
+    Canonical n > N
     '''
-    ret = {}
-    for cpl in pto.control_point_lines:
-        n = cpl.getv('n')
-        N = cpl.getv('N')
-        imgn = pto.image_lines[n]
-        imgN = pto.image_lines[N]
-        dx = (imgn.getv('d') - cpl.getv('x')) - (imgN.getv('d') -
-                                                 cpl.getv('X'))
-        dy = (imgn.getv('e') - cpl.getv('y')) - (imgN.getv('e') -
-                                                 cpl.getv('Y'))
-
-        # Make canonical
-        # Usually n < N
-        if N > n:
-            n, N = N, n
-            dx = -dx
-            dy = -dy
-        points = ret.get((n, N), [])
-        points.append((dx, dy))
-        ret[(n, N)] = points
-    return ret
+    return Residuals(pto).pair_deltas()
 
 
 def rm_image_cps(self, indexes):
     '''
     Given a list of n, N tuples, delete all control points matching indexes
     '''
+    cpa = self.columnar_cps()
+    if cpa is not None:
+        mask = cpa.pair_mask(indexes, self.nimages())
+        self.set_cp_array(cpa.take(~mask))
+        return int(mask.sum())
+
     removed = 0
     newls = []
     for cpl in self.control_point_lines:
@@ -65,7 +51,9 @@ def rm_image_cps(self, indexes):
 
 def check_cp(pto):
     print('Building CP map')
-    cps = pto2cps(pto)
+    res = Residuals(pto)
+    cps = res.pair_deltas()
+    pair_stats = res.pair_stats()
     errors = []
     for cpk, diffs in sorted(cps.items()):
         n, N = cpk
@@ -73,11 +61,7 @@ def check_cp(pto):
         img2 = pto.i2img(N).get_name()
 
         # Compute error
-        rms = 0.0
-        for diff in diffs:
-            dx, dy = diff
-            rms += math.sqrt(dx**2 + dy**2)
-        rms /= len(diffs)
+        rms, _count = pair_stats[cpk]
 
         print('%s - %s: % 6.1f:' % (img1, img2, rms))
         for diff in diffs:
@@ -175,7 +159,7 @@ if __name__ == "__main__":
     print('Out: %s' % pto_out)
     bench = Benchmark()
 
-    pto = PTOProject.from_file_name(pto_in)
+    pto = PTOProject.from_file_name(pto_in, columnar=True)
     # Make sure we don't accidently override the original
     pto.remove_file_name()
 
@@ -8,8 +8,9 @@ import argparse
 import sys
 from xystitch.pto.project import PTOProject
 from xystitch.benchmark import Benchmark
-from xystitch.optimizer import gen_cps, pto2icm, tmpdbg
-from xystitch import statistics
+from xystitch.optimizer import gen_cps, pto2icm
+from xystitch.residual import Residuals
+import numpy as np
 
 
 def run(pto_fn, pto_fn_out=None, stdev=3.0):
@@ -18,46 +19,32 @@ def run(pto_fn, pto_fn_out=None, stdev=3.0):
 
     # TODO: l/r compensation
 
-    pto = PTOProject.from_file_name(pto_fn)
-    icm = pto2icm(pto)
-    deltas = []
-    pairs = []
-    cpls = []
-    for cpl, ((n_fn, N_fn), (nx, ny), (Nx, Ny)) in gen_cps(pto, icm=icm):
-        delta = ((nx - Nx)**2 + (ny - Ny)**2)**0.5
-        deltas.append(delta)
-        pairs.append((n_fn, N_fn))
-        cpls.append(cpl)
-        if tmpdbg and (n_fn == 'c005_r003.jpg' and N_fn == 'c005_r004.jpg'):
-            print(('debug', (n_fn, N_fn), (nx, ny), (Nx, Ny)))
-            print(('debug', delta))
-
-    deltas_u = statistics.mean(deltas)
-    deltas_sd = statistics.stdev(deltas)
+    pto = PTOProject.from_file_name(pto_fn, columnar=True)
+    res = Residuals(pto)
+    deltas_u = res.dist.mean()
+    deltas_sd = res.dist.std(ddof=1)
     print(("Delta mean: %0.1f" % deltas_u))
     print(("Delta stdev: %0.1f" % deltas_sd))
-    _deltas_min = deltas_u - deltas_sd * stdev
-    deltas_max = deltas_u + deltas_sd * stdev
+    outliers = res.outlier_mask(stdev)
 
-    outlier_cps = 0
-    outlier_pairs = set()
-    pair_cur = None
-    pairi = 0
-    for cpl, (n_fn, N_fn), delta in zip(cpls, pairs, deltas):
-        if pair_cur != (n_fn, N_fn):
-            pairi = 0
-            pair_cur = (n_fn, N_fn)
-        else:
-            pairi += 1
+    # Index of each point within its run of same pair points
+    pair_keys = res.n * res.nimages + res.N
+    indexes = np.arange(len(pair_keys))
+    run_start = np.ones(len(pair_keys), dtype=bool)
+    run_start[1:] = pair_keys[1:] != pair_keys[:-1]
+    pairis = indexes - np.maximum.accumulate(np.where(run_start, indexes, 0))
 
+    outlier_pairs = set()
+    for i in np.nonzero(outliers)[0].tolist():
+        n_fn = pto.image_lines[res.n[i]].get_name()
+        N_fn = pto.image_lines[res.N[i]].get_name()
         # really only care about max
-        if delta > deltas_max:
-            # canonical file names
-            fna, fnb = sorted((n_fn, N_fn))
-            print(("%s %s %u: outlier delta %0.1f" % (fna, fnb, pairi, delta)))
-            outlier_pairs.add((fna, fnb))
-            outlier_cps += 1
-            pto.remove_control_point_line(cpl)
+        # canonical file names
+        fna, fnb = sorted((n_fn, N_fn))
+        print(("%s %s %u: outlier delta %0.1f" %
+               (fna, fnb, pairis[i], res.dist[i])))
+        outlier_pairs.add((fna, fnb))
+    outlier_cps = res.remove(outliers)
     print("")
     print(("Flagged cps: %u" % outlier_cps))
     print(("Flagged pairs: %u" % len(outlier_pairs)))
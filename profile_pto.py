@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Benchmark .pto parsing and writing on a synthetic project
+Run after touching xystitch/pto to catch parser / writer speed regressions
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from xystitch.pto.project import PTOProject
+from xystitch.config import config
+
+
+def gen_pto(f, lines, cols=100):
+    '''Write a grid project with roughly lines total lines, mostly control points'''
+    rows = max(1, int(lines / 2000))
+    images = rows * cols
+    cps = max(0, lines - images - 3)
+    f.write('# Generated by profile_pto\n')
+    f.write('p f0 w100000 h100000 v10 E0 R0 S0,100000,0,100000 n"TIFF_m c:LZW"\n')
+    f.write('m g1 i0 f0 m2\n')
+    for i in range(images):
+        col = i % cols
+        row = i // cols
+        f.write(
+            'i w2592 h1944 f0 v51 Ra0 Rb0 Rc0 Rd0 Re0 Eev0 Er1 Eb1 r0 p0 y0 TrX0 TrY0 TrZ0 Tpy0 Tpp0 j0 a0 b0 c0 d%0.3f e%0.3f g0 t0 Va1 Vb0 Vc0 Vd0 Vx0 Vy0 Vm5 n"c%03u_r%03u.jpg"\n'
+            % (-col * 1800.0, -row * 1400.0, col, row))
+    rand = random.Random(0)
+    for _i in range(cps):
+        n = rand.randrange(images)
+        N = (n + 1) % images
+        f.write('c n%u N%u x%f y%f X%f Y%f t0\n' %
+                (n, N, rand.uniform(0, 2592), rand.uniform(0, 1944),
+                 rand.uniform(0, 2592), rand.uniform(0, 1944)))
+    return images, cps
+
+
+def run(args):
+    fn = args.pto
+    tmp = None
+    if not fn:
+        tmp = tempfile.NamedTemporaryFile('w', suffix='.pto', delete=False)
+        fn = tmp.name
+        print('Generating %u line project %s' % (args.lines, fn))
+        images, cps = gen_pto(tmp, args.lines)
+        tmp.close()
+        print('  %u images, %u control points' % (images, cps))
+
+    # Time the text parser, not the parsed project cache
+    config.json['pto_cache_min'] = 0
+    out_fn = fn + '.out.pto'
+    try:
+        tstart = time.time()
+        pto = PTOProject.from_file_name(fn, columnar=args.columnar)
+        dt = time.time() - tstart
+        n = len(pto.image_lines) + pto.ncontrol_points()
+        print('Parse: %0.3f sec, %u lines, %0.1f k lines / sec' %
+              (dt, n, n / dt / 1000.0))
+
+        tstart = time.time()
+        pto.get_text()
+        dt_text = time.time() - tstart
+        print('get_text(): %0.3f sec, %0.1f k lines / sec' %
+              (dt_text, n / dt_text / 1000.0))
+
+        tstart = time.time()
+        pto.save_as(out_fn)
+        dt_save = time.time() - tstart
+        print('save_as(): %0.3f sec, %0.1f k lines / sec' %
+              (dt_save, n / dt_save / 1000.0))
+    finally:
+        if tmp:
+            os.remove(fn)
+        if os.path.exists(out_fn):
+            os.remove(out_fn)
+
+    if args.max_sec and dt > args.max_sec:
+        print('FAIL: parse took %0.3f sec, limit %0.3f sec' %
+              (dt, args.max_sec))
+        sys.exit(1)
+    if args.max_save_sec and dt_save > args.max_save_sec:
+        print('FAIL: save took %0.3f sec, limit %0.3f sec' %
+              (dt_save, args.max_save_sec))
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark .pto parsing speed')
+    parser.add_argument('pto',
+                        nargs='?',
+                        default=None,
+                        help='project to parse (default: synthetic)')
+    parser.add_argument('--lines',
+                        type=int,
+                        default=1000000,
+                        help='synthetic project size')
+    parser.add_argument('--max-sec',
+                        type=float,
+                        default=None,
+                        help='exit with error if parsing takes longer')
+    parser.add_argument('--max-save-sec',
+                        type=float,
+                        default=None,
+                        help='exit with error if saving takes longer')
+    parser.add_argument('--columnar',
+                        action='store_true',
+                        help='keep control points columnar')
+    args = parser.parse_args()
+
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
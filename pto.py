@@ -7,7 +7,7 @@ Copyright 2012 John McMaster
 import argparse
 import sys
 from xystitch.optimizer import PTOptimizer, XYOptimizer
-from xystitch.optimizer2 import XYOptimizer2
+from xystitch.optimizer2 import XYOptimizer2, TranslationOptimizer
 from xystitch.pto.project import PTOProject
 from xystitch.pto.util import *
 from xystitch.util import IOTimestamp, IOLog
@@ -42,6 +42,12 @@ if __name__ == "__main__":
     parser.add_argument('--ptoptimizer',
                         action="store_true",
                         help='Run PTOptimizer also center by default')
+    parser.add_argument(
+        '--translation-opt',
+        action="store_true",
+        help=
+        'Like --ptoptimizer but in process and only d/e (stage scans). Also center by default'
+    )
     parser.add_argument(
         '--xy-opt',
         action="store_true",
@@ -49,6 +55,13 @@ if __name__ == "__main__":
     parser.add_argument('--xy-opt2',
                         action="store_true",
                         help='Newer algorithm using uscan.json metadata')
+    parser.add_argument(
+        '--xy-solver',
+        default='spiral',
+        choices=['spiral', 'lsq'],
+        help=
+        'xy-opt2 placement: spiral (attach outward from anchor) or lsq (global robust least squares)'
+    )
     parser.add_argument(
         '--reoptimize',
         action="store_true",
@@ -206,6 +219,16 @@ if __name__ == "__main__":
             print('Centering...')
             center(pto)
 
+    if args.translation_opt:
+        print('Optimizing')
+        opt = TranslationOptimizer(pto)
+        opt.reoptimize = args.reoptimize
+        opt.run()
+        # Default
+        if args.center != False:
+            print('Centering...')
+            center(pto)
+
     if args.xy_opt:
         print('Optimizing')
         opt = XYOptimizer(pto)
@@ -226,6 +249,7 @@ if __name__ == "__main__":
         opt = XYOptimizer2(pto)
         opt.debug = args.verbose
         opt.stdev = args.stdev
+        opt.solver = args.xy_solver
         anchor_cr = None
         if args.anchor_cr:
             anchor_c, anchor_r = args.anchor_cr.split(",")
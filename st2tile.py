@@ -3,6 +3,7 @@
 from xystitch.tiler import Tiler
 from xystitch.pto.project import PTOProject
 from xystitch.config import config
+from xystitch import st_store
 from xystitch.single import singlify, HugeJPEG, coord
 from xystitch.util import logwt, add_bool_arg, size2str, mksize, mem2pix
 
@@ -13,7 +14,6 @@ import os
 import re
 import sys
 import time
-from PIL import Image
 from collections import OrderedDict
 
 
@@ -73,11 +73,13 @@ def run(args):
     t.calc_vars()
 
     print('Forcing tiler on all images')
-    for fn in glob.glob(args.st_dir + "/*.jpg"):
+    for fn in glob.glob(st_store.glob_pattern(args.st_dir)):
+        if not st_store.is_st_fn(fn):
+            continue
         print("")
         print(("%s" % fn))
-        im = Image.open(fn)
-        width, height = im.size
+        im = st_store.load(fn)
+        height, width = im.shape[0:2]
         x0, y0 = coord(fn)
         #t.make_tile(im, x, y, row, col)
         st_bounds = [x0, x0 + width, y0, y0 + height]
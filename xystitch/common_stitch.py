@@ -11,7 +11,9 @@ from xystitch.control_point import get_cp_engine, pto_unsub
 from xystitch.pto.project import PTOProject
 from xystitch.pto.util import optimize_xy_only, fixup_i_lines, fixup_p_lines
 from xystitch.pimage import PImage
-from xystitch.temp_file import ManagedTempFile
+from xystitch.feature_cache import FeatureCache
+from xystitch.config import config
+from xystitch.temp_file import ManagedTempFile, ManagedTempDir
 from xystitch.benchmark import Benchmark
 from xystitch import microscopej
 
@@ -88,6 +90,8 @@ class CommonStitch:
         self.output_project_file_name = None
         self.image_file_names = None
         self.control_point_gen = None
+        # get_cp_engine() name, None for default
+        self.cp_engine = None
 
         # Images have predictable separation?
         self.regular = False
@@ -98,6 +102,10 @@ class CommonStitch:
 
         self.dry = False
         self.log_dir = 'pr0nstitch'
+        # Decoded overlap strips, shared by all pairs (see FeatureCache)
+        self.feature_cache = None
+        # Holds the feature cache if it only lasts for this run
+        self.feature_cache_temp = None
 
         # Each filename as the key
         #self.failures = FailedImages()
@@ -158,10 +166,22 @@ class CommonStitch:
         self.init_failures()
 
         # Generate control points and merge them into a master project
-        self.control_point_gen = get_cp_engine()
+        self.control_point_gen = get_cp_engine(self.cp_engine)
+        cache_dir = config.feature_cache_dir()
+        if self.regular and self.subimage_control_points and cache_dir != "":
+            if cache_dir is None:
+                self.feature_cache_temp = ManagedTempDir.get2(
+                    prefix_mangle='feature_')
+                cache_dir = self.feature_cache_temp.file_name
+            print('Feature cache: %s' % cache_dir)
+            self.feature_cache = FeatureCache(cache_dir, self.x_overlap,
+                                              self.y_overlap)
+            if hasattr(self.control_point_gen, 'keypoint_cache_dir'):
+                self.control_point_gen.keypoint_cache_dir = cache_dir
         # How many rows and cols to go to each side
         # If you hand took the pictures, this might suit you
-        self.project = PTOProject.from_blank()
+        # p / m lines and image defaults used to come from pto_merge
+        self.project = PTOProject.from_default2()
         if self.output_project_file_name:
             self.project.set_file_name(self.output_project_file_name)
             if os.path.exists(self.output_project_file_name):
@@ -220,37 +240,51 @@ class CommonStitch:
                 print('WARNING: failed intermediate save')
             raise e
         finally:
+            # Deletes a per run feature cache
+            self.feature_cache = None
+            self.feature_cache_temp = None
             bench.stop()
             print('Stitch done in %s' % bench)
 
-    def control_points_by_subimage(self, pair, image_fn_pair):
+    def control_points_by_subimage(self, pair, image_fn_pair, cache=True):
         '''Stitch two images together by cropping to restrict overlap'''
 
         # subimage_factor: (y, x) overlap percent tuple or none for default
         # pair: pair of row/col or coordinate positions (used to determine relative positions)
         # (0, 0) at upper left
         # image_fn_pair: pair of image file names
+        # cache: crop through self.feature_cache (if any)
 
         print('Preparing subimage stitch on %s:%s' %
               (image_fn_pair[0], image_fn_pair[1]))
         '''
         Just work on the overlap section, maybe even less
         '''
-
-        images = [
-            PImage.from_file(image_file_name)
-            for image_file_name in image_fn_pair
-        ]
+        feature_cache = self.feature_cache if cache else None
+
+        if feature_cache:
+            # Header only, decode is deferred to the cache
+            sizes = [
+                feature_cache.image_size(image_file_name)
+                for image_file_name in image_fn_pair
+            ]
+        else:
+            images = [
+                PImage.from_file(image_file_name)
+                for image_file_name in image_fn_pair
+            ]
+            sizes = [(image.width(), image.height()) for image in images]
         '''
         image_0 used as reference
         4 basic situations: left, right, up right
         8 extended: 4 basic + corners
         Pairs should be sorted, which simplifies the logic
+        Keep in sync with FeatureCache.overlap_boxes()
         '''
         sub_image_0_x_delta = 0
         sub_image_0_y_delta = 0
-        sub_image_1_x_end = images[1].width()
-        sub_image_1_y_end = images[1].height()
+        sub_image_1_x_end = sizes[1][0]
+        sub_image_1_y_end = sizes[1][1]
 
         # Add some backlash margin
         # "more overlap" means will try a slightly larger area
@@ -261,45 +295,56 @@ class CommonStitch:
         # image 0 left of image 1?
         if pair.first.col < pair.second.col:
             # Keep image 0 right, image 1 left
-            sub_image_0_x_delta = int(images[0].width() * x_overlap)
-            sub_image_1_x_end = int(
-                round(images[1].width() * (1.0 - x_overlap)))
+            sub_image_0_x_delta = int(sizes[0][0] * x_overlap)
+            sub_image_1_x_end = int(round(sizes[1][0] * (1.0 - x_overlap)))
 
         # image 0 above image 1?
         if pair.first.row < pair.second.row:
             # Keep image 0 top, image 1 bottom
-            sub_image_0_y_delta = int(images[0].height() * y_overlap)
-            sub_image_1_y_end = int(
-                round(images[1].height() * (1.0 - y_overlap)))
+            sub_image_0_y_delta = int(sizes[0][1] * y_overlap)
+            sub_image_1_y_end = int(round(sizes[1][1] * (1.0 - y_overlap)))
         '''
         print 'image 0 x delta: %d, y delta: %d' % (sub_image_0_x_delta, sub_image_0_y_delta)
         Note y starts at top in PIL
         '''
-        sub_image_0 = images[0].subimage(sub_image_0_x_delta, None,
-                                         sub_image_0_y_delta, None)
-        sub_image_1 = images[1].subimage(None, sub_image_1_x_end, None,
-                                         sub_image_1_y_end)
-        sub_image_0_file = ManagedTempFile.get(None, '.jpg')
-        sub_image_1_file = ManagedTempFile.get(None, '.jpg')
-        print('sub image 0: width=%d, height=%d, name=%s' %
-              (sub_image_0.width(), sub_image_0.height(),
-               sub_image_0_file.file_name))
-        print('sub image 1: width=%d, height=%d, name=%s' %
-              (sub_image_1.width(), sub_image_1.height(),
-               sub_image_1_file.file_name))
-        #sys.exit(1)
-        sub_image_0.image.save(sub_image_0_file.file_name)
-        sub_image_1.image.save(sub_image_1_file.file_name)
+        # PIL (x0, y0, x1, y1)
+        sub_image_0_box = (sub_image_0_x_delta, sub_image_0_y_delta,
+                           sizes[0][0], sizes[0][1])
+        sub_image_1_box = (0, 0, sub_image_1_x_end, sub_image_1_y_end)
+        # Keep temp files alive until the project is unsub'd
+        sub_image_files = []
+        if feature_cache:
+            sub_image_fn_pair = (
+                feature_cache.crop(image_fn_pair[0], sub_image_0_box),
+                feature_cache.crop(image_fn_pair[1], sub_image_1_box))
+            print('Feature cache: %s' % feature_cache)
+        else:
+            sub_image_0 = images[0].subimage(sub_image_0_x_delta, None,
+                                             sub_image_0_y_delta, None)
+            sub_image_1 = images[1].subimage(None, sub_image_1_x_end, None,
+                                             sub_image_1_y_end)
+            # Lossless so JPEG blocking doesn't pull the correlation peak
+            sub_image_files = [
+                ManagedTempFile.get(None, '.png'),
+                ManagedTempFile.get(None, '.png')
+            ]
+            sub_image_0.image.save(sub_image_files[0].file_name,
+                                   compress_level=1)
+            sub_image_1.image.save(sub_image_files[1].file_name,
+                                   compress_level=1)
+            sub_image_fn_pair = (sub_image_files[0].file_name,
+                                 sub_image_files[1].file_name)
+        for i, box in enumerate((sub_image_0_box, sub_image_1_box)):
+            print('sub image %d: width=%d, height=%d, name=%s' %
+                  (i, box[2] - box[0], box[3] - box[1], sub_image_fn_pair[i]))
 
-        sub_image_fn_pair = (sub_image_0_file.file_name,
-                             sub_image_1_file.file_name)
         # subimage file name symbolic link to subimage file name
         # this should be taken care of inside of control point actually
         #sub_link_to_sub = dict()
         # subimage to the image it came from
         sub_to_real = dict()
-        sub_to_real[sub_image_0_file.file_name] = image_fn_pair[0]
-        sub_to_real[sub_image_1_file.file_name] = image_fn_pair[1]
+        sub_to_real[sub_image_fn_pair[0]] = image_fn_pair[0]
+        sub_to_real[sub_image_fn_pair[1]] = image_fn_pair[1]
 
         # Returns a pto project object
         pair_project = self.control_point_gen.generate_core(sub_image_fn_pair)
@@ -310,18 +355,23 @@ class CommonStitch:
         # all we need to do is adjust xy positions
         # afaik above is way overcomplicated
         final_pair_project = pto_unsub(
-            pair_project, (sub_image_0_file, sub_image_1_file),
+            pair_project, sub_image_fn_pair,
             (sub_image_0_x_delta, sub_image_0_y_delta), sub_to_real)
 
         # Filenames become absolute
         #sys.exit(1)
         return final_pair_project
 
-    def try_control_points_with_position(self, pair, image_fn_pair):
+    def try_control_points_with_position(self,
+                                         pair,
+                                         image_fn_pair,
+                                         cache=True):
         '''Try to stitch two images together without any (high level) image processing other than cropping'''
         # If images are arranged in a regular grid and we are allowed to crop do it
         if self.regular and self.subimage_control_points:
-            return self.control_points_by_subimage(pair, image_fn_pair)
+            return self.control_points_by_subimage(pair,
+                                                   image_fn_pair,
+                                                   cache=cache)
         # Otherwise run stitches on the full image
         else:
             print(
@@ -402,8 +452,9 @@ class CommonStitch:
             pair_soften_image_file_names = (
                 soften_image_file_0_managed.file_name,
                 soften_image_file_1_managed.file_name)
+            # Softened images are throwaway, don't pollute the cache
             ret_project = self.try_control_points_with_position(
-                pair, pair_soften_image_file_names)
+                pair, pair_soften_image_file_names, cache=False)
             # Did we win?
             if ret_project:
                 # Fixup the project to reflect the correct file names
@@ -149,6 +149,38 @@ class Config:
     def temp_base(self):
         return self.get('temp_base', "/tmp/ts_")
 
+    def feature_cache_dir(self):
+        """
+        Where xy-feature keeps decoded overlap strips (and cpfind keypoints) between pairs and runs
+        Outside the log dir since that gets shifted every run
+        Nothing evicts it, clean it up yourself
+        None (default): use a temp dir deleted at the end of the run
+        Set to "" to disable
+        """
+        return self.get('feature_cache', None)
+
+    def phase_min_psr(self):
+        """
+        Phase correlation control points: weakest correlation peak (peak to sidelobe ratio) to trust
+        Below this the pair falls back to cpfind
+        """
+        return float(self.get('phase_min_psr', 15.0))
+
+    def phase_min_ncc(self):
+        """
+        Phase correlation control points: lowest normalized cross correlation of the overlap
+        at the found offset to trust, otherwise the pair falls back to cpfind
+        """
+        return float(self.get('phase_min_ncc', 0.3))
+
+    def pto_cache_min(self):
+        """
+        Write a parsed project cache (<file>.pto.npz) next to .pto files with at least this many
+        image + control point lines so the next tool loads it without re-parsing
+        Set to 0 to disable
+        """
+        return self.get('pto_cache_min', 10000)
+
     def enblend_opts(self):
         return self.getx('enblend.opts', "")
 
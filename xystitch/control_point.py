@@ -4,11 +4,14 @@ Copyright 2011 John McMaster <JohnDMcMaster@gmail.com>
 Licensed under a 2 clause BSD license, see COPYING for details
 '''
 from xystitch.temp_file import ManagedTempFile
+from xystitch.config import config
 from xystitch.execute import exc_ret_istr
 from xystitch.pto.project import PTOProject
 from xystitch.pto.util import *
 from xystitch.pto.control_point_line import ControlPointLine
 from xystitch.pto.image_line import ImageLine
+from PIL import Image
+import numpy as np
 import shutil
 import os.path
 
@@ -103,7 +106,7 @@ def pto_unsub(src_prj, sub_image_files, deltas, sub_to_real):
     Transforms a sub-project back into original control point coordinate space using original file names
     Returns a new project file
     src_prj: base project that needs to be transformed
-    sub_image_files: tuple specifying original project 0/1 positions
+    sub_image_files: tuple of file names specifying original project 0/1 positions
         needed to correctly apply deltas
     deltas: delta to apply to pair_project coordinates to bring back to target (original) project space
         0: x
@@ -125,10 +128,8 @@ def pto_unsub(src_prj, sub_image_files, deltas, sub_to_real):
         dst_il.set_name(sub_to_real[src_il.get_name()])
         # add it
         ret.add_image_line(dst_il)
-        same_order = same_order and sub_image_files[
-            i].file_name == src_il.get_name()
-        print('  %d: %s vs %s' %
-              (i, sub_image_files[i].file_name, src_il.get_name()))
+        same_order = same_order and sub_image_files[i] == src_il.get_name()
+        print('  %d: %s vs %s' % (i, sub_image_files[i], src_il.get_name()))
 
     # Copy/shift control points
     # Should have been filtered out earlier
@@ -205,6 +206,8 @@ class ControlPointGeneratorXX:
 class PanoCP:
     def __init__(self):
         self.print_output = True
+        # Images from this dir (see FeatureCache) get their keypoints cached
+        self.keypoint_cache_dir = None
 
     def generate_core(self, img_fns):
         # cpfind (and likely cpclean) trashes absolute file names
@@ -219,6 +222,11 @@ class PanoCP:
         # Start with cpfind
         args.append("--multirow")
         args.append("--fullscale")
+        if self.keypoint_cache_dir and all(
+                os.path.dirname(os.path.realpath(img_fn)) == os.path.realpath(
+                    self.keypoint_cache_dir) for img_fn in img_fns):
+            # Writes/reuses <image>.key next to each image
+            args.append("--cache")
         # output file
         args.append("-o")
         args.append(project.file_name)
@@ -302,9 +310,207 @@ class PanoCP:
         return project
 
 
+def phase_correlate(a, b):
+    '''
+    Translation between two same sized grayscale arrays by FFT phase correlation
+    Returns (dx, dy, psr) such that a[y, x] ~= b[y - dy, x - dx]
+    psr: peak to sidelobe ratio, how far the peak stands out of the correlation surface
+    '''
+    h, w = a.shape
+    # Taper edges so the image border doesn't correlate with itself
+    window = np.outer(np.hanning(h), np.hanning(w))
+    fa = np.fft.rfft2((a - a.mean()) * window)
+    fb = np.fft.rfft2((b - b.mean()) * window)
+    cross = fa * np.conj(fb)
+    cross /= np.abs(cross) + 1e-12
+    surface = np.fft.irfft2(cross, s=(h, w))
+
+    py, px = np.unravel_index(np.argmax(surface), surface.shape)
+    peak = surface[py, px]
+    psr = (peak - surface.mean()) / (surface.std() + 1e-12)
+
+    def subpixel(m1, c, p1):
+        # Parabola through the peak and its neighbors
+        denom = m1 - 2 * c + p1
+        if denom == 0:
+            return 0.0
+        return 0.5 * (m1 - p1) / denom
+
+    dy = py + subpixel(surface[(py - 1) % h, px], peak, surface[(py + 1) % h,
+                                                                 px])
+    dx = px + subpixel(surface[py, (px - 1) % w], peak, surface[py,
+                                                                 (px + 1) % w])
+    # Unwrap to signed shifts
+    if dy > h / 2:
+        dy -= h
+    if dx > w / 2:
+        dx -= w
+    return dx, dy, psr
+
+
+def overlap_ncc(a, b, dx, dy, min_frac=0.25):
+    '''
+    Normalized cross correlation of the region a and b share at integer shift (dx, dy)
+    Same convention as phase_correlate(): a[y, x] ~= b[y - dy, x - dx]
+    Returns -1 if the shared region is under min_frac of the strip
+    '''
+    h, w = a.shape
+    ya0, ya1 = max(0, dy), min(h, h + dy)
+    xa0, xa1 = max(0, dx), min(w, w + dx)
+    if (ya1 - ya0) * (xa1 - xa0) < min_frac * h * w:
+        return -1.0
+    pa = a[ya0:ya1, xa0:xa1]
+    pb = b[ya0 - dy:ya1 - dy, xa0 - dx:xa1 - dx]
+    pa = pa - pa.mean()
+    pb = pb - pb.mean()
+    denom = np.sqrt((pa * pa).sum() * (pb * pb).sum())
+    if denom == 0:
+        return -1.0
+    return float((pa * pb).sum() / denom)
+
+
+def ncc_refine(a, b, dx, dy, radius=4, max_iter=3):
+    '''
+    Check a phase correlation estimate by NCC over the overlap and refine it
+    Every integer shift within radius is scored since the NCC peak is often only a pixel wide
+    (the phase peak can be a few pixels off on compressed input)
+    The window moves if the best shift is on its edge
+    Subpixel offset is a parabola through the NCC neighbors, which is less biased than the phase peak
+    Returns (dx, dy, ncc)
+    '''
+    cx = int(round(dx))
+    cy = int(round(dy))
+    scores = {}
+
+    def score(x, y):
+        if (x, y) not in scores:
+            scores[(x, y)] = overlap_ncc(a, b, x, y)
+        return scores[(x, y)]
+
+    for _i in range(max_iter):
+        best = max(((x, y) for y in range(cy - radius, cy + radius + 1)
+                    for x in range(cx - radius, cx + radius + 1)),
+                   key=lambda xy: score(*xy))
+        on_edge = abs(best[0] - cx) == radius or abs(best[1] - cy) == radius
+        cx, cy = best
+        if not on_edge:
+            break
+
+    def subpixel(m1, c, p1):
+        denom = m1 - 2 * c + p1
+        if denom >= 0:
+            return 0.0
+        return max(-0.5, min(0.5, 0.5 * (m1 - p1) / denom))
+
+    c = score(cx, cy)
+    fx = cx + subpixel(score(cx - 1, cy), c, score(cx + 1, cy))
+    fy = cy + subpixel(score(cx, cy - 1), c, score(cx, cy + 1))
+    return fx, fy, c
+
+
+class PhaseCorrelationCP:
+    '''
+    Translation only control points for a regular XY grid
+
+    Expects the overlap strips from CommonStitch.control_points_by_subimage()
+    These are nominally aligned, so the residual offset is small and one FFT finds it
+    Emits a grid of synthetic control points consistent with that offset
+    Falls back to PanoCP (cpfind + cpclean) when the correlation peak is weak
+    or the strips don't actually match at that offset (NCC check)
+    '''
+    def __init__(self):
+        self.print_output = True
+        # Below this the peak is indistinguishable from noise, use cpfind
+        self.min_psr = config.phase_min_psr()
+        # Overlap NCC at the refined offset must be at least this, see ncc_refine()
+        self.min_ncc = config.phase_min_ncc()
+        # Reject offsets that eat more than this fraction of the strip
+        self.max_shift = 0.25
+        # Control points per axis
+        self.grid = 4
+        self.fallback = PanoCP()
+        self.n_phase = 0
+        self.n_fallback = 0
+
+    @property
+    def keypoint_cache_dir(self):
+        return self.fallback.keypoint_cache_dir
+
+    @keypoint_cache_dir.setter
+    def keypoint_cache_dir(self, cache_dir):
+        self.fallback.keypoint_cache_dir = cache_dir
+
+    def load(self, img_fn):
+        with Image.open(img_fn) as im:
+            return np.asarray(im.convert('L'), dtype=np.float32)
+
+    def generate_core(self, img_fns):
+        if len(img_fns) != 2:
+            raise Exception('Phase correlation requires an image pair')
+        ret = self.phase_core(img_fns)
+        if ret is None:
+            self.n_fallback += 1
+            print('PhaseCorrelationCP: falling back to cpfind')
+            ret = self.fallback.generate_core(img_fns)
+        else:
+            self.n_phase += 1
+        print('PhaseCorrelationCP: phase %d, fallback %d' %
+              (self.n_phase, self.n_fallback))
+        return ret
+
+    def phase_core(self, img_fns):
+        '''Return pair project or None if the match isn't trustworthy'''
+        a = self.load(img_fns[0])
+        b = self.load(img_fns[1])
+        # Strips can be off by a pixel from rounding
+        h = min(a.shape[0], b.shape[0])
+        w = min(a.shape[1], b.shape[1])
+        if h < 16 or w < 16:
+            print('PhaseCorrelationCP: strip too small (%dx%d)' % (w, h))
+            return None
+        dx, dy, psr = phase_correlate(a[:h, :w], b[:h, :w])
+        print('PhaseCorrelationCP: dx %0.2f, dy %0.2f, psr %0.1f' %
+              (dx, dy, psr))
+        if psr < self.min_psr:
+            return None
+        if abs(dx) > w * self.max_shift or abs(dy) > h * self.max_shift:
+            return None
+        dx, dy, ncc = ncc_refine(a[:h, :w], b[:h, :w], dx, dy)
+        print('PhaseCorrelationCP: refined dx %0.2f, dy %0.2f, ncc %0.3f' %
+              (dx, dy, ncc))
+        if ncc < self.min_ncc:
+            return None
+        if abs(dx) > w * self.max_shift or abs(dy) > h * self.max_shift:
+            return None
+
+        project = PTOProject.from_default2()
+        for img_fn in img_fns:
+            project.add_image(img_fn, def_opt=True)
+        # Sample points inside the region both strips cover, away from the edges
+        x0 = max(0.0, dx) + w * 0.1
+        x1 = min(w, w + dx) - w * 0.1
+        y0 = max(0.0, dy) + h * 0.1
+        y1 = min(h, h + dy) - h * 0.1
+        for y in np.linspace(y0, y1, self.grid):
+            for x in np.linspace(x0, x1, self.grid):
+                project.add_control_point_line(
+                    ControlPointLine(project=project,
+                                     variables={
+                                         'n': 0,
+                                         'N': 1,
+                                         'x': float(x),
+                                         'y': float(y),
+                                         'X': float(x - dx),
+                                         'Y': float(y - dy),
+                                         't': 0,
+                                     }))
+        return project
+
+
 def get_cp_engine(engine=None):
     return {
         'autopano-sift-c': AutopanoSiftC,
         'panocp': PanoCP,
+        'phase': PhaseCorrelationCP,
         None: PanoCP
     }[engine]()
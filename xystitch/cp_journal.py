@@ -0,0 +1,155 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+Append only journal of control point pair results
+
+xy-feature used to rewrite the whole master .pto every few pairs to checkpoint progress
+That is O(project) per save, so quadratic over a run
+Instead each finished pair is appended as a small self contained block:
+
+# xystitch-journal pair <col0> <row0> <col1> <row1> ok <pair fingerprint>
+<pair project text: image lines with real file names + c lines>
+# xystitch-journal end
+
+Failed pairs are recorded with "fail" and no project text
+A block without its end marker (crash mid write) is ignored when read
+so a rerun can load() what finished, skip those pairs and append the rest
+
+Grid positions alone don't say which images a block matched
+so the file starts with "# xystitch-journal run <run id>" (output project + image list, see run_id())
+and a journal from another run is stale() and thrown out as a whole
+Each block also has a fingerprint of its images' names, sizes and mtimes (pair_fingerprint())
+so a pair whose images were replaced is matched again
+'''
+
+from xystitch.pto.project import PTOProject
+
+import hashlib
+import os
+
+MAGIC = '# xystitch-journal'
+
+
+def pair_key(pair):
+    '''ImageCoordinatePair => hashable (col0, row0, col1, row1)'''
+    return (pair.first.col, pair.first.row, pair.second.col,
+            pair.second.row)
+
+
+def run_id(project_fn, image_fns):
+    '''Identifies the output project and image set a journal belongs to'''
+    h = hashlib.sha1(os.path.realpath(project_fn).encode('utf-8'))
+    for fn in sorted(os.path.realpath(fn) for fn in image_fns):
+        h.update(b'\0' + fn.encode('utf-8'))
+    return h.hexdigest()
+
+
+def pair_fingerprint(pair_fns):
+    '''Changes if either image of the pair is renamed or rewritten'''
+    h = hashlib.sha1()
+    for fn in pair_fns:
+        st = os.stat(fn)
+        h.update(('%s\0%d\0%d\0' % (os.path.realpath(fn), st.st_size,
+                                     st.st_mtime_ns)).encode('utf-8'))
+    return h.hexdigest()
+
+
+class CPJournal(object):
+    def __init__(self, file_name, run_id=None):
+        self.file_name = file_name
+        self.run_id = run_id
+        self.f = None
+
+    def exists(self):
+        return os.path.exists(self.file_name)
+
+    def header(self):
+        return '%s run %s\n' % (MAGIC, self.run_id)
+
+    def stale(self):
+        '''True if the journal was written for another output project or image set'''
+        if not self.exists():
+            return False
+        with open(self.file_name, 'r') as f:
+            return f.readline() != self.header()
+
+    def load(self):
+        '''
+        Return {pair_key: (pair fingerprint, PTOProject or None if failed)} for every complete block
+        A later block for the same pair wins
+        '''
+        ret = {}
+        if not self.exists() or self.stale():
+            return ret
+        key = None
+        status = None
+        fingerprint = None
+        lines = []
+        for line in open(self.file_name, 'r'):
+            if not line.startswith(MAGIC):
+                if key is not None:
+                    lines.append(line)
+                continue
+            parts = line.split()
+            if len(parts) == 9 and parts[2] == 'pair':
+                # Any open block was cut short
+                key = tuple(int(x) for x in parts[3:7])
+                status = parts[7]
+                fingerprint = parts[8]
+                lines = []
+            elif len(parts) == 3 and parts[2] == 'end' and key is not None:
+                if status == 'ok':
+                    ret[key] = (fingerprint,
+                                PTOProject.from_text(''.join(lines)))
+                else:
+                    ret[key] = (fingerprint, None)
+                key = None
+            else:
+                # Header cut short, or the run line
+                key = None
+        return ret
+
+    def open(self):
+        if self.f is None:
+            # Don't glue our first block onto a partial last line
+            partial = False
+            if self.exists() and os.path.getsize(self.file_name):
+                with open(self.file_name, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    partial = f.read(1) != b'\n'
+            new = not self.exists() or os.path.getsize(self.file_name) == 0
+            self.f = open(self.file_name, 'a')
+            if new:
+                self.f.write(self.header())
+            elif partial:
+                self.f.write('\n')
+
+    def append(self, pair, pair_fns, pto):
+        '''Record a finished pair, pto None if it failed'''
+        self.open()
+        status = 'ok' if pto else 'fail'
+        parts = [
+            '%s pair %d %d %d %d %s %s\n' % ((MAGIC, ) + pair_key(pair) +
+                                             (status,
+                                              pair_fingerprint(pair_fns)))
+        ]
+        if pto:
+            parts.append(pto.get_text().strip() + '\n')
+        parts.append('%s end\n' % MAGIC)
+        # One write so a block is never interleaved with a partial one
+        self.f.write(''.join(parts))
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def remove(self):
+        '''Final project has everything, journal no longer needed'''
+        self.close()
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
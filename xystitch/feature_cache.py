@@ -0,0 +1,109 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+Per image overlap strip cache for control point generation
+
+A regular grid only ever matches an image against its left/right/top/bottom neighbor
+Each pair used to decode both full images and re-encode a crop for cpfind
+So an interior image was decoded four times and cropped to four different strips
+Instead the first pair to touch an image decodes it once and writes all four strips
+
+Entries are keyed by real path + mtime + size + crop box so a changed input is not reused
+By default the cache is a temp dir for the run
+A configured cache dir is not under the (shifted) log dir so a re-run or resume reuses it
+Strips are lossless (PNG) so cpfind / phase correlation don't see a second round of JPEG artifacts
+Strips are written to a temp name and renamed in so concurrent workers are safe
+cpfind is run with --cache on strips so its keypoint files persist alongside them
+'''
+
+from PIL import Image
+
+import hashlib
+import os
+
+
+class FeatureCache(object):
+    def __init__(self, cache_dir, x_overlap, y_overlap, ext='.png'):
+        self.cache_dir = cache_dir
+        self.x_overlap = x_overlap
+        self.y_overlap = y_overlap
+        self.ext = ext
+        # (realpath, mtime, size) => (width, height)
+        self.sizes = {}
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def stat_key(self, fn):
+        real_fn = os.path.realpath(fn)
+        st = os.stat(real_fn)
+        return (real_fn, st.st_mtime_ns, st.st_size)
+
+    def image_size(self, fn):
+        '''(width, height) from the image header only'''
+        key = self.stat_key(fn)
+        ret = self.sizes.get(key)
+        if ret is None:
+            with Image.open(key[0]) as im:
+                ret = im.size
+            self.sizes[key] = ret
+        return ret
+
+    def overlap_boxes(self, size):
+        '''
+        The strips a grid pair can ask for, as PIL (x0, y0, x1, y1) boxes
+        Must match control_points_by_subimage()
+        '''
+        width, height = size
+        return {
+            # Image is the left one of a pair
+            'right': (int(width * self.x_overlap), 0, width, height),
+            # Image is the right one of a pair
+            'left': (0, 0, int(round(width * (1.0 - self.x_overlap))),
+                     height),
+            # Image is the top one of a pair
+            'bottom': (0, int(height * self.y_overlap), width, height),
+            # Image is the bottom one of a pair
+            'top': (0, 0, width, int(round(height *
+                                           (1.0 - self.y_overlap)))),
+        }
+
+    def entry_fn(self, key, box):
+        h = hashlib.sha1(('%s\0%d\0%d\0%d,%d,%d,%d' %
+                          (key + tuple(box))).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, h + self.ext)
+
+    def crop(self, fn, box):
+        '''Return file name of a cached crop of fn to box, decoding fn at most once'''
+        key = self.stat_key(fn)
+        box = tuple(box)
+        ret = self.entry_fn(key, box)
+        if os.path.exists(ret):
+            self.hits += 1
+            return ret
+        self.misses += 1
+
+        # Decode once and write every strip a neighbor will want
+        boxes = [box]
+        with Image.open(key[0]) as im:
+            im.load()
+            self.sizes[key] = im.size
+            for other in self.overlap_boxes(im.size).values():
+                if other not in boxes:
+                    boxes.append(other)
+            for this_box in boxes:
+                this_fn = self.entry_fn(key, this_box)
+                if this_box is not box and os.path.exists(this_fn):
+                    continue
+                tmp_fn = '%s.%d.tmp%s' % (this_fn, os.getpid(), self.ext)
+                # Fast zlib level, these are big and short lived
+                im.crop(this_box).save(tmp_fn, compress_level=1)
+                os.rename(tmp_fn, this_fn)
+        return ret
+
+    def __str__(self):
+        return 'hits %d, misses %d' % (self.hits, self.misses)
@@ -27,11 +27,13 @@ def ceil_mult(n, mult, align=0):
 
 
 class PolygonQuadTreeItem:
-    def __init__(self, left, right, top, bottom):
+    def __init__(self, left, right, top, bottom, data=None):
         self.left = left
         self.right = right
         self.top = top
         self.bottom = bottom
+        # Caller payload, ex: image index
+        self.data = data
 
 
 '''
@@ -85,7 +87,7 @@ class PolygonQuadTree(object):
         # If we've reached the maximum depth then insert all items into this
         # quadrant.
         depth -= 1
-        if depth == 0:
+        if depth == 0 or not items:
             self.items = items
             return
 
@@ -135,16 +137,6 @@ class PolygonQuadTree(object):
         if sw_items:
             self.sw = PolygonQuadTree(sw_items, depth, (l, cy, cx, b))
 
-    '''
-	def hit(self, x):
-		r = object()
-		r.left = 
-		r.right = 
-		r.top = 
-		r.bottom = 
-		return self.hit_core(r)
-	'''
-
     def hit_bounds(self, bounds):
         '''Hit in form [left,right,top,bottom]'''
         return self.hit(
@@ -169,12 +161,12 @@ class PolygonQuadTree(object):
 
         # Recursively check the lower quadrants.
         if self.nw and rect.left <= self.cx and rect.top <= self.cy:
-            hits |= self.nw.hit_core(rect)
+            hits |= self.nw.hit(rect)
         if self.sw and rect.left <= self.cx and rect.bottom >= self.cy:
-            hits |= self.sw.hit_core(rect)
+            hits |= self.sw.hit(rect)
         if self.ne and rect.right >= self.cx and rect.top <= self.cy:
-            hits |= self.ne.hit_core(rect)
+            hits |= self.ne.hit(rect)
         if self.se and rect.right >= self.cx and rect.bottom >= self.cy:
-            hits |= self.se.hit_core(rect)
+            hits |= self.se.hit(rect)
 
         return hits
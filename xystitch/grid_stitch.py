@@ -13,10 +13,10 @@ from .image_coordinate_map import ImageCoordinateMap
 import os
 import sys
 from xystitch.pto.util import dbg
+from xystitch.cp_journal import CPJournal, pair_key, pair_fingerprint, run_id
 import queue
 import traceback
 from . import common_stitch
-import time
 import shutil
 import multiprocessing
 
@@ -24,16 +24,17 @@ from xystitch.util import IOTimestamp
 
 
 class Worker(object):
-    def __init__(self, i, log_fn):
+    def __init__(self, i, log_fn, qi, qo):
         self.process = multiprocessing.Process(target=self.run)
 
         self.i = i
-        self.qi = multiprocessing.Queue()
-        self.qo = multiprocessing.Queue()
-        self.pq = multiprocessing.Queue()
+        # Shared by all workers
+        # qi: batches of (pair, pair_fns) tasks, None to exit
+        # qo: one result per task
+        self.qi = qi
+        self.qo = qo
         self.running = multiprocessing.Event()
         self.generate_control_points_by_pair = None
-        self.idle = True
         self.log_fn = log_fn
 
     def start(self):
@@ -52,39 +53,45 @@ class Worker(object):
         self.running.set()
         while self.running.is_set():
             try:
-                task = self.qi.get(True, 0.1)
+                batch = self.qi.get(True, 0.1)
             except queue.Empty:
-                self.idle = True
                 continue
-            self.idle = False
-
-            try:
-                (pair, pair_fns) = task
+            if batch is None:
+                print('w%d: no more work' % self.i)
+                break
+            print('w%d: batch rx, %d tasks' % (self.i, len(batch)))
+            for task in batch:
+                if not self.running.is_set():
+                    break
+                self.run_task(task)
+
+    def run_task(self, task):
+        try:
+            (pair, pair_fns) = task
 
-                print()
-                print()
-                print()
-                print()
-                print()
-                print('*' * 80)
-                print('w%d: task rx' % self.i)
+            print()
+            print()
+            print()
+            print()
+            print()
+            print('*' * 80)
+            print('w%d: task rx' % self.i)
 
-                pto = self.generate_control_points_by_pair(pair, pair_fns)
+            pto = self.generate_control_points_by_pair(pair, pair_fns)
 
-                if not pto:
-                    print('WARNING: bad project @ %s, %s' %
-                          (repr(pair), pair_fns))
-                else:
-                    if len(pto.get_text().strip()) == 0:
-                        raise Exception('Generated empty pair project')
+            if not pto:
+                print('WARNING: bad project @ %s, %s' % (repr(pair), pair_fns))
+            else:
+                if len(pto.get_text().strip()) == 0:
+                    raise Exception('Generated empty pair project')
 
-                self.qo.put(('done', (task, pto)))
-                print('w%d: task done, pto: %s' % (self.i, pto))
+            self.qo.put(('done', (task, pto)))
+            print('w%d: task done, pto: %s' % (self.i, pto))
 
-            except Exception as e:
-                traceback.print_exc()
-                estr = traceback.format_exc()
-                self.qo.put(('exception', (task, e, estr)))
+        except Exception as e:
+            traceback.print_exc()
+            estr = traceback.format_exc()
+            self.qo.put(('exception', (task, e, estr)))
 
 
 class GridStitch(common_stitch.CommonStitch):
@@ -96,8 +103,11 @@ class GridStitch(common_stitch.CommonStitch):
         self.skip_missing = False
         self.threads = 1
         self.workers = []
-        self.workers_p = []
         self.ignore_errors = False
+        # Pairs per worker request
+        self.batch_size = 8
+        # Skip pairs already in the journal of a previous (interrupted) run
+        self.resume = True
 
     @staticmethod
     def from_tagged_file_names(image_file_names):
@@ -122,6 +132,61 @@ class GridStitch(common_stitch.CommonStitch):
             open_list.add(file_name)
         self.failures = common_stitch.FailedImages(open_list)
 
+    def pair_tasks(self):
+        '''
+        (pair, pair_fns) for every pair to match, row major
+        A pair is keyed by its lower/right image so row r only touches rows r - 1 and r
+        Consecutive tasks (and so a worker's batch) share images
+        '''
+        pairs = sorted(self.coordinate_map.gen_pairs(1, 1),
+                       key=lambda pair: (pair.second.row, pair.second.col,
+                                         pair.first.row, pair.first.col))
+        ret = []
+        for pair in pairs:
+            # Image file names as list
+            pair_images = self.coordinate_map.get_images_from_pair(pair)
+            if pair_images[0] is None or pair_images[1] is None:
+                print('WARNING: skipping missing image @ %s' % repr(pair))
+                continue
+            ret.append((pair, pair_images))
+        return ret
+
+    def resume_journal(self, tasks, journal):
+        '''
+        Merge pairs finished by a previous run and return (remaining tasks, resumed tasks)
+        All journaled projects go in one merge
+        '''
+        done = journal.load()
+        if not done:
+            return tasks, []
+        print('Resuming from journal %s: %d pairs' %
+              (journal.file_name, len(done)))
+        remaining = []
+        resumed = []
+        ptos = []
+        for task in tasks:
+            (pair, pair_fns) = task
+            key = pair_key(pair)
+            if key not in done:
+                remaining.append(task)
+                continue
+            fingerprint, pto = done[key]
+            if fingerprint != pair_fingerprint(pair_fns):
+                print('Journal: images changed @ %s, redoing' % repr(pair))
+                remaining.append(task)
+                continue
+            resumed.append(task)
+            if pto:
+                self.failures.add_success(pair_fns)
+                ptos.append(pto)
+            else:
+                self.failures.add_failure(pair_fns)
+        print('Resumed %d / %d pairs (%d with control points)' %
+              (len(resumed), len(tasks), len(ptos)))
+        if ptos:
+            self.project.merge_native(ptos)
+        return remaining, resumed
+
     def generate_control_points(self):
         '''
         Generate control points
@@ -129,13 +194,6 @@ class GridStitch(common_stitch.CommonStitch):
         '''
         #temp_projects = list()
 
-        print()
-        n_pairs = len(list(self.coordinate_map.gen_pairs(1, 1)))
-        print('***Pairs: %d***' % n_pairs)
-        print()
-        pair_submit = 0
-        pair_complete = 0
-
         if self.skip_missing:
             print('Not verifying image map')
         else:
@@ -148,53 +206,87 @@ class GridStitch(common_stitch.CommonStitch):
                 print('!' * 80)
                 raise e
 
+        tasks = self.pair_tasks()
+        n_pairs = len(tasks)
+        print()
+        print('***Pairs: %d***' % n_pairs)
+        print()
+        pair_complete = 0
+
+        # Seed project with all images in order
+        # note we used the filename that will get used below
+        # not the final output file name
+        for can_fn in sorted(self.canon2orig.keys()):
+            self.project.add_image(can_fn, def_opt=True)
+
+        # Checkpoint is the journal
+        # Pair projects are merged in memory and the project is only written at the end
+        journal = CPJournal(self.project.file_name + '.journal',
+                            run_id(self.project.file_name, self.canon2orig))
+        if journal.exists() and not self.resume:
+            print('Discarding old journal %s' % journal.file_name)
+            journal.remove()
+        elif journal.stale():
+            print('Discarding journal %s from another project / image set' %
+                  journal.file_name)
+            journal.remove()
+        tasks, resumed = self.resume_journal(tasks, journal)
+        pair_complete += len(resumed)
+
+        qi = multiprocessing.Queue()
+        qo = multiprocessing.Queue()
+        # Workers pull batches as they free up, nothing to dispatch after this
+        for i in range(0, len(tasks), self.batch_size):
+            qi.put(tasks[i:i + self.batch_size])
+        print('Queued %d pairs in batches of %d' %
+              (len(tasks), self.batch_size))
+
         print('Initializing %d workers' % self.threads)
         for ti in range(self.threads):
-            w = Worker(ti, os.path.join(self.log_dir, 'w%02d.log' % ti))
+            w = Worker(ti, os.path.join(self.log_dir, 'w%02d.log' % ti), qi,
+                       qo)
             w.generate_control_points_by_pair = self.generate_control_points_by_pair
             self.workers.append(w)
+            qi.put(None)
             w.start()
 
         try:
-            coord_pairs = self.coordinate_map.gen_pairs(1, 1)
-
-            all_allocated = False
-
-            # Seed project with all images in order
-            # note we used the filename that will get used below
-            # not the final output file name
-            for can_fn in sorted(self.canon2orig.keys()):
-                self.project.add_image(can_fn)
-            self.project.save()
-
-            last_progress = time.time()
-            while not (all_allocated and pair_complete == pair_submit):
-                progress = False
-                # Most efficient to merge things in batches as they complete
-                final_pair_projects = []
-                # Check for completed jobs
-                for wi, worker in enumerate(self.workers):
+            # Merge whatever came in together
+            final_pair_projects = []
+            while pair_complete < n_pairs:
+                try:
+                    outs = [qo.get(True, 30)]
+                except queue.Empty:
+                    if not any(w.process.is_alive() for w in self.workers):
+                        raise Exception(
+                            'Workers exited with %d pairs outstanding' %
+                            (n_pairs - pair_complete))
+                    print('WARNING: server thread stalled')
+                    continue
+                # Take whatever else finished meanwhile
+                while True:
                     try:
-                        out = worker.qo.get(False)
+                        outs.append(qo.get(False))
                     except queue.Empty:
-                        continue
+                        break
+
+                for out in outs:
                     pair_complete += 1
                     what = out[0]
-                    progress = True
 
                     if what == 'done':
                         (task, pto) = out[1]
                         prog = 'complete %d/%d' % (pair_complete, n_pairs)
-                        print('W%d: done w/ submit %d, %s' %
-                              (wi, pair_submit, prog))
+                        print('done: %s' % prog)
                         print(task)
                         #print pto
 
-                        (_pair, pair_fns) = task
+                        (pair, pair_fns) = task
                         if pto:
                             self.failures.add_success(pair_fns)
                         else:
                             self.failures.add_failure(pair_fns)
+                        journal.append(pair, pair_fns, pto)
 
                         fn = os.path.join(self.log_dir, 'stat.txt')
                         open(fn + '.tmp', 'w').write(prog + '\n')
@@ -202,16 +294,11 @@ class GridStitch(common_stitch.CommonStitch):
                         # May have failed
                         if pto:
                             final_pair_projects.append(pto)
-                            if pair_complete % 10 == 0:
-                                print('Saving intermediate result to %s' %
-                                      self.project.file_name)
-                                self.project.save()
-                                print('Saved')
 
                     elif what == 'exception':
                         #(_task, e) = out[1]
                         print('!' * 80)
-                        print('ERROR: W%d failed w/ exception' % wi)
+                        print('ERROR: worker failed w/ exception')
                         (_task, _e, estr) = out[1]
                         print('Stack trace:')
                         for l in estr.split('\n'):
@@ -221,57 +308,16 @@ class GridStitch(common_stitch.CommonStitch):
                         if self.ignore_errors:
                             print('Continuing anyway on ignore errors')
                         else:
-                            for worker in self.workers:
-                                worker.running.clear()
                             raise Exception('Shutdown on worker failure')
                     else:
                         print('%s' % (out, ))
                         raise Exception('Internal error: bad task type %s' %
                                         what)
-                # Merge projects
-                if len(final_pair_projects):
-                    print('Merging %d projects' % len(final_pair_projects))
-                    self.project.merge_into(final_pair_projects)
 
-                # Any workers need more work?
-                for wi, worker in enumerate(self.workers):
-                    if all_allocated:
-                        break
-                    if worker.qi.empty():
-                        while True:
-                            try:
-                                pair = next(coord_pairs)
-                            except StopIteration:
-                                print('All tasks allocated')
-                                all_allocated = True
-                                break
-
-                            progress = True
-
-                            print('*' * 80)
-                            print('W%d: submit %s (%d / %d)' %
-                                  (wi, repr(pair), pair_submit, n_pairs))
-
-                            # Image file names as list
-                            pair_images = self.coordinate_map.get_images_from_pair(
-                                pair)
-                            print('pair images: ' + repr(pair_images))
-                            if pair_images[0] is None or pair_images[1] is None:
-                                print('WARNING: skipping missing image')
-                                continue
-
-                            worker.qi.put((pair, pair_images))
-                            pair_submit += 1
-                            break
-
-                if progress:
-                    last_progress = time.time()
-                else:
-                    if time.time() - last_progress > 30:
-                        print('WARNING: server thread stalled')
-                        last_progress = time.time()
-
-                time.sleep(0.1)
+                # Merge projects
+                if final_pair_projects:
+                    self.project.merge_native(final_pair_projects)
+                    final_pair_projects = []
 
             print('pairs done')
 
@@ -279,6 +325,7 @@ class GridStitch(common_stitch.CommonStitch):
             print('Shutting down workers')
             for worker in self.workers:
                 worker.running.clear()
+            journal.close()
 
         print('Reverting canonical file names to original input...')
         # Fixup the canonical hack
@@ -291,9 +338,10 @@ class GridStitch(common_stitch.CommonStitch):
                 il.set_name(orig)
             else:
                 print('WARNING: adding image without feature match %s' % orig)
-                self.project.add_image(orig)
+                self.project.add_image(orig, def_opt=True)
 
         self.project.save()
+        journal.remove()
         '''
         if 0:
             print 'Sub projects (full image):'
@@ -0,0 +1,335 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+In process NumPy supertile stitcher for translation only projects
+
+A stage scanned die is rectilinear images on a rectilinear canvas at the same scale
+that only differ by d/e (plus maybe a hair of roll)
+nona + enblend still cost per supertile: a .pto written, two processes spawned,
+an LZW TIFF written and read back per image and the blended TIFF read back again
+Here each image is placed with a bilinear sub pixel shift (and scale) and blended straight into a numpy canvas:
+-feather: weighted average, weight = distance to the image edge
+-multiband: Laplacian pyramid blend with a hard seam at the center most image (like enblend, minus seam optimization)
+The supertile is done in horizontal bands so the float working set stays small
+Multiband bands overlap by the pyramid's reach so band edges don't show
+
+Placement matches ImageIndex: image center at (canvas w / 2 - d, canvas h / 2 - e)
+times the canvas / image focal length ratio
+Anything else (lens distortion, yaw / pitch, TrX..., photometric correction, image crop)
+is reported by unsupported() and the caller should fall back to nona + enblend
+'''
+
+from PIL import Image
+
+import math
+import numpy as np
+
+BLEND_FEATHER = 'feather'
+BLEND_MULTIBAND = 'multiband'
+BLENDS = (BLEND_MULTIBAND, BLEND_FEATHER)
+
+# Float pixels per band, bounds working memory
+BAND_PIX = 16 * 1000 * 1000
+
+KERNEL = np.array([1, 4, 6, 4, 1], dtype=np.float32) / 16
+
+
+def focal(width, fov):
+    return width / 2.0 / math.tan(math.radians(fov) / 2.0)
+
+
+def unsupported(pto, max_rot_px=0.5):
+    '''Return why pto can't be stitched here or None if it can'''
+    pl = pto.get_panorama_line()
+    if pl.getv('f') not in (None, 0):
+        return 'canvas not rectilinear'
+    for il in pto.get_image_lines():
+        name = il.get_name()
+        if il.getv('f') not in (None, 0):
+            return '%s: not rectilinear' % name
+        r = il.getv('r') or 0.0
+        if abs(math.radians(r)) * max(il.width(),
+                                      il.height()) / 2.0 > max_rot_px:
+            return '%s: rotated %g deg' % (name, r)
+        for k in ('y', 'p', 'a', 'b', 'c', 'g', 't', 'TrX', 'TrY', 'TrZ',
+                  'Vb', 'Vc', 'Vd'):
+            if il.getv(k):
+                return '%s: %s %s' % (name, k, il.getv(k))
+        for k in ('Er', 'Eb', 'Va'):
+            if il.getv(k) not in (None, 1):
+                return '%s: %s %s' % (name, k, il.getv(k))
+        if (il.getv('Eev') or 0) != (pl.getv('E') or 0):
+            return '%s: exposure correction' % name
+        if il.getv('S') is not None:
+            return '%s: cropped' % name
+    return None
+
+
+def blur(a):
+    '''5 tap binomial on both axes, reflected borders'''
+    for axis in (0, 1):
+        n = a.shape[axis]
+        if n < 3:
+            continue
+        pad = [(0, 0)] * a.ndim
+        pad[axis] = (2, 2)
+        p = np.pad(a, pad, mode='reflect')
+        out = np.zeros_like(a)
+        sl = [slice(None)] * a.ndim
+        for k, coef in enumerate(KERNEL):
+            sl[axis] = slice(k, k + n)
+            out += coef * p[tuple(sl)]
+        a = out
+    return a
+
+
+def down(a):
+    return blur(a)[::2, ::2]
+
+
+def up(a, shape):
+    ret = np.zeros(shape, dtype=np.float32)
+    ret[::2, ::2] = a
+    return blur(ret) * 4
+
+
+class Axis(object):
+    '''
+    Source pixel n of one axis lands at supertile pixel (n - k) * scale + c
+    Continuous coordinates with pixel centers at + 0.5, image optical center at size / 2 + d
+    '''
+    def __init__(self, size, c, k, scale):
+        self.size = size
+        self.c = c
+        self.k = k
+        self.scale = scale
+        # First and one past last supertile pixel that has source on both sides
+        self.start = int(math.ceil(c - scale * k - 1e-6))
+        stop = int(math.floor(c + scale * (size - 1 - k) + 1e-6)) + 1
+        self.n = max(stop - self.start, 0)
+
+    def sample(self, j0, j1):
+        '''Source index + bilinear weight of the next one for placed pixels j0:j1'''
+        sx = (np.arange(self.start + j0, self.start + j1) -
+              self.c) / self.scale + self.k
+        sx = np.clip(sx, 0, self.size - 1)
+        idx = np.minimum(np.floor(sx).astype(np.int64), max(self.size - 2, 0))
+        return idx, (sx - idx).astype(np.float32)
+
+
+class Placement(object):
+    '''One image shifted (and scaled) onto the supertile'''
+    def __init__(self, fn, width, height, xs, ys):
+        '''xs, ys: Axis'''
+        self.fn = fn
+        self.xs = xs
+        self.ys = ys
+        self.kx0 = xs.start
+        self.ky0 = ys.start
+        self.w = xs.n
+        self.h = ys.n
+        self.im = None
+
+    def load(self):
+        if self.im is None:
+            self.im = np.asarray(Image.open(self.fn).convert('RGB'))
+        return self.im
+
+    def free(self):
+        self.im = None
+
+    def rect(self, x0, x1, y0, y1):
+        '''Intersect with supertile rect, in placed image coordinates or None'''
+        j0 = max(x0 - self.kx0, 0)
+        j1 = min(x1 - self.kx0, self.w)
+        i0 = max(y0 - self.ky0, 0)
+        i1 = min(y1 - self.ky0, self.h)
+        if j0 >= j1 or i0 >= i1:
+            return None
+        return j0, j1, i0, i1
+
+    def pixels(self, j0, j1, i0, i1):
+        src = self.load()
+        ky, ay = self.ys.sample(i0, i1)
+        kx, ax = self.xs.sample(j0, j1)
+        # Only touch the source rows / cols needed
+        r0 = ky[0]
+        c0 = kx[0]
+        block = src[r0:ky[-1] + 2, c0:kx[-1] + 2]
+        ky = ky - r0
+        kx = kx - c0
+        rows = block[ky].astype(np.float32) * (1 - ay)[:, None, None]
+        if len(block) > 1:
+            rows += block[ky + 1].astype(np.float32) * ay[:, None, None]
+        ret = rows[:, kx] * (1 - ax)[None, :, None]
+        if block.shape[1] > 1:
+            ret += rows[:, kx + 1] * ax[None, :, None]
+        return ret
+
+    def weight(self, j0, j1, i0, i1):
+        '''Distance to the nearest image edge'''
+        j = np.arange(j0, j1, dtype=np.float32)
+        i = np.arange(i0, i1, dtype=np.float32)
+        wx = np.minimum(j + 1, self.w - j)
+        wy = np.minimum(i + 1, self.h - i)
+        return np.minimum(wy[:, None], wx[None, :])
+
+
+class NumpyStitcher(object):
+    def __init__(self, pto, bounds, blend=BLEND_MULTIBAND, levels=None):
+        '''
+        pto: project cropped to bounds, see ProjectSnapshot.sub_project()
+        bounds: (x0, x1, y0, y1) canvas coordinates
+        levels: multiband pyramid levels, default from image size
+        '''
+        if blend not in BLENDS:
+            raise Exception('Bad blend %s' % blend)
+        self.bounds = bounds
+        self.blend = blend
+        x0, x1, y0, y1 = bounds
+        self.width = x1 - x0
+        self.height = y1 - y0
+        pl = pto.get_panorama_line()
+        cw = pl.width2()
+        ch = pl.height2()
+        pano_focal = focal(cw, pl.fov())
+        self.placements = []
+        for il in pto.get_image_lines():
+            w = il.width()
+            h = il.height()
+            scale = pano_focal / focal(w, il.fov())
+            xs = Axis(w, cw / 2.0 - x0 - 0.5, w / 2.0 + (il.x() or 0) - 0.5,
+                      scale)
+            ys = Axis(h, ch / 2.0 - y0 - 0.5, h / 2.0 + (il.y() or 0) - 0.5,
+                      scale)
+            self.placements.append(Placement(il.get_name(), w, h, xs, ys))
+        self.placements.sort(key=lambda p: p.ky0)
+
+        if levels is None:
+            min_side = min([min(il.width(), il.height())
+                            for il in pto.get_image_lines()] or [64])
+            # Coarsest band well inside a typical overlap
+            levels = max(1, int(math.log(max(min_side / 32.0, 2), 2)))
+        while levels > 1 and 2**levels > min(self.width, self.height):
+            levels -= 1
+        self.levels = levels
+        self.align = 2**levels
+        if blend == BLEND_MULTIBAND:
+            # Pyramid reach so bands match a whole supertile blend
+            self.margin = 4 * self.align
+        else:
+            self.margin = 0
+        rows = max(1, BAND_PIX // max(self.width, 1))
+        self.band_rows = max(self.align, rows // self.align * self.align)
+
+    def run(self):
+        '''Return stitched supertile as a PIL RGB image'''
+        print('numpy stitch: %u images, %uw X %uh, %s blend, %u levels' %
+              (len(self.placements), self.width, self.height, self.blend,
+               self.levels))
+        out = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        for by0 in range(0, self.height, self.band_rows):
+            by1 = min(by0 + self.band_rows, self.height)
+            ry0 = max(0, by0 - self.margin)
+            ry1 = min(self.height, by1 + self.margin)
+            if self.blend == BLEND_MULTIBAND:
+                band = self.multiband(ry0, ry1)
+            else:
+                band = self.feather(ry0, ry1)
+            out[by0:by1] = np.clip(np.rint(band[by0 - ry0:by1 - ry0]), 0,
+                                   255).astype(np.uint8)
+            # Rows are done in order, drop images above what's left
+            for p in self.placements:
+                if p.ky0 + p.h <= by1 - self.margin:
+                    p.free()
+        return Image.fromarray(out)
+
+    def feather(self, ry0, ry1):
+        acc = np.zeros((ry1 - ry0, self.width, 3), dtype=np.float32)
+        wsum = np.zeros((ry1 - ry0, self.width), dtype=np.float32)
+        for p in self.placements:
+            rect = p.rect(0, self.width, ry0, ry1)
+            if rect is None:
+                continue
+            j0, j1, i0, i1 = rect
+            w = p.weight(j0, j1, i0, i1)
+            dst = (slice(p.ky0 + i0 - ry0,
+                         p.ky0 + i1 - ry0), slice(p.kx0 + j0, p.kx0 + j1))
+            acc[dst] += p.pixels(j0, j1, i0, i1) * w[:, :, None]
+            wsum[dst] += w
+        return acc / np.where(wsum > 0, wsum, 1.0)[:, :, None]
+
+    def multiband(self, ry0, ry1):
+        rh = ry1 - ry0
+        rw = self.width
+        # Seam: each pixel goes to the image it is deepest inside of
+        best = np.zeros((rh, rw), dtype=np.float32)
+        owner = np.full((rh, rw), -1, dtype=np.int32)
+        rects = []
+        for pi, p in enumerate(self.placements):
+            rect = p.rect(0, rw, ry0, ry1)
+            rects.append(rect)
+            if rect is None:
+                continue
+            j0, j1, i0, i1 = rect
+            dst = (slice(p.ky0 + i0 - ry0,
+                         p.ky0 + i1 - ry0), slice(p.kx0 + j0, p.kx0 + j1))
+            w = p.weight(j0, j1, i0, i1)
+            sel = w > best[dst]
+            best[dst] = np.where(sel, w, best[dst])
+            owner[dst] = np.where(sel, pi, owner[dst])
+        del best
+
+        shapes = []
+        h, w = rh, rw
+        for _l in range(self.levels + 1):
+            shapes.append((h, w))
+            h, w = (h + 1) // 2, (w + 1) // 2
+        acc = [np.zeros(s + (3, ), dtype=np.float32) for s in shapes]
+        wsum = [np.zeros(s, dtype=np.float32) for s in shapes]
+        a = self.align
+        for pi, (p, rect) in enumerate(zip(self.placements, rects)):
+            if rect is None:
+                continue
+            j0, j1, i0, i1 = rect
+            # Valid pixels in region coordinates
+            vy0, vy1 = p.ky0 + i0 - ry0, p.ky0 + i1 - ry0
+            vx0, vx1 = p.kx0 + j0, p.kx0 + j1
+            # Pad so the pyramid has room to roll off, aligned so levels line up
+            y0 = max(0, (vy0 - 2 * a) // a * a)
+            x0 = max(0, (vx0 - 2 * a) // a * a)
+            y1 = min(rh, vy1 + 2 * a)
+            x1 = min(rw, vx1 + 2 * a)
+            im = np.zeros((y1 - y0, x1 - x0, 3), dtype=np.float32)
+            im[vy0 - y0:vy1 - y0,
+               vx0 - x0:vx1 - x0] = p.pixels(j0, j1, i0, i1)
+            mask = (owner[y0:y1, x0:x1] == pi).astype(np.float32)
+            for l in range(self.levels + 1):
+                if l < self.levels:
+                    im_next = down(im)
+                    lap = im - up(im_next, im.shape)
+                else:
+                    lap = im
+                ly = y0 >> l
+                lx = x0 >> l
+                lh, lw = lap.shape[:2]
+                acc[l][ly:ly + lh, lx:lx + lw] += lap * mask[:, :, None]
+                wsum[l][ly:ly + lh, lx:lx + lw] += mask
+                if l < self.levels:
+                    im = im_next
+                    mask = down(mask)
+        del owner
+
+        ret = None
+        for l in range(self.levels, -1, -1):
+            this = acc[l] / np.where(wsum[l] > 0, wsum[l], 1.0)[:, :, None]
+            if ret is None:
+                ret = this
+            else:
+                ret = up(ret, this.shape) + this
+            acc[l] = None
+            wsum[l] = None
+        return ret
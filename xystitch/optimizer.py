@@ -32,12 +32,7 @@ from xystitch.pto.util import img_cpls, PImage, ImageCoordinateMap
 from xystitch.benchmark import Benchmark
 from xystitch import statistics
 from xystitch.config import config
-
-import math
-
-
-class NoRMS(Exception):
-    pass
+from xystitch.residual import NoRMS, Residuals
 
 
 def debug(s=''):
@@ -1082,49 +1077,17 @@ def xy_opt(project,
 
 
 def iter_rms(project):
-    for cpl in project.control_point_lines:
-        n = cpl.get_variable('n')
-        imgn = project.image_lines[n]
-        N = cpl.get_variable('N')
-        imgN = project.image_lines[N]
-
-        # global coordinates (d/e) are positive upper left
-        # but image coordinates (x/X//y/Y) are positive down right
-        # wtf?
-        # invert the sign so that the math works out
-        try:
-            dx2 = ((imgn.getv('d') - cpl.getv('x')) -
-                   (imgN.getv('d') - cpl.getv('X')))**2
-            dy2 = ((imgn.getv('e') - cpl.getv('y')) -
-                   (imgN.getv('e') - cpl.getv('Y')))**2
-        # Abort RMS if not all variables defined
-        except TypeError:
-            raise NoRMS("Missing variable (%s, %s, %s)" %
-                        (imgn.text, imgN.text, cpl.text))
-
-        if 0:
-            print('iter')
-            print(('  ', imgn.text))
-            print(('  ', imgN.text))
-            print(('  ', imgn.getv('d'), cpl.getv('x'), imgN.getv('d'),
-                   cpl.getv('X')))
-            print(('  %f vs %f' % ((imgn.getv('d') + cpl.getv('x')),
-                                   (imgN.getv('d') + cpl.getv('X')))))
-            print(('  ', imgn.getv('e'), cpl.getv('y'), imgN.getv('e'),
-                   cpl.getv('Y')))
-            print(('  %f vs %f' % ((imgn.getv('e') + cpl.getv('y')),
-                                   (imgN.getv('e') + cpl.getv('Y')))))
-
-        rms_this = math.sqrt(dx2 + dy2)
-        yield cpl, n, imgn, N, imgN, rms_this
+    """Yield cpl, n, imgn, N, imgN, rms_this for every control point"""
+    res = Residuals(project)
+    for i, (n, N, rms_this) in enumerate(
+            zip(res.n.tolist(), res.N.tolist(), res.dist.tolist())):
+        yield res.cpl(i), n, project.image_lines[n], N, project.image_lines[
+            N], rms_this
 
 
 def get_rms(project):
     '''Calculate the root mean square error between control points'''
-    rms = 0.0
-    for _cpl, _n, _imgn, _N, _imgN, rms_this in iter_rms(project):
-        rms += rms_this
-    return rms / len(project.control_point_lines)
+    return Residuals(project).mean()
 
 
 def check_poor_opt(project, icm=None):
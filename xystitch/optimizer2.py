@@ -31,18 +31,16 @@ from xystitch import microscopej
 from xystitch.pto.util import img_cpls, PImage, ImageCoordinateMap
 from xystitch.benchmark import Benchmark
 from xystitch.config import config
+from xystitch.residual import NoRMS, Residuals
+from xystitch import xy_solver
 
-import math
+import numpy as np
 
 # this package is more standard now
 # from xystitch import statistics
 import statistics
 
 
-class NoRMS(Exception):
-    pass
-
-
 def debug(s=''):
     pass
 
@@ -330,6 +328,107 @@ class PTOptimizer:
         print('Optimized project in %s' % bench)
 
 
+class TranslationOptimizer:
+    '''
+    In process replacement for PTOptimizer when only d/e vary (stage scans)
+
+    Minimizes sum |(d_n - x) - (d_N - X)|^2 + |(e_n - y) - (e_N - Y)|^2 over all control points
+    (the Residuals convention) as one sparse linear system, see xy_solver.LaplacianSolver
+    Optimized images are those with d/e on a v line, everything else is held
+    Results are written directly into the image lines: no copy, no PToptimizer form text,
+    no subprocess and no reparse
+    Other v line variables (r, v, ...) are not optimized and left as is
+    '''
+    def __init__(self, project):
+        self.project = project
+        self.verbose = False
+        # Same meaning as PTOptimizer
+        self.rms_error_threshold = 250.0
+        self.reoptimize = True
+        self.rms_error = None
+        # Mean residual distance and control point count per image, see Residuals.image_stats()
+        self.image_residuals = None
+
+    def free_images(self):
+        '''(free d, free e) bool arrays from the v lines'''
+        nimages = self.project.nimages()
+        free = [np.zeros(nimages, dtype=bool), np.zeros(nimages, dtype=bool)]
+        ignored = set()
+        for vl in self.project.variable_lines:
+            for k, v in vl.variables.items():
+                if k == 'd':
+                    free[0][v] = True
+                elif k == 'e':
+                    free[1][v] = True
+                else:
+                    ignored.add(k)
+        if ignored:
+            print('TranslationOptimizer: not optimizing %s' %
+                  ' '.join(sorted(ignored)))
+        return free
+
+    def run(self):
+        bench = Benchmark()
+        project = self.project
+        project.parse()
+        ils = project.get_image_lines()
+        nimages = len(ils)
+
+        free = self.free_images()
+        for axis, k in enumerate('de'):
+            for i, il in enumerate(ils):
+                if il.getv(k) is None or (self.reoptimize and
+                                          not free[axis][i]):
+                    il.set_variable(k, 0.0)
+
+        # Offsets at the current positions, then solve from scratch
+        res = Residuals(project)
+        p0 = np.array([[il.getv('d'), il.getv('e')] for il in ils],
+                      dtype=np.float64).reshape(-1, 2)
+        n, N = res.n, res.N
+        # p[n] - p[N] = (x - X, y - Y)
+        o = np.stack(((p0[n, 0] - p0[N, 0]) - res.dx,
+                      (p0[n, 1] - p0[N, 1]) - res.dy),
+                     axis=1)
+        solver = xy_solver.LaplacianSolver(nimages, N, n)
+        labels = xy_solver.components(nimages, N, n)
+        p = p0.copy()
+        for axis in range(2):
+            fixed = ~free[axis]
+            # A component with nothing held has no unique solution, hold one image
+            held = set(labels[fixed].tolist())
+            for label in sorted(set(labels.tolist()) - held):
+                i = int(np.nonzero(labels == label)[0][0])
+                if (labels == label).sum() > 1:
+                    print(
+                        'WARNING: no reference image for %s and %d others, holding it'
+                        % (ils[i].get_name(), (labels == label).sum() - 1))
+                fixed[i] = True
+            p[:, axis] = solver.solve(np.ones(len(n)), o, fixed, p0)[:, axis]
+
+        for il, (d, e) in zip(ils, p.tolist()):
+            il.set_variable('d', d)
+            il.set_variable('e', e)
+
+        res = Residuals(project)
+        self.rms_error = res.rms()
+        self.image_residuals = res.image_stats()
+        print('Optimize: RMS error of %f' % self.rms_error)
+        means, counts = self.image_residuals
+        worst = np.argsort(np.where(np.isnan(means), -1.0, means))[::-1][:5]
+        for i in worst.tolist():
+            if counts[i]:
+                print('  %s: %0.2f mean over %d points' %
+                      (ils[i].get_name(), means[i], counts[i]))
+        # Filter out gross optimization problems
+        if self.rms_error_threshold and self.rms_error > self.rms_error_threshold:
+            raise Exception("Max RMS error threshold %f but got %f" %
+                            (self.rms_error_threshold, self.rms_error))
+
+        bench.stop()
+        print('Optimized project in %s' % bench)
+
+
 def pto2icm(pto):
     fns = []
     for il in pto.get_image_lines():
@@ -749,49 +848,17 @@ def anchor(project, icm, use_cr=None):
 
 
 def iter_rms(project):
-    for cpl in project.control_point_lines:
-        n = cpl.get_variable('n')
-        imgn = project.image_lines[n]
-        N = cpl.get_variable('N')
-        imgN = project.image_lines[N]
-
-        # global coordinates (d/e) are positive upper left
-        # but image coordinates (x/X//y/Y) are positive down right
-        # wtf?
-        # invert the sign so that the math works out
-        try:
-            dx2 = ((imgn.getv('d') - cpl.getv('x')) -
-                   (imgN.getv('d') - cpl.getv('X')))**2
-            dy2 = ((imgn.getv('e') - cpl.getv('y')) -
-                   (imgN.getv('e') - cpl.getv('Y')))**2
-        # Abort RMS if not all variables defined
-        except TypeError:
-            raise NoRMS("Missing variable (%s, %s, %s)" %
-                        (imgn.text, imgN.text, cpl.text))
-
-        if 0:
-            print('iter')
-            print(('  ', imgn.text))
-            print(('  ', imgN.text))
-            print(('  ', imgn.getv('d'), cpl.getv('x'), imgN.getv('d'),
-                   cpl.getv('X')))
-            print(('  %f vs %f' % ((imgn.getv('d') + cpl.getv('x')),
-                                   (imgN.getv('d') + cpl.getv('X')))))
-            print(('  ', imgn.getv('e'), cpl.getv('y'), imgN.getv('e'),
-                   cpl.getv('Y')))
-            print(('  %f vs %f' % ((imgn.getv('e') + cpl.getv('y')),
-                                   (imgN.getv('e') + cpl.getv('Y')))))
-
-        rms_this = math.sqrt(dx2 + dy2)
-        yield cpl, n, imgn, N, imgN, rms_this
+    """Yield cpl, n, imgn, N, imgN, rms_this for every control point"""
+    res = Residuals(project)
+    for i, (n, N, rms_this) in enumerate(
+            zip(res.n.tolist(), res.N.tolist(), res.dist.tolist())):
+        yield res.cpl(i), n, project.image_lines[n], N, project.image_lines[
+            N], rms_this
 
 
 def get_rms(project):
     '''Calculate the root mean square error between control points'''
-    rms = 0.0
-    for _cpl, _n, _imgn, _N, _imgN, rms_this in iter_rms(project):
-        rms += rms_this
-    return rms / len(project.control_point_lines)
+    return Residuals(project).mean()
 
 
 def check_poor_opt(project, icm=None):
@@ -925,6 +992,10 @@ class XYOptimizer2:
         # self.r_orders = 1
         # TODO: some check parameter on camera rotation
         # We are fed an estimate but may come up with something better
+        # Initial placement
+        # spiral: attach images outward from the anchor (attach_image_adjacent())
+        # lsq: global robust least squares over all pairs (see xy_solver)
+        self.solver = 'spiral'
 
     def verify_image_assumptions(self):
         """
@@ -1129,6 +1200,15 @@ class XYOptimizer2:
         ret[(n, N)] = [list of cpls]
         """
         if cpls is None:
+            cpa = self.project.columnar_cps()
+            if cpa is not None:
+                # Row views instead of full ControlPointLine objects
+                ret = {}
+                for i, (n, N) in enumerate(
+                        zip(cpa.arr['n'].tolist(), cpa.arr['N'].tolist())):
+                    ret.setdefault((n, N), []).append(cpa.row(i))
+                self.cpl_index = ret
+                return
             cpls = self.project.control_point_lines
         ret = {}
         for cpl in cpls:
@@ -1136,12 +1216,17 @@ class XYOptimizer2:
         self.cpl_index = ret
 
     def write_cp_index(self):
-        old = len(self.project.control_point_lines)
-        self.project.control_point_lines = []
-        for cpls in self.cpl_index.values():
-            self.project.control_point_lines.extend(cpls)
+        old = self.project.ncontrol_points()
+        cpls = []
+        for cpls_pair in self.cpl_index.values():
+            cpls.extend(cpls_pair)
+        cpa = self.project.columnar_cps()
+        if cpa is not None:
+            self.project.set_cp_array(cpa.from_lines(cpls))
+        else:
+            self.project.control_point_lines = cpls
         print("Updating cp index: %u => %u" %
-              (old, len(self.project.control_point_lines)))
+              (old, self.project.ncontrol_points()))
 
     def print_check_control_points(self):
         fail = False
@@ -1401,44 +1486,17 @@ class XYOptimizer2:
 
         # Chose an image in the center to attach other images to
         anch_c, anch_r = anchor(project, icm, use_cr=self.anchor_cr)
-        closed_set = {(anch_c, anch_r): (0.0, 0.0)}
-
-        print("")
-        print("")
-        # Attach images to neighbors starting in middle and working outward
-        # For a healthy stitch this should attach all images
-        print('First pass: adjacent images')
-        attach_image_adjacent(project,
-                              icm,
-                              closed_set,
-                              pairsx,
-                              pairsy,
-                              order=1,
-                              verbose=self.verbose)
-        """
-        print("")
-        print("")
-        # If an image couldn't be connected directly, guess based on nearby data?
-        print('Second pass: adjacent adjacent images')
-        attach_image_adjacent(
-            project, icm, closed_set, pairsx, pairsy, order=2, verbose=verbose)
-        """
-
-        print("")
-        print("")
-        attach_image_linear(project,
-                            icm,
-                            closed_set,
-                            pairsx,
-                            pairsy,
-                            xbase=0,
-                            xorder=1,
-                            ybase=0,
-                            yorder=1)
+        if self.solver == 'lsq':
+            closed_set = self.xy_opt_lsq(pairsx, pairsy, (anch_c, anch_r))
+        elif self.solver == 'spiral':
+            closed_set = self.xy_opt_spiral(pairsx, pairsy, (anch_c, anch_r))
+        else:
+            raise Exception('Unknown solver %s' % self.solver)
 
         print("")
         print("")
         # critical image => couldn't locate
+        # For a healthy stitch this should attach all images
         print('Checking for critical images')
         for y in range(icm.height()):
             for x in range(icm.width()):
@@ -1476,6 +1534,65 @@ class XYOptimizer2:
         # internal use only
         return closed_set
 
+    def xy_opt_lsq(self, pairsx, pairsy, anchor_cr):
+        '''Place all images at once, see xy_solver'''
+        project = self.project
+        icm = self.icm
+        nodes_cr = []
+        for y in range(icm.height()):
+            for x in range(icm.width()):
+                if icm.get_image(x, y) is not None:
+                    nodes_cr.append((x, y))
+        closed_set, _weights = xy_solver.solve_positions(
+            nodes_cr,
+            xy_solver.pair_offsets(pairsx, pairsy),
+            anchor_cr,
+            verbose=self.verbose)
+        for (x, y), (xpos, ypos) in closed_set.items():
+            il = project.img_fn2il[icm.get_image(x, y)]
+            il.set_x(xpos)
+            il.set_y(ypos)
+        return closed_set
+
+    def xy_opt_spiral(self, pairsx, pairsy, anchor_cr):
+        project = self.project
+        icm = self.icm
+        closed_set = {anchor_cr: (0.0, 0.0)}
+
+        print("")
+        print("")
+        # Attach images to neighbors starting in middle and working outward
+        # For a healthy stitch this should attach all images
+        print('First pass: adjacent images')
+        attach_image_adjacent(project,
+                              icm,
+                              closed_set,
+                              pairsx,
+                              pairsy,
+                              order=1,
+                              verbose=self.verbose)
+        """
+        print("")
+        print("")
+        # If an image couldn't be connected directly, guess based on nearby data?
+        print('Second pass: adjacent adjacent images')
+        attach_image_adjacent(
+            project, icm, closed_set, pairsx, pairsy, order=2, verbose=verbose)
+        """
+
+        print("")
+        print("")
+        attach_image_linear(project,
+                            icm,
+                            closed_set,
+                            pairsx,
+                            pairsy,
+                            xbase=0,
+                            xorder=1,
+                            ybase=0,
+                            yorder=1)
+        return closed_set
+
     def run(self, anchor_cr=None, check_poor_opt=True):
         print(('Verbose: %d' % self.verbose))
 
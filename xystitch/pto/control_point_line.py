@@ -5,11 +5,17 @@ Licensed under a 2 clause BSD license, see COPYING for details
 '''
 
 import os
+import re
 import shutil
 from xystitch.temp_file import ManagedTempFile
 from xystitch.execute import Execute
 from . import line
 
+_V = r'([+\-0-9][^ ]*)'
+# Fast path for the usual form, anything else goes through the generic tokenizer
+# c n0 N1 x1444.778035 y233.742619 X1225.863118 Y967.737131 t0
+CPL_RE = re.compile(r'c n%s N%s x%s y%s X%s Y%s t%s$' % ((_V, ) * 7))
+
 
 class ControlPointLine(line.Line):
     def __init__(self, text=None, project=None, variables=None):
@@ -20,6 +26,13 @@ class ControlPointLine(line.Line):
         self.upper_image = None
         line.Line.__init__(self, text, project, variables=variables)
 
+    def cow_copy(self, project):
+        ret = line.Line.cow_copy(self, project)
+        # Image lines of the other project
+        ret.lower_image = None
+        ret.upper_image = None
+        return ret
+
     def prefix(self):
         return 'c'
 
@@ -38,6 +51,26 @@ class ControlPointLine(line.Line):
     def string_variables(self):
         return set()
 
+    def reparse(self):
+        m = CPL_RE.match(self.text)
+        if m:
+            n, N, x, y, X, Y, t = m.groups()
+            try:
+                self.variables = {
+                    'n': int(n),
+                    'N': int(N),
+                    'x': float(x),
+                    'y': float(y),
+                    'X': float(X),
+                    'Y': float(Y),
+                    't': int(t),
+                }
+                return
+            # Let the generic parser report it
+            except ValueError:
+                pass
+        line.Line.reparse(self)
+
     @staticmethod
     def from_line(line, pto_project):
         ret = ControlPointLine()
@@ -0,0 +1,198 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+Columnar control point storage
+
+A ControlPointLine costs a dict, a comments list and the raw text per point
+Large projects have 500k+ points that are only ever read in bulk
+Instead keep them as one structured array and hand out
+lightweight row views or real ControlPointLine objects on demand
+
+Only the canonical form (exactly n N x y X Y t) can be stored
+Anything else stays as ControlPointLine objects
+Arrays are treated as immutable: edits produce a new ControlPointArray
+'''
+
+from .control_point_line import ControlPointLine, CPL_RE
+
+import numpy as np
+
+CP_DTYPE = np.dtype([
+    ('n', np.int32),
+    ('N', np.int32),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('X', np.float64),
+    ('Y', np.float64),
+    ('t', np.int32),
+])
+CP_KEYS = CP_DTYPE.names
+CP_INT_KEYS = set(['n', 'N', 't'])
+
+
+def cp_text(n, N, x, y, X, Y, t):
+    '''Must match ControlPointLine.__str__() for the canonical form'''
+    return 'c n%s N%s x%s y%s X%s Y%s t%s' % (n, N, x, y, X, Y, t)
+
+
+class ControlPointRow(object):
+    '''
+    Read mostly view of a single control point
+    Quacks enough like ControlPointLine for the optimizers
+    '''
+    __slots__ = ('cpa', 'i')
+
+    def __init__(self, cpa, i):
+        self.cpa = cpa
+        self.i = i
+
+    def getv(self, k):
+        return self.cpa.arr[k][self.i].item()
+
+    def get_variable(self, k):
+        return self.getv(k)
+
+    @property
+    def variables(self):
+        return dict(zip(CP_KEYS, self.cpa.arr[self.i].tolist()))
+
+    @property
+    def text(self):
+        return str(self)
+
+    def __str__(self, key_blacklist=None):
+        return cp_text(*self.cpa.arr[self.i].tolist())
+
+    def regen(self, key_blacklist=None):
+        return str(self) + '\n'
+
+    def to_line(self, project=None):
+        return ControlPointLine(project=project, variables=self.variables)
+
+
+class ControlPointArray(object):
+    def __init__(self, arr=None):
+        if arr is None:
+            arr = np.zeros(0, dtype=CP_DTYPE)
+        self.arr = arr
+
+    def __len__(self):
+        return len(self.arr)
+
+    @staticmethod
+    def from_texts(texts):
+        '''Parse raw c lines, None if any line isn't in canonical form'''
+        rows = []
+        for text in texts:
+            m = CPL_RE.match(text.strip())
+            if not m:
+                return None
+            n, N, x, y, X, Y, t = m.groups()
+            try:
+                rows.append((int(n), int(N), float(x), float(y), float(X),
+                             float(Y), int(t)))
+            except ValueError:
+                return None
+        return ControlPointArray(np.array(rows, dtype=CP_DTYPE))
+
+    @staticmethod
+    def from_lines(cpls):
+        '''Pack ControlPointLine objects, None if any can't round trip'''
+        rows = []
+        for cpl in cpls:
+            if isinstance(cpl, ControlPointRow):
+                rows.append(tuple(cpl.cpa.arr[cpl.i].tolist()))
+                continue
+            variables = cpl.variables
+            if len(variables) != len(CP_KEYS) or cpl.comments:
+                return None
+            row = []
+            for k in CP_KEYS:
+                v = variables.get(k)
+                # float 5.0 vs int 5 print differently, so types must be exact
+                if type(v) is not (int if k in CP_INT_KEYS else float):
+                    return None
+                row.append(v)
+            rows.append(tuple(row))
+        return ControlPointArray(np.array(rows, dtype=CP_DTYPE))
+
+    def row(self, i):
+        return ControlPointRow(self, i)
+
+    def rows(self):
+        for i in range(len(self.arr)):
+            yield ControlPointRow(self, i)
+
+    def to_lines(self, project=None):
+        '''Materialize as ControlPointLine objects'''
+        ret = []
+        for vals in self.arr.tolist():
+            ret.append(
+                ControlPointLine(project=project,
+                                 variables=dict(zip(CP_KEYS, vals))))
+        return ret
+
+    def iter_text(self):
+        for vals in self.arr.tolist():
+            yield cp_text(*vals) + '\n'
+
+    def get_text(self):
+        return ''.join(self.iter_text())
+
+    def rows_where(self, mask):
+        return [ControlPointRow(self, i) for i in np.nonzero(mask)[0].tolist()]
+
+    def image_deltas(self, image_lines):
+        '''
+        Per point (dx, dy) mismatch given current image positions (d/e)
+        Same math as optimizer2.iter_rms()
+        Raises TypeError if a referenced image is missing d/e
+        '''
+        d = np.array([il.getv('d') for il in image_lines], dtype=np.float64)
+        e = np.array([il.getv('e') for il in image_lines], dtype=np.float64)
+        n = self.arr['n']
+        N = self.arr['N']
+        # numpy quietly turns None into nan
+        if np.isnan(d[n]).any() or np.isnan(d[N]).any() or np.isnan(
+                e[n]).any() or np.isnan(e[N]).any():
+            raise TypeError('Missing image d/e')
+        dx = (d[n] - self.arr['x']) - (d[N] - self.arr['X'])
+        dy = (e[n] - self.arr['y']) - (e[N] - self.arr['Y'])
+        return dx, dy
+
+    def take(self, selector):
+        '''New array from an index array or boolean mask'''
+        return ControlPointArray(self.arr[selector])
+
+    def pair_keys(self, nimages):
+        '''Unique int64 per ordered (n, N)'''
+        return self.arr['n'].astype(np.int64) * nimages + self.arr['N']
+
+    def pair_mask(self, pairs, nimages):
+        '''True where (n, N) or (N, n) is in pairs'''
+        keys = []
+        for n, N in pairs:
+            keys.append(n * nimages + N)
+            keys.append(N * nimages + n)
+        return np.isin(self.pair_keys(nimages), np.array(keys,
+                                                         dtype=np.int64))
+
+    def image_mask(self, i):
+        '''True where control point touches image i'''
+        return (self.arr['n'] == i) | (self.arr['N'] == i)
+
+    def remap_images(self, old2new):
+        '''
+        old2new: int array, new image index or -1 to drop
+        Drops control points referencing a dropped image
+        '''
+        n = old2new[self.arr['n']]
+        N = old2new[self.arr['N']]
+        keep = (n >= 0) & (N >= 0)
+        arr = self.arr[keep]
+        arr['n'] = n[keep]
+        arr['N'] = N[keep]
+        return ControlPointArray(arr)
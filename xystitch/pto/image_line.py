@@ -219,8 +219,8 @@ class ImageLine(line.Line):
     # Entire line
     text = None
     """
-    def __init__(self, text, project):
-        line.Line.__init__(self, text, project)
+    def __init__(self, text, project, variables=None):
+        line.Line.__init__(self, text, project, variables=variables)
         self.image = None
 
     def prefix(self):
@@ -281,6 +281,14 @@ class ImageLine(line.Line):
     def set_name(self, name):
         return self.set_variable('n', name)
 
+    def setv(self, k, v=None):
+        if k != 'n' or self.project is None:
+            return line.Line.setv(self, k, v)
+        old = self.getv('n')
+        line.Line.setv(self, k, v)
+        # Keep the project's file name index in sync
+        self.project.image_renamed(self, old)
+
     def make_absolute(self, to):
         '''Make image path absolute.  Location is assumed to be working dir unless otherwise specified'''
         if to is None:
@@ -334,13 +342,9 @@ class ImageLine(line.Line):
         return self.get_variable('v')
 
     def get_index(self):
-        if self.project.il2i:
-            return self.project.il2i[self]
-        i = 0
-        for line in self.project.image_lines:
-            if line is self:
-                return i
-            i += 1
+        ret = self.project.il2i.get(self)
+        if ret is not None:
+            return ret
         raise Exception('Image %s is not in panorama w/ %u images' %
                         (self.get_name(), len(self.project.image_lines)))
 
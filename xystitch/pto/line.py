@@ -6,6 +6,7 @@ Licensed under a 2 clause BSD license, see COPYING for details
 
 import shutil
 import os
+import re
 from xystitch.temp_file import ManagedTempFile
 from xystitch.execute import Execute
 from xystitch.pto.util import dbg
@@ -13,8 +14,16 @@ from xystitch.pto.util import dbg
 #def dbg(s=''):
 #	print s
 
+# One k/v token per match, same rules as the original character walker:
+# key chars (= dropped) followed by either a quoted value,
+# a numeric value running to the next space, or a space / end of line
+TOKEN_RE = re.compile(r'([^ "+\-0-9]*)(?:"([^"]*)("?)|([+\-0-9][^ ]*) ?| ?)')
+
 
 class Line:
+    # variables dict is also referenced by a copy, see cow_copy()
+    shared = False
+
     def __init__(self, text=None, project=None, variables=None):
         # Variables for the line as dict
         # If a value is not set, it should not have the key even present
@@ -93,7 +102,27 @@ class Line:
     def set_variable(self, k, v=None):
         self.setv(k, v)
 
+    def cow_copy(self, project):
+        '''
+        Return a copy bound to project that shares variables until either one is modified
+        Much cheaper than deepcopy for read mostly copies
+        '''
+        ret = self.__class__.__new__(self.__class__)
+        ret.__dict__.update(self.__dict__)
+        ret.project = project
+        ret.comments = list(self.comments)
+        ret.shared = True
+        self.shared = True
+        return ret
+
+    def own_variables(self):
+        '''Copy variables if shared so they can be modified'''
+        if self.shared:
+            self.variables = dict(self.variables)
+            self.shared = False
+
     def setv(self, k, v=None):
+        self.own_variables()
         '''
 		if v is None:
 			if k in self.variables:
@@ -105,6 +134,7 @@ class Line:
         #print 'new variables set (%s: %s): %s' % (str(k), str(v), str(self.variables))
 
     def remove_variable(self, k):
+        self.own_variables()
         if k in self.variables:
             del self.variables[k]
 
@@ -138,39 +168,53 @@ class Line:
 
         self.update()
 
-        dbg()
-        dbg('original: %s' % self.text)
-        dbg('variables: %s' % self.variables)
-
-        ret = self.prefix()
+        # Joined once, += per variable adds up over a million lines
+        parts = [self.prefix()]
 
         printed = set()
         for k in self.variable_print_order():
             if k in key_blacklist:
                 continue
             if k in self.variables:
-                v = self.variables[k]
-                dbg('k: %s, v: %s' % (repr(k), repr(v)))
                 printed.add(k)
-                ret += ' %s' % self.print_variable(k)
+                parts.append(self.print_variable(k))
 
         for k in self.variables:
             if k in key_blacklist:
                 continue
             if k in printed:
                 continue
-            ret += ' %s' % self.print_variable(k)
+            parts.append(self.print_variable(k))
 
-        dbg('final: %s' % ret)
-
-        return ret
+        return ' '.join(parts)
 
     def regen(self, key_blacklist=None):
-        text = ''
-        for comment_line in self.comments:
-            text += '%s\n' % comment_line
-        text += '%s\n' % self.__str__(key_blacklist)
-        return text
+        if not self.comments:
+            return self.__str__(key_blacklist) + '\n'
+        return ''.join('%s\n' % comment_line
+                       for comment_line in self.comments
+                       ) + '%s\n' % self.__str__(key_blacklist)
+
+    def var_types(self):
+        '''
+        Returns dict of key => converter (None if kept as is)
+        The type sets are fixed per line type, so only build this once per class
+        '''
+        cls = self.__class__
+        ret = cls.__dict__.get('_var_types')
+        if ret is None:
+            ret = dict()
+            # Lowest priority first to match the old if/elif order
+            for k in self.string_variables():
+                ret[k] = None
+            for k in self.float_variables():
+                ret[k] = float
+            for k in self.int_variables():
+                ret[k] = int
+            for k in self.key_variables():
+                ret[k] = None
+            cls._var_types = ret
+        return ret
 
     def get_tokens(self):
         '''
@@ -185,57 +229,19 @@ class Line:
 		Instead, they will be re-added when writing
 		'''
         tokens = list()
-        i = 0
         # Some version have a0, some have a=0 although a0 seems much more common
-        while i < len(self.text):
-            k = ''
-            v = None
-
-            # Find the key: keep going until we hit either ", number, or space
-            while i < len(self.text):
-                c = self.text[i]
-                # End of this k/v?
-                if c == ' ':
-                    i += 1
-                    break
-                # A quoted value?
-                elif c == '"':
-                    i += 1
-                    v = ''
-                    # Note we skip the "
-                    while True:
-                        if i >= len(self.text):
-                            raise Exception('Missing closing " on %s' %
-                                            self.text)
-                        c = self.text[i]
-                        if c == '"':
-                            i += 1
-                            break
-                        v += c
-                        i += 1
-                    # Think we should have at most one quoted thingy
-                    break
-                # A numeric value?
-                elif c in '+-0123456789':
-                    v = ''
-                    # Note we include the original char
-                    while i < len(self.text):
-                        c = self.text[i]
-                        if c == ' ':
-                            i += 1
-                            break
-                        v += c
-                        i += 1
-                    break
-                else:
-                    # This may not be bulletproof but I think its good enough
-                    # These lines show up when you add images in Hugin
-                    # ex bad: a=a but I'm not sure thats valid anyway
-                    if c != '=':
-                        k += c
-
-                i += 1
-
+        for m in TOKEN_RE.finditer(self.text):
+            k, vq, vq_end, v = m.groups()
+            # A quoted value?
+            if vq is not None:
+                if not vq_end:
+                    raise Exception('Missing closing " on %s' % self.text)
+                v = vq
+            # This may not be bulletproof but I think its good enough
+            # These lines show up when you add images in Hugin
+            # ex bad: a=a but I'm not sure thats valid anyway
+            if '=' in k:
+                k = k.replace('=', '')
             # Discard extra spaces and some other corner cases
             if len(k) > 0:
                 tokens.append((k, v))
@@ -244,14 +250,9 @@ class Line:
 
     def reparse(self):
         self.variables = dict()
+        types = self.var_types()
         first = True
-        #for token in self.text.split(' '):
         for (k, v) in self.get_tokens():
-            #print 'token: "%s"' % token
-            #k = token[0]
-            #v = token[1:]
-            dbg('k: %s, v: %s' % (repr(k), repr(v)))
-
             # We can still have empty string
             if not v is None and len(v) == 0:
                 v = None
@@ -267,19 +268,13 @@ class Line:
 
             # Convert if possible
             try:
-                if k in self.key_variables():
-                    pass
-                elif k in self.int_variables():
-                    v = int(v)
-                elif k in self.float_variables():
-                    v = float(v)
-                elif k in self.string_variables():
-                    # Already in string form
-                    pass
-                else:
+                if k not in types:
                     print('WARNING: unknown data type on %s (full: %s)' %
                           (k, self.text))
                     raise Exception('Unknown key %s' % k)
+                conv = types[k]
+                if conv is not None:
+                    v = conv(v)
             except:
                 print('line: %s' % self.text)
                 print('key: %s, value: %s' % (repr(k), repr(v)))
@@ -287,7 +282,7 @@ class Line:
                 raise
 
             # Ready to roll
-            self.set_variable(k, v)
+            self.variables[k] = v
 
     def print_variables(self):
         print('Variables:')
@@ -0,0 +1,185 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+Binary sidecar cache of a parsed project
+
+xy-stitch, xy-pto, xy-ts, xy-outlier, xy-cp... each re-read and re-tokenize the same .pto
+For a big scan that is mostly half a million c lines through a regex
+Instead the parsed project is also written next to the .pto as <file>.pto.npz:
+-Control points: the ControlPointArray structured array as is
+-Image lines: one column per variable (int, float or string) + which keys each line has
+-Everything else (p, m, v, comments...) is small and kept as text
+Keyed by real path + size + mtime so an edited (or rewritten) .pto is never served stale
+Only written for projects big enough to matter, see config.pto_cache_min()
+'''
+
+from .cp_array import ControlPointArray, CP_DTYPE
+
+import numpy as np
+import os
+
+VERSION = 1
+# Column kinds
+KIND_INT = 'i'
+KIND_FLOAT = 'f'
+KIND_STR = 's'
+KIND_KEY = 'k'
+
+
+def cache_fn(file_name):
+    return file_name + '.npz'
+
+
+def stat_key(file_name):
+    real_fn = os.path.realpath(file_name)
+    st = os.stat(real_fn)
+    return (real_fn, st.st_size, st.st_mtime_ns)
+
+
+def column_kind(values):
+    '''Column kind so values round trip exactly, None if they can't'''
+    types = set(type(v) for v in values)
+    if types == set([int]):
+        return KIND_INT
+    if types == set([float]):
+        return KIND_FLOAT
+    if types == set([str]):
+        return KIND_STR
+    if types == set([type(None)]):
+        return KIND_KEY
+    return None
+
+
+def pack_image_lines(image_lines):
+    '''Return dict of arrays or None if some line won't round trip'''
+    sigs = {}
+    line_sigs = []
+    columns = {}
+    for i, il in enumerate(image_lines):
+        if il.comments:
+            return None
+        sig = tuple(il.variables.keys())
+        line_sigs.append(sigs.setdefault(sig, len(sigs)))
+        for k, v in il.variables.items():
+            columns.setdefault(k, ([], []))
+            columns[k][0].append(i)
+            columns[k][1].append(v)
+
+    ret = {
+        'il_sig': np.array(line_sigs, dtype=np.int32),
+        # Keys of each signature joined by spaces, in dict order
+        'il_sigs': np.array([' '.join(sig) for sig in sigs], dtype=str),
+    }
+    keys = []
+    kinds = []
+    for k, (rows, values) in columns.items():
+        kind = column_kind(values)
+        if kind is None or ' ' in k:
+            return None
+        keys.append(k)
+        kinds.append(kind)
+        ret['il_rows_' + k] = np.array(rows, dtype=np.int32)
+        if kind == KIND_INT:
+            ret['il_val_' + k] = np.array(values, dtype=np.int64)
+        elif kind == KIND_FLOAT:
+            ret['il_val_' + k] = np.array(values, dtype=np.float64)
+        elif kind == KIND_STR:
+            ret['il_val_' + k] = np.array(values, dtype=str)
+    ret['il_keys'] = np.array(keys, dtype=str)
+    ret['il_kinds'] = np.array(kinds, dtype=str)
+    return ret
+
+
+def unpack_image_lines(data, project):
+    from .image_line import ImageLine
+
+    sigs = [str(s).split() for s in data['il_sigs'].tolist()]
+    il_sig = data['il_sig'].tolist()
+    variables = [dict.fromkeys(sigs[sig]) for sig in il_sig]
+    for k, kind in zip(data['il_keys'].tolist(), data['il_kinds'].tolist()):
+        if kind == KIND_KEY:
+            continue
+        for i, v in zip(data['il_rows_' + k].tolist(),
+                        data['il_val_' + k].tolist()):
+            variables[i][k] = v
+    return [ImageLine(None, project, variables=v) for v in variables]
+
+
+def save(project, file_name, key):
+    '''
+    Write the cache for project as parsed from / saved to file_name
+    key: stat_key() from before the text was read / after it was written
+    '''
+    arrays = pack_image_lines(project.image_lines)
+    if arrays is None:
+        return False
+    # Don't repack the project itself, caller may hold ControlPointLine objects
+    cpa = project._cp_array
+    if cpa is None:
+        cpa = ControlPointArray.from_lines(project._control_point_lines or [])
+        if cpa is None:
+            return False
+
+    def texts(lines):
+        return [str(l) for l in lines]
+
+    other = {
+        'p': texts([project.panorama_line] if project.panorama_line else []),
+        'm': texts([project.mode_line] if project.mode_line else []),
+        'v': texts(project.variable_lines),
+        'o': texts(project.optimizer_lines),
+        'C': texts(project.absolute_control_point_lines),
+        '#': list(project.comment_lines),
+    }
+    for k, lines in other.items():
+        arrays['text_' + k] = np.array(lines, dtype=str)
+    arrays['version'] = np.array([VERSION])
+    arrays['key'] = np.array([key[0], str(key[1]), str(key[2])], dtype=str)
+    arrays['cps'] = cpa.arr
+
+    fn = cache_fn(file_name)
+    tmp_fn = '%s.%d.tmp.npz' % (fn, os.getpid())
+    try:
+        np.savez(tmp_fn, **arrays)
+        os.rename(tmp_fn, fn)
+    except OSError as e:
+        # Read only dir or similar, just don't cache
+        print('WARNING: failed to write project cache %s: %s' % (fn, e))
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        return False
+    return True
+
+
+def load(project, file_name):
+    '''Fill in parsed project from the cache, False if there isn't a fresh one'''
+    fn = cache_fn(file_name)
+    if not os.path.exists(fn):
+        return False
+    key = stat_key(file_name)
+    try:
+        with np.load(fn, allow_pickle=False) as data:
+            if int(data['version'][0]) != VERSION or tuple(
+                    data['key'].tolist()) != (key[0], str(key[1]), str(
+                        key[2])):
+                return False
+            if data['cps'].dtype != CP_DTYPE:
+                return False
+            image_lines = unpack_image_lines(data, project)
+            texts = []
+            for k in 'pmvoC#':
+                texts += data['text_' + k].tolist()
+            cpa = ControlPointArray(data['cps'])
+    except (OSError, KeyError, ValueError) as e:
+        print('WARNING: bad project cache %s: %s' % (fn, e))
+        return False
+    project.image_lines = image_lines
+    for line in texts:
+        project.parse_line(str(line))
+    # Non-columnar projects get ControlPointLines on first use of control_point_lines
+    # so tools that don't touch control points never build them
+    project.set_cp_array(cpa)
+    return True
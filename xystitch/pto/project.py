@@ -30,10 +30,43 @@ from .optimizer_line import OptimizerLine
 from .util import dbg, calc_il_dim
 from xystitch.temp_file import ManagedTempFile
 from xystitch.execute import Execute
+from xystitch.config import config
 
 import os
 import shutil
-import copy
+
+
+class ImageLineList(list):
+    '''
+    PTOProject.image_lines
+    Editing it in place (swap, sort, insert...) drops the project's image index
+    so image_index() never hands out positions that moved
+    '''
+    def __init__(self, project, ils=()):
+        list.__init__(self, ils)
+        self.project = project
+
+
+def _reindexing(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        ret = method(self, *args, **kwargs)
+        # Unpickling fills the list in before project is set
+        project = getattr(self, 'project', None)
+        if project is not None:
+            project.reindex_images()
+        return ret
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in ('__setitem__', '__delitem__', '__iadd__', 'append', 'extend',
+              'insert', 'pop', 'remove', 'sort', 'reverse', 'clear'):
+    setattr(ImageLineList, _name, _reindexing(_name))
+
+
 '''
 class ControlPointLineImage:
     image = None
@@ -127,7 +160,10 @@ Example file
 
 
 class PTOProject:
-    def __init__(self):
+    def __init__(self, columnar=False):
+        # Store canonical control points as a ControlPointArray (needs numpy)
+        # See get_cp_array()
+        self.columnar = columnar
         # File name, if one exists
         self.file_name = None
         # If this is a temporary project, have it delete upon destruction
@@ -146,11 +182,11 @@ class PTOProject:
         # Raw strings
         self.comment_lines = None
         # c N1 X1225.863118 Y967.737131 n0 t0 x1444.778035 y233.74261
+        # Also clears the columnar form
         self.control_point_lines = None
         self.absolute_control_point_lines = None
+        # Also drops the image index, see image_index()
         self.image_lines = None
-        self.img_fn2il = None
-        self.il2i = None
         self.optimizer_lines = None
         '''
         I bet lone v lines can be omitted
@@ -164,9 +200,124 @@ class PTOProject:
         self.variable_lines = None
         # Raw strings, we don't know what these are
         self.misc_lines = list()
+        # Raw c lines while parsing columnar
+        self.cp_texts = None
         # Has this been loaded from the file?
         self.parsed = False
 
+    @property
+    def image_lines(self):
+        return self._image_lines
+
+    @image_lines.setter
+    def image_lines(self, ils):
+        if ils is not None:
+            ils = ImageLineList(self, ils)
+        self._image_lines = ils
+        self.reindex_images()
+
+    def reindex_images(self):
+        '''Drop the image index so the next lookup rebuilds it (see ImageLineList)'''
+        self._il2i = None
+        self._fn2i = None
+        self._fn2il = None
+        self._fn_dups = False
+
+    def image_index(self):
+        '''
+        Return (image line => index, file name => index, file name => image line)
+        Built once then kept in sync by add_image_line() and ImageLine.set_name()
+        Any other edit to image_lines drops it (ImageLineList)
+        With duplicate file names the first image wins
+        '''
+        ils = self.get_image_lines() or []
+        if self._il2i is None:
+            self._il2i = {}
+            self._fn2i = {}
+            self._fn2il = {}
+            for i, il in enumerate(ils):
+                self._il2i[il] = i
+                fn = il.get_name()
+                if fn in self._fn2i:
+                    self._fn_dups = True
+                else:
+                    self._fn2i[fn] = i
+                    self._fn2il[fn] = il
+        return self._il2i, self._fn2i, self._fn2il
+
+    @property
+    def il2i(self):
+        '''Image line => index'''
+        return self.image_index()[0]
+
+    @property
+    def img_fn2il(self):
+        '''Image file name => image line'''
+        return self.image_index()[2]
+
+    def image_renamed(self, il, old_fn):
+        '''Keep the index in sync after il's file name changed from old_fn'''
+        if self._il2i is None or il not in self._il2i:
+            return
+        new_fn = il.get_name()
+        if self._fn_dups or new_fn in self._fn2i:
+            self.reindex_images()
+            return
+        i = self._il2i[il]
+        if self._fn2i.get(old_fn) == i:
+            del self._fn2i[old_fn]
+            del self._fn2il[old_fn]
+        self._fn2i[new_fn] = i
+        self._fn2il[new_fn] = il
+
+    @property
+    def control_point_lines(self):
+        if self._cp_array is not None:
+            # Caller may edit the objects so they become the only copy
+            self._control_point_lines = self._cp_array.to_lines(self)
+            self._cp_array = None
+        return self._control_point_lines
+
+    @control_point_lines.setter
+    def control_point_lines(self, cpls):
+        self._control_point_lines = cpls
+        self._cp_array = None
+
+    def get_cp_array(self):
+        '''
+        Return control points as a ControlPointArray, packing them if needed
+        None if some control point isn't in the canonical form
+        Any previously returned ControlPointLine objects are detached from the project
+        '''
+        self.parse()
+        if self._cp_array is None:
+            # numpy is only needed for columnar projects
+            from .cp_array import ControlPointArray
+            cpa = ControlPointArray.from_lines(self._control_point_lines
+                                               or [])
+            if cpa is None:
+                return None
+            self.set_cp_array(cpa)
+        return self._cp_array
+
+    def columnar_cps(self):
+        '''ControlPointArray if this is a columnar project, otherwise None'''
+        if not self.columnar:
+            return None
+        return self.get_cp_array()
+
+    def set_cp_array(self, cpa):
+        '''Replace all control points'''
+        self._control_point_lines = None
+        self._cp_array = cpa
+
+    def ncontrol_points(self):
+        '''Number of control points without materializing them'''
+        self.parse()
+        if self._cp_array is not None:
+            return len(self._cp_array)
+        return len(self._control_point_lines)
+
     def remove_file_name(self):
         '''Unbound this from the filesystem'''
         self.ensure_text_loaded()
@@ -174,7 +325,7 @@ class PTOProject:
 
     def update_lines_project(self):
         # Update project references on sub-objects
-        for l in self.control_point_lines:
+        for l in self._control_point_lines or []:
             l.project = self
         for l in self.image_lines:
             l.project = self
@@ -184,26 +335,42 @@ class PTOProject:
             self.mode_line.project = self
 
     def copy(self, control_points=True):
-        '''Return an unsaved but identical project'''
-        # slow
-        #return PTOProject.from_text(self.get_text())
-        # maybe...not sure about this
-        cp_tmp = self.control_point_lines
-        cp_tmp_abs = self.absolute_control_point_lines
-        if not control_points:
-            self.control_point_lines = []
-            self.absolute_control_point_lines = []
-        ret = copy.deepcopy(self)
+        '''
+        Return an unsaved but identical project
+        Structurally shared: lines are copy on write (see Line.cow_copy())
+        and the columnar control points are never modified in place so they are shared as is
+        '''
+        ret = PTOProject.__new__(PTOProject)
+        ret.__dict__.update(self.__dict__)
         ret.file_name = None
         ret.temp_file = None
-        #return self.to_str_core(False)
-        if not control_points:
-            self.control_point_lines = cp_tmp
-            self.absolute_control_point_lines = cp_tmp_abs
+        # Index points at our lines
+        ret.reindex_images()
+        if not self.parsed:
+            ret.text = self.get_text()
+            return ret
 
-        # does deepcopy update references?
-        ret.update_lines_project()
+        def cow_lines(lines):
+            if lines is None:
+                return None
+            return [l.cow_copy(ret) for l in lines]
 
+        if self.panorama_line:
+            ret.panorama_line = self.panorama_line.cow_copy(ret)
+        if self.mode_line:
+            ret.mode_line = self.mode_line.cow_copy(ret)
+        ret.comment_lines = list(self.comment_lines or [])
+        ret.misc_lines = list(self.misc_lines)
+        ret.image_lines = cow_lines(self.image_lines)
+        ret.variable_lines = cow_lines(self.variable_lines)
+        ret.optimizer_lines = cow_lines(self.optimizer_lines)
+        if control_points:
+            ret._control_point_lines = cow_lines(self._control_point_lines)
+            ret.absolute_control_point_lines = cow_lines(
+                self.absolute_control_point_lines)
+        else:
+            ret.control_point_lines = []
+            ret.absolute_control_point_lines = []
         return ret
 
     def i2img(self, index):
@@ -219,17 +386,11 @@ class PTOProject:
 
     def img_fn2i(self, fn):
         '''Given image file name return image index'''
-        for i, il in enumerate(self.get_image_lines()):
-            if fn == il.get_name():
-                return i
-        return None
+        return self.image_index()[1].get(fn)
 
     def img_fn2l(self, fn):
         '''Given image file name return image line'''
-        for il in self.get_image_lines():
-            if fn == il.get_name():
-                return il
-        return None
+        return self.img_fn2il.get(fn)
 
     def assert_uniform_images(self):
         '''All images have same width and height'''
@@ -254,25 +415,15 @@ class PTOProject:
         return self.get_image_lines()[n]
 
     def build_image_fn_map(self):
-        self.img_fn2il = {}
-        for il in self.get_image_lines():
-            self.img_fn2il[il.get_name()] = il
+        '''Kept for old callers, the index is always maintained now'''
         return self.img_fn2il
 
     def build_il2i(self):
-        self.il2i = {}
-        for i, il in enumerate(self.image_lines):
-            self.il2i[il] = i
+        '''Kept for old callers, the index is always maintained now'''
         return self.il2i
 
     def get_image_by_fn(self, fn):
-        if self.img_fn2il:
-            return self.img_fn2il.get(fn, None)
-
-        for i in self.get_image_lines():
-            if fn == i.get_name():
-                return i
-        return None
+        return self.img_fn2il.get(fn, None)
 
     def add_image(self, image_fn, calc_dim=True, def_opt=False):
         self.parse()
@@ -287,41 +438,34 @@ class PTOProject:
             # x/y position not yet calculated
             il.set_variable('d', 0)
             il.set_variable('e', 0)
-        self.image_lines.append(il)
+        self.add_image_line(il)
 
     def del_images(self, ils):
         '''Delete image as well as coresponding control point lines'''
         # added to support image sub-projects for fast preview
 
-        ils_i = [il.get_index() for il in ils]
+        ils_i = set(il.get_index() for il in ils)
         new_image_lines = []
+        # Map of old image index to new
+        ii_old2new = {}
         for i, il in enumerate(self.image_lines):
             if not i in ils_i:
+                ii_old2new[i] = len(new_image_lines)
                 new_image_lines.append(il)
 
-        # Build a map of old image index to new
-        img_fn2ii_old = {}
-        for i, il in enumerate(self.image_lines):
-            img_fn2ii_old[il.get_name()] = i
-        img_fn2ii_new = {}
-        for i, il in enumerate(new_image_lines):
-            img_fn2ii_new[il.get_name()] = i
-        ii_old2new = {}
-        for fn, ii_new in img_fn2ii_new.items():
-            try:
-                ii_old2new[img_fn2ii_old[fn]] = ii_new
-            except:
-                print('ERROR')
-                print(fn)
-                print(img_fn2ii_old)
-                print(img_fn2ii_new)
-                print(ii_old2new)
-                raise
-
         # remove unneeded control points
         # and replace image indices
+        if self._cp_array is not None:
+            import numpy as np
+            old2new = np.full(len(self.image_lines), -1, dtype=np.int32)
+            for ii_old, ii_new in ii_old2new.items():
+                old2new[ii_old] = ii_new
+            self._cp_array = self._cp_array.remap_images(old2new)
+            cpls_old = []
+        else:
+            cpls_old = self.control_point_lines
         new_control_point_lines = []
-        for cpl in self.control_point_lines:
+        for cpl in cpls_old:
             n = cpl.getv('n')
             N = cpl.getv('N')
             if n not in ils_i and N not in ils_i:
@@ -331,18 +475,16 @@ class PTOProject:
                 # and add to the keep set
                 new_control_point_lines.append(cpl)
         # shift in new control point set
-        self.control_point_lines = new_control_point_lines
+        if self._cp_array is None:
+            self.control_point_lines = new_control_point_lines
 
         # FIXME: hack since I don't need variables for intended purpose of this function
         # variable lines are messy since technically you might have to split it
         self.variable_lines = []
 
-        # shift in new image line set
+        # shift in new image line set (rebuilds the index)
         self.image_lines = new_image_lines
 
-        # Invalidate the index cache, if any
-        self.img_fn2il = None
-
     def get_image_lines(self):
         self.parse()
         return self.image_lines
@@ -380,7 +522,18 @@ class PTOProject:
         self.parse()
         if self.image_lines is None:
             self.image_lines = []
-        self.image_lines.append(il)
+        if self._il2i is not None and len(self._il2i) == len(
+                self.image_lines):
+            i = len(self.image_lines)
+            self._il2i[il] = i
+            fn = il.get_name()
+            if fn in self._fn2i:
+                self._fn_dups = True
+            else:
+                self._fn2i[fn] = i
+                self._fn2il[fn] = il
+        # Index is already updated, don't drop it
+        list.append(self.image_lines, il)
 
     def add_image_line_by_text(self, il_text):
         il = ImageLine(il_text, self)
@@ -400,8 +553,8 @@ class PTOProject:
         return self.variable_lines
 
     @staticmethod
-    def from_file_name(file_name, is_temporary=False):
-        ret = PTOProject()
+    def from_file_name(file_name, is_temporary=False, columnar=False):
+        ret = PTOProject(columnar=columnar)
         ret.file_name = file_name
         if is_temporary:
             ret.temp_file = ManagedTempFile.from_existing(file_name)
@@ -417,10 +570,10 @@ class PTOProject:
         return ret
 
     @staticmethod
-    def from_text(text):
+    def from_text(text, columnar=False):
         if text is None:
             raise Exception('Require text')
-        ret = PTOProject()
+        ret = PTOProject(columnar=columnar)
         ret.text = text
         ret.reparse()
         return ret
@@ -454,9 +607,10 @@ m g1.0 i0 f0 m2
         '''Parse if not already parsed'''
         if not self.parsed:
             self.reparse()
-        # We should now be using the intermediate form
-        # Force a regen if someone wants text
-        self.text = None
+            # We should now be using the intermediate form
+            # Force a regen if someone wants text
+            # Only here: set_text() sets text while still parsed and saving may parse() again
+            self.text = None
 
     def reparse(self):
         '''Force a parse'''
@@ -476,13 +630,25 @@ m g1.0 i0 f0 m2
         self.misc_lines = list()
         self.optimizer_lines = list()
 
+        cache_key = None
         if self.text is None:
+            if self.use_parse_cache():
+                from . import parse_cache
+                if parse_cache.load(self, self.file_name):
+                    self.parsed = True
+                    return
+                # Before reading so a concurrent rewrite can't be cached as this text
+                cache_key = parse_cache.stat_key(self.file_name)
             self.text = open(self.file_name).read()
 
+        # Raw c lines, packed at the end
+        self.cp_texts = None
+        if self.columnar:
+            self.cp_texts = []
+
         #print self.text
         dbg('Beginning split on text of len %d' % (len(self.text)))
         for line in self.text.split('\n'):
-            dbg('Processing line: %s' % line)
             # Single * is end of file
             # Any comments / garbage is allowed to follow
             #if line.strip() == '*':
@@ -490,10 +656,38 @@ m g1.0 i0 f0 m2
             # In practice this is PTOptimizer output I want
             # Add an option later if needed to override
             self.parse_line(line)
-            dbg()
+
+        if self.cp_texts is not None:
+            from .cp_array import ControlPointArray
+            cpa = ControlPointArray.from_texts(self.cp_texts)
+            if cpa is None:
+                print('WARNING: non-canonical control points, not columnar')
+                for line in self.cp_texts:
+                    self._control_point_lines.append(
+                        ControlPointLine(line, self))
+            else:
+                self.set_cp_array(cpa)
+            self.cp_texts = None
 
         #print 'Finished reparse'
         self.parsed = True
+        if cache_key:
+            self.save_parse_cache(self.file_name, cache_key)
+
+    def use_parse_cache(self):
+        '''Temporary projects are read once, don't bother'''
+        return self.file_name is not None and not self.temp_file and config.pto_cache_min(
+        ) > 0
+
+    def save_parse_cache(self, file_name, cache_key=None):
+        '''See parse_cache, only worth it for big projects'''
+        if len(self.image_lines) + self.ncontrol_points(
+        ) < config.pto_cache_min():
+            return
+        from . import parse_cache
+        if cache_key is None:
+            cache_key = parse_cache.stat_key(file_name)
+        parse_cache.save(self, file_name, cache_key)
 
     def parse_line(self, line):
         # Ignore empty lines
@@ -524,7 +718,10 @@ m g1.0 i0 f0 m2
             self.variable_lines.append(VariableLine(line, self))
         # Control point line
         elif k == "c":
-            self.control_point_lines.append(ControlPointLine(line, self))
+            if self.cp_texts is not None:
+                self.cp_texts.append(line)
+            else:
+                self._control_point_lines.append(ControlPointLine(line, self))
         elif k == 'C':
             self.absolute_control_point_lines.append(
                 AbsoluteControlPointLine(line, self))
@@ -546,10 +743,15 @@ m g1.0 i0 f0 m2
         self.regen_pto()
 
     def to_str_core(self, ptoptimizer_form):
-        self.build_il2i()
+        return ''.join(self.iter_text(ptoptimizer_form))
 
-        text = ''
-        text += '# Generated by xystitch\n'
+    def write(self, f, ptoptimizer_form=False):
+        '''Stream the project text to file object f without building it in memory'''
+        f.writelines(self.iter_text(ptoptimizer_form))
+
+    def iter_text(self, ptoptimizer_form=False):
+        '''Yield the project text a line (or so) at a time, see to_str_core() / write()'''
+        yield '# Generated by xystitch\n'
 
         #print 'Pano line: %s' % self.panorama_line
 
@@ -561,33 +763,34 @@ m g1.0 i0 f0 m2
             key_blacklist = 'E R S'.split()
 
         if self.panorama_line:
-            text += self.panorama_line.regen(key_blacklist)
+            yield self.panorama_line.regen(key_blacklist)
         if self.mode_line:
-            text += self.mode_line.regen()
+            yield self.mode_line.regen()
 
+        key_blacklist = None
+        if ptoptimizer_form:
+            key_blacklist = 'Eb Eev Er Ra Rb Rc Rd Re Va Vb Vc Vd Vx Vy'.split(
+            )
         for line in self.image_lines:
-            key_blacklist = None
-            if ptoptimizer_form:
-                key_blacklist = 'Eb Eev Er Ra Rb Rc Rd Re Va Vb Vc Vd Vx Vy'.split(
-                )
-            text += line.regen(key_blacklist)
+            yield line.regen(key_blacklist)
 
         for line in self.variable_lines:
-            text += line.regen()
+            yield line.regen()
 
-        print("save cpls", len(self.control_point_lines))
-        for line in self.control_point_lines:
-            text += line.regen()
+        print("save cpls", self.ncontrol_points())
+        if self._cp_array is not None:
+            for line in self._cp_array.iter_text():
+                yield line
+        else:
+            for line in self.control_point_lines:
+                yield line.regen()
 
         for line in self.absolute_control_point_lines:
-            text += line.regen()
+            yield line.regen()
 
         for line in self.comment_lines:
-            #text += line.regen()
-            text += line + '\n'
-
-        self.il2i = None
-        return text
+            #yield line.regen()
+            yield line + '\n'
 
     def __str__(self):
         # Might make this diff from get_text to show parser info at some point
@@ -664,6 +867,48 @@ m g1.0 i0 f0 m2
         shutil.move(temp.file_name, self.file_name)
         self.reopen()
 
+    def merge_native(self, ptos):
+        '''
+        In memory merge of ptos into this project
+        Images are matched by file name (new ones appended) and control points remapped onto them
+        Unlike merge_into() nothing is saved, no pto_merge and no reparse
+        Only image and control point lines are taken from ptos
+        '''
+        self.parse()
+        cpls = []
+        for pto in ptos:
+            # This project's index for each of pto's images
+            remap = []
+            for il in pto.get_image_lines():
+                i = self.img_fn2i(il.get_name())
+                if i is None:
+                    i = len(self.image_lines)
+                    self.add_image_line(ImageLine(str(il), self))
+                remap.append(i)
+
+            cpa = pto.columnar_cps()
+            src = cpa.rows() if cpa is not None else pto.get_control_point_lines()
+            for cpl in src:
+                variables = dict(cpl.variables)
+                variables['n'] = remap[variables['n']]
+                variables['N'] = remap[variables['N']]
+                cpls.append(ControlPointLine(project=self, variables=variables))
+        print('merge_native: %d projects, %d images, +%d control points' %
+              (len(ptos), len(self.image_lines), len(cpls)))
+
+        if self._cp_array is not None:
+            # Keep columnar projects columnar
+            from .cp_array import ControlPointArray
+            new = ControlPointArray.from_lines(cpls)
+            if new is not None:
+                import numpy as np
+                self.set_cp_array(
+                    ControlPointArray(
+                        np.concatenate((self._cp_array.arr, new.arr))))
+                return
+        for cpl in cpls:
+            self.add_control_point_line(cpl)
+
     def merge(self, ptos):
         '''Return a project containing both control points'''
         '''
@@ -715,8 +960,13 @@ m g1.0 i0 f0 m2
     def save_as(self, file_name, is_new_filename=False):
         print("get text", self.parsed)
         with open(file_name + '.tmp', 'w') as f:
-            f.write(self.get_text())
+            if self.parsed:
+                self.write(f)
+            else:
+                f.write(self.get_text())
         shutil.move(file_name + '.tmp', file_name)
+        if self.parsed and self.use_parse_cache():
+            self.save_parse_cache(file_name)
         if is_new_filename:
             self.file_name = file_name
 
@@ -0,0 +1,77 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+Read only project snapshot for the tiler workers
+
+Each supertile used to copy the whole project and then have rm_red_img() walk every image
+That is O(images) python objects per supertile, in every worker
+Instead the master packs what the workers need once:
+-a spatial index of image bounds (see ImageIndex)
+-image line text as a single bytes blob + offsets
+-p, m and comment lines as text
+Workers are forked after this is built so the buffers are shared copy on write
+Nothing writes to them so the pages stay shared
+
+sub_project() then emits a cropped project containing only the kept images
+Selection is the same as rm_red_img()
+'''
+
+from .project import PTOProject
+from .util import ImageIndex
+
+import numpy as np
+
+
+class ProjectSnapshot(object):
+    def __init__(self, pto):
+        pto.parse()
+        pl = pto.get_panorama_line()
+        # Crop is set per supertile
+        self.header = pl.regen(['S'])
+        if pto.mode_line:
+            self.header += pto.mode_line.regen()
+        self.footer = ''.join(
+            [line + '\n' for line in pto.get_comment_lines()])
+
+        # Which images matter to a given supertile
+        self.index = ImageIndex(pto)
+
+        ils = pto.get_image_lines()
+        texts = [il.regen().encode('utf-8') for il in ils]
+        self.il_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in texts], out=self.il_offsets[1:])
+        self.il_blob = b''.join(texts)
+
+    def nimages(self):
+        return self.index.nimages()
+
+    def il_text(self, i):
+        start, end = self.il_offsets[i], self.il_offsets[i + 1]
+        return self.il_blob[start:end].decode('utf-8')
+
+    def select(self, crop):
+        '''Indices of the images that matter to crop, see rm_red_img()'''
+        return self.index.select(crop)
+
+    def images_project(self, keep, crop=None):
+        '''Return a new PTOProject with only images keep, cropped to crop if given'''
+        text = self.header + ''.join(
+            [self.il_text(i) for i in keep]) + self.footer
+        pto = PTOProject.from_text(text)
+        if crop is not None:
+            pto.get_panorama_line().set_crop(crop)
+        return pto
+
+    def sub_project(self, crop):
+        '''Return a new PTOProject cropped to crop with redundant images removed'''
+        keep = self.select(crop)
+        print('Removing %d / %d images' %
+              (self.nimages() - len(keep), self.nimages()))
+        if len(keep) == 0:
+            raise Exception("Removed all images.  remapper will fail")
+        pto = self.images_project(keep, crop)
+        print('Remaining: %u' % len(pto.image_lines))
+        return pto
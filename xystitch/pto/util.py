@@ -22,6 +22,7 @@ from xystitch.image_coordinate_map import ImageCoordinateMap
 import os
 from xystitch.pimage import PImage
 from xystitch.config import config
+from xystitch.geometry import PolygonQuadTree, PolygonQuadTreeItem
 
 debugging = 0
 
@@ -439,6 +440,9 @@ def fixup_image_dim(pto):
 
 def img_cpls(pto, img_i):
     '''Return control point lines for given image file name'''
+    cpa = pto.columnar_cps()
+    if cpa is not None:
+        return cpa.rows_where(cpa.image_mask(img_i))
     cpls = []
     for cpl in pto.control_point_lines:
         n = cpl.getv('n')
@@ -448,88 +452,113 @@ def img_cpls(pto, img_i):
     return cpls
 
 
-def rm_red_img(pto):
-    '''Remove redundant images given crop selection'''
-    # see coordinate warnings at top
-    print('Removing redundant images')
-    pl = pto.panorama_line
-    (c_left_, c_right_, c_top_, c_bottom_) = pl.get_crop_ez()
-    # translate crop coordinates into image coordinates
-    # p f0 w2673 h2056 v76  E0 R0 S322,1612,351,1890 n"TIFF_m c:LZW"
-    canvas_w = pl.width2()
-    canvas_h = pl.height2()
-    # say 100 w
-    # 0 => 50
-    # 50 => 0
-    # 100 => -50
-    c_left = canvas_w / 2 - c_left_
-    c_right = canvas_w / 2 - c_right_
-    c_top = canvas_h / 2 - c_top_
-    c_bottom = canvas_h / 2 - c_bottom_
-    print(('Canvas: %dw X %dh' % (canvas_w, canvas_h)))
-    print(('Crop [%s, %s, %s, %s] => [%s, %s, %s, %s]' %
-           (c_left_, c_right_, c_top_, c_bottom_, c_left, c_right, c_top,
-            c_bottom)))
-
-    to_rm = []
-    for il in pto.image_lines:
-        #im_left = il.right()
-        #im_right = il.left()
-        #im_top = il.bottom()
-        #im_bottom = il.top()
-        r = il.rotation()
-        rr = r * 3.14159 / 180
-
-        x = il.x()
-        y = il.y()
-        # rotate x/y rr radians
-        xp = x * math.cos(rr) - y * math.sin(rr)
-        yp = x * math.sin(rr) + y * math.cos(rr)
-
-        im_left = xp - il.width() / 2.0
-        im_right = xp + il.width() / 2.0
-        if im_left < im_right:
-            (im_left, im_right) = (im_right, im_left)
-        im_top = yp - il.height() / 2.0
-        im_bottom = yp + il.height() / 2.0
-        if im_top < im_bottom:
-            (im_top, im_bottom) = (im_bottom, im_top)
-
+class ImageIndex(object):
+    '''
+    Spatial index of image bounds for finding the images that matter to a crop region
+    Build once per project and query per crop (ex: per supertile)
+    '''
+    def __init__(self, pto):
+        # see coordinate warnings at top
+        pl = pto.panorama_line
+        self.canvas_w = pl.width2()
+        self.canvas_h = pl.height2()
         # try simple heuristic first
         # seems to mostly care when they aren't really overlapping at all
         # should have at least 30% overlap, maybe as low as 20% if severe errors
         # filter out anything that doesn't have at least 15% overlap into this supertile
-        # this means that an image n
         overlap_thresh = config.overlap_threshold()
-        il_w = il.width()
-        il_h = il.height()
-        if 0:
-            print('check %s [%s, %s, %s, %s]' %
-                  (il.get_name(), im_left, im_right, im_top, im_bottom))
-            print('  x %0.1f => %0.1f' % (x, xp))
-            print('  y %0.1f => %0.1f' % (y, yp))
-            print('  %s < %s' % (c_left - im_right, il_w * overlap_thresh))
-            print('  %s < %s' % (im_left - c_right, il_w * overlap_thresh))
-            print('  %s < %s' % (c_top - im_bottom, il_h * overlap_thresh))
-            print('  %s < %s' % (im_top - c_bottom, il_h * overlap_thresh))
-        if (c_left - im_right < il_w * overlap_thresh
-                or im_left - c_right < il_w * overlap_thresh
-                or c_top - im_bottom < il_h * overlap_thresh
-                or im_top - c_bottom < il_h * overlap_thresh):
-            #print 'Removing %s' % il
-            if 0:
-                print('rm %s [%s, %s, %s, %s]' %
-                      (il.get_name(), im_left, im_right, im_top, im_bottom))
-            to_rm.append(il)
+
+        # (im_left, im_right, im_top, im_bottom, thresh_w, thresh_h)
+        # in centered image coordinates, left >= right and top >= bottom
+        self.bounds = []
+        items = []
+        for i, il in enumerate(pto.image_lines):
+            r = il.rotation()
+            rr = r * 3.14159 / 180
+
+            x = il.x()
+            y = il.y()
+            # rotate x/y rr radians
+            xp = x * math.cos(rr) - y * math.sin(rr)
+            yp = x * math.sin(rr) + y * math.cos(rr)
+
+            im_left = xp - il.width() / 2.0
+            im_right = xp + il.width() / 2.0
+            if im_left < im_right:
+                (im_left, im_right) = (im_right, im_left)
+            im_top = yp - il.height() / 2.0
+            im_bottom = yp + il.height() / 2.0
+            if im_top < im_bottom:
+                (im_top, im_bottom) = (im_bottom, im_top)
+            thresh_w = il.width() * overlap_thresh
+            thresh_h = il.height() * overlap_thresh
+            self.bounds.append(
+                (im_left, im_right, im_top, im_bottom, thresh_w, thresh_h))
+
+            # Region a crop must touch for the image to be kept, in crop coordinates
+            # Pad a pixel so rounding can't drop a candidate, select() does the exact check
+            xs = (self.canvas_w / 2 - im_left + thresh_w,
+                  self.canvas_w / 2 - im_right - thresh_w)
+            ys = (self.canvas_h / 2 - im_top + thresh_h,
+                  self.canvas_h / 2 - im_bottom - thresh_h)
+            items.append(
+                PolygonQuadTreeItem(min(xs) - 1,
+                                    max(xs) + 1,
+                                    min(ys) - 1,
+                                    max(ys) + 1,
+                                    data=i))
+        self.tree = PolygonQuadTree(items)
+
+    def nimages(self):
+        return len(self.bounds)
+
+    def keep(self, i, crop):
+        '''True if image i overlaps crop (left, right, top, bottom) enough to be kept'''
+        (c_left_, c_right_, c_top_, c_bottom_) = crop
+        # translate crop coordinates into image coordinates
+        # say 100 w
+        # 0 => 50
+        # 50 => 0
+        # 100 => -50
+        c_left = self.canvas_w / 2 - c_left_
+        c_right = self.canvas_w / 2 - c_right_
+        c_top = self.canvas_h / 2 - c_top_
+        c_bottom = self.canvas_h / 2 - c_bottom_
+        (im_left, im_right, im_top, im_bottom, thresh_w,
+         thresh_h) = self.bounds[i]
+        return not (c_left - im_right < thresh_w or im_left - c_right < thresh_w
+                    or c_top - im_bottom < thresh_h
+                    or im_top - c_bottom < thresh_h)
+
+    def select(self, crop):
+        '''Sorted indices of images to keep for crop (left, right, top, bottom)'''
+        hits = self.tree.hit_bounds(crop)
+        return sorted(item.data for item in hits if self.keep(item.data, crop))
+
+
+def rm_red_img(pto, index=None):
+    '''
+    Remove redundant images given crop selection
+    index: ImageIndex for pto, built if not given
+    '''
+    print('Removing redundant images')
+    if index is None:
+        index = ImageIndex(pto)
+    crop = pto.panorama_line.get_crop_ez()
+    print(('Canvas: %dw X %dh, crop [%s, %s, %s, %s]' %
+           (index.canvas_w, index.canvas_h, crop[0], crop[1], crop[2],
+            crop[3])))
+
+    keep = set(index.select(crop))
+    to_rm = [
+        il for i, il in enumerate(pto.image_lines) if i not in keep
+    ]
 
     print('Removing %d / %d images' % (len(to_rm), len(pto.image_lines)))
     if len(to_rm) == len(pto.image_lines):
         raise Exception("Removed all images.  remapper will fail")
     pto.del_images(to_rm)
     print('Remaining: %u' % len(pto.image_lines))
-    for il in pto.image_lines:
-        print('  %s w/ [%s, %s, %s, %s]' %
-              (il.get_name(), il.left(), il.right(), il.top(), il.bottom()))
 
 
 def iter_raw_image_positions(pto):
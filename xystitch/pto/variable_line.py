@@ -16,6 +16,12 @@ class VariableLine(Line):
         self.image = None
         Line.__init__(self, text, project)
 
+    def cow_copy(self, project):
+        ret = Line.cow_copy(self, project)
+        # Image line of the other project
+        ret.image = None
+        return ret
+
     def prefix(self):
         return 'v'
 
@@ -0,0 +1,160 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+Zoom pyramid built while tiling
+
+Viewers want coarser levels on top of the base tiles in out/
+Building them afterwards means reading every base tile back in
+Instead each tile is shrunk 2x into its parent as soon as it's cut:
+level k tile (row, col) is made of level k - 1 tiles (2 row + 0/1, 2 col + 0/1)
+A parent is written once all of its children are in, then shrinks into its own parent and so on
+Workers finish parents that fall entirely inside their supertile
+Parents straddling supertiles go back to the master as partial (quadrant) tiles
+and are written there once the other supertiles fill them in
+Tiles that weren't cut this run (resume) are read back by finish()
+Level k is 1 / 2**k scale, level 0 is the base tiles (see tile_sink for where they go)
+'''
+
+from PIL import Image
+import numpy as np
+
+
+class TilePyramid(object):
+    def __init__(self, rows, cols, tw, th, sink):
+        '''
+        rows, cols: base tile grid
+        sink: tile_sink.TileDir or TileArchive
+        '''
+        assert tw % 2 == 0 and th % 2 == 0, "Pyramid needs even tile sizes"
+        self.tw = tw
+        self.th = th
+        self.sink = sink
+        # (rows, cols) for each level, the last one is a single tile
+        self.grids = [(rows, cols)]
+        while self.grids[-1] != (1, 1):
+            r, c = self.grids[-1]
+            self.grids.append(((r + 1) // 2, (c + 1) // 2))
+        # (level, row, col) => [canvas, set of (qy, qx) quadrants filled]
+        self.pending = {}
+        # (level, row, col) written, level >= 1
+        self.written = set()
+
+    def local(self):
+        '''Empty pyramid with the same layout, ex: for a worker to fill from one supertile'''
+        return TilePyramid(self.grids[0][0], self.grids[0][1], self.tw,
+                           self.th, self.sink)
+
+    def top(self):
+        return len(self.grids) - 1
+
+    def children(self, level, row, col):
+        '''Quadrants (qy, qx) of level tile (row, col) that exist on the level - 1 grid'''
+        rows, cols = self.grids[level - 1]
+        return [(qy, qx) for qy in (0, 1) for qx in (0, 1)
+                if 2 * row + qy < rows and 2 * col + qx < cols]
+
+    def quadrant(self, canvas, qy, qx):
+        h = self.th // 2
+        w = self.tw // 2
+        return canvas[qy * h:(qy + 1) * h, qx * w:(qx + 1) * w]
+
+    def shrink(self, tile):
+        '''(th, tw, 3) => (th / 2, tw / 2, 3) box filter'''
+        tile = tile.reshape(self.th // 2, 2, self.tw // 2, 2, 3)
+        return (tile.mean(axis=(1, 3)) + 0.5).astype(np.uint8)
+
+    def put(self, level, row, col, qy, qx, quarter):
+        '''Fill in quadrant of a level tile, write it if its now complete'''
+        k = (level, row, col)
+        this = self.pending.get(k)
+        if this is None:
+            this = [np.zeros((self.th, self.tw, 3), dtype=np.uint8), set()]
+            self.pending[k] = this
+        self.quadrant(this[0], qy, qx)[...] = quarter
+        this[1].add((qy, qx))
+        if len(this[1]) == len(self.children(level, row, col)):
+            del self.pending[k]
+            self.save(level, row, col, this[0])
+
+    def save(self, level, row, col, tile):
+        self.sink.save(level, row, col, Image.fromarray(tile))
+        self.written.add((level, row, col))
+        self.add(level, row, col, tile)
+
+    def add(self, level, row, col, tile):
+        '''A level tile (th, tw, 3) is done, shrink it into its parent'''
+        if level == self.top():
+            return
+        self.put(level + 1, row // 2, col // 2, row % 2, col % 2,
+                 self.shrink(tile))
+
+    def export(self):
+        '''
+        Return (written, partials) and forget them
+        partials: [(level, row, col, {(qy, qx): quarter})]
+        '''
+        partials = []
+        for (level, row, col), (canvas, quads) in self.pending.items():
+            partials.append((level, row, col,
+                             dict((q, self.quadrant(canvas, *q).copy())
+                                  for q in quads)))
+        written = self.written
+        self.pending = {}
+        self.written = set()
+        return written, partials
+
+    def merge(self, written, partials):
+        '''Take in what a worker's local pyramid didn't finish'''
+        self.written.update(written)
+        for level, row, col, quads in partials:
+            for (qy, qx), quarter in quads.items():
+                self.put(level, row, col, qy, qx, quarter)
+
+    def load(self, level, row, col):
+        im = self.sink.load(level, row, col)
+        if im is None:
+            return None
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+        return np.asarray(im)
+
+    def finish(self):
+        '''
+        Write every level tile not written this run
+        Children not cut this run (resume, skipped supertile) are read back from the sink
+        Missing children are left black
+        '''
+        loaded = 0
+        for level in range(1, len(self.grids)):
+            rows, cols = self.grids[level]
+            for row in range(rows):
+                for col in range(cols):
+                    k = (level, row, col)
+                    if k in self.written:
+                        continue
+                    this = self.pending.pop(k, None)
+                    if this is None:
+                        # From an earlier run and nothing under it changed
+                        if self.sink.exists(level, row, col):
+                            continue
+                        this = [
+                            np.zeros((self.th, self.tw, 3), dtype=np.uint8),
+                            set()
+                        ]
+                    canvas, quads = this
+                    for qy, qx in self.children(level, row, col):
+                        if (qy, qx) in quads:
+                            continue
+                        child = self.load(level - 1, 2 * row + qy,
+                                          2 * col + qx)
+                        if child is not None:
+                            loaded += 1
+                            self.quadrant(canvas, qy, qx)[...] = self.shrink(
+                                child)
+                    self.save(level, row, col, canvas)
+        self.sink.flush()
+        print('Pyramid: %u levels, finished reading back %u tiles' %
+              (self.top(), loaded))
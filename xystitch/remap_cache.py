@@ -0,0 +1,147 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+Remapped image cache shared by the supertile workers
+
+Supertiles overlap by the clip width so an image near a boundary is in two to four of them
+Each one used to run nona on its own sub project cropped to the supertile
+so those images were read and remapped again every time
+But nona's cropped TIFF_m output is in whole canvas coordinates (XPosition / YPosition tags)
+Remapped over the uncropped canvas, an image's output only depends on its own image line
+and the canvas (p / m lines), never on the supertile
+So a worker only remaps the images of its supertile that aren't in the cache yet, in one nona run,
+and hands every cached file to enblend with the output placed at the supertile (-f)
+-f only sets a minimum canvas though: enblend unions it with the inputs and never crops
+so the blended image is cropped back to the supertile here (see crop_blended())
+Entries are keyed by a hash of the image line + canvas text
+The master counts how many supertiles use each image and drops an entry after the last one
+so disk use follows the supertile front instead of growing to the whole remapped scan
+'''
+
+from xystitch.nona import Nona
+
+from PIL import Image
+import hashlib
+import os
+
+TAG_X_RESOLUTION = 282
+TAG_Y_RESOLUTION = 283
+TAG_X_POSITION = 286
+TAG_Y_POSITION = 287
+
+
+def tiff_offset(im):
+    '''
+    Canvas pixel (x, y) of a cropped TIFF's top left, None if it has no position tags
+    Positions are stored in resolution units
+    '''
+    tags = getattr(im, 'tag_v2', None)
+    if tags is None or (TAG_X_POSITION not in tags
+                        and TAG_Y_POSITION not in tags):
+        return None
+    xres = float(tags.get(TAG_X_RESOLUTION) or 1)
+    yres = float(tags.get(TAG_Y_RESOLUTION) or 1)
+    return (int(round(float(tags.get(TAG_X_POSITION, 0)) * xres)),
+            int(round(float(tags.get(TAG_Y_POSITION, 0)) * yres)))
+
+
+def crop_blended(fn, bounds, remap_files):
+    '''
+    Load enblend output fn cropped to bounds (x0, x1, y0, y1)
+    Its top left is taken from its position tags
+    or else the union of the -f rectangle and the tagged inputs, which is what enblend outputs
+    Untagged inputs can't be placed so they're skipped, and if nothing is tagged this fails
+    rather than guess
+    Return PIL image
+    '''
+    x0, x1, y0, y1 = bounds
+    im = Image.open(fn)
+    im.load()
+    offset = tiff_offset(im)
+    if offset is None:
+        ox, oy = x0, y0
+        tagged = 0
+        for remap_fn in remap_files:
+            with Image.open(remap_fn) as remapped:
+                this = tiff_offset(remapped)
+            if this is None:
+                print('WARNING: remapped image %s has no position tags' %
+                      remap_fn)
+                continue
+            tagged += 1
+            ox = min(ox, this[0])
+            oy = min(oy, this[1])
+        if not tagged:
+            raise Exception(
+                'Blended %s and its inputs have no position tags, can\'t crop to supertile'
+                % fn)
+    else:
+        ox, oy = offset
+    if (ox, oy) == (x0, y0) and im.size == (x1 - x0, y1 - y0):
+        return im
+    print('Remap cache: cropping blended %ux%u+%d+%d to supertile' %
+          (im.size[0], im.size[1], ox, oy))
+    ret = Image.new(im.mode, (x1 - x0, y1 - y0))
+    ret.paste(im, (ox - x0, oy - y0))
+    return ret
+
+
+class RemapCache(object):
+    def __init__(self, cache_dir, snapshot):
+        self.cache_dir = cache_dir
+        self.snapshot = snapshot
+        # image index => supertiles still needing it
+        # Only tracked in the master
+        self.refs = {}
+        self.hits = 0
+        self.misses = 0
+
+    def entry_fn(self, i):
+        h = hashlib.sha1((self.snapshot.header + self.snapshot.il_text(i) +
+                          self.snapshot.footer).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, h + '.tif')
+
+    def remap(self, keep, out_name_prefix, pprefix=None, nona_args=[]):
+        '''
+        Make sure images keep are remapped
+        Return remapped file names (images that don't land on the canvas have none)
+        '''
+        missing = [i for i in keep if not os.path.exists(self.entry_fn(i))]
+        self.hits += len(keep) - len(missing)
+        self.misses += len(missing)
+        print('Remap cache: %u / %u images cached (%s)' %
+              (len(keep) - len(missing), len(keep), self))
+        if missing:
+            # Uncropped so each output is cropped to just its image
+            pto = self.snapshot.images_project(missing)
+            remapper = Nona(pto, out_name_prefix, pprefix=pprefix)
+            remapper.args = nona_args
+            remapper.remap()
+            for n, i in enumerate(missing):
+                fn = '%s%04d.tif' % (out_name_prefix, n)
+                # Another worker may have beat us to it, same pixels either way
+                if os.path.exists(fn):
+                    os.rename(fn, self.entry_fn(i))
+        return [
+            self.entry_fn(i) for i in keep if os.path.exists(self.entry_fn(i))
+        ]
+
+    def add_refs(self, keep):
+        for i in keep:
+            self.refs[i] = self.refs.get(i, 0) + 1
+
+    def release(self, keep):
+        '''A supertile using keep is finished, drop entries nothing else needs'''
+        for i in keep:
+            self.refs[i] -= 1
+            if self.refs[i] == 0:
+                del self.refs[i]
+                fn = self.entry_fn(i)
+                if os.path.exists(fn):
+                    os.remove(fn)
+
+    def __str__(self):
+        return 'hits %d, misses %d' % (self.hits, self.misses)
@@ -0,0 +1,164 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+Control point residuals computed in one batched numpy pass
+
+Shared by the optimizers, xy-outlier and xy-cp
+For a point between images n and N (same convention as the old iter_rms()):
+    dx = (n.d - x) - (N.d - X)
+    dy = (n.e - y) - (N.e - Y)
+Global coordinates (d/e) are positive upper left but image coordinates are positive down right
+so the signs work out to 0 for a perfect fit
+
+Note "rms" historically means the mean residual distance here (see get_rms())
+'''
+
+import numpy as np
+
+
+class NoRMS(Exception):
+    pass
+
+
+class Residuals(object):
+    def __init__(self, pto):
+        self.pto = pto
+        self.nimages = pto.nimages()
+        self.cpa = pto.columnar_cps()
+        if self.cpa is not None:
+            self.cpls = None
+            arr = self.cpa.arr
+            self.n = arr['n'].astype(np.int64)
+            self.N = arr['N'].astype(np.int64)
+            x, y, X, Y = arr['x'], arr['y'], arr['X'], arr['Y']
+        else:
+            self.cpls = pto.get_control_point_lines()
+            self.n = np.array([cpl.getv('n') for cpl in self.cpls],
+                              dtype=np.int64)
+            self.N = np.array([cpl.getv('N') for cpl in self.cpls],
+                              dtype=np.int64)
+            x, y, X, Y = [
+                np.array([cpl.getv(k) for cpl in self.cpls],
+                         dtype=np.float64) for k in ('x', 'y', 'X', 'Y')
+            ]
+
+        d = np.array([il.getv('d') for il in pto.image_lines],
+                     dtype=np.float64)
+        e = np.array([il.getv('e') for il in pto.image_lines],
+                     dtype=np.float64)
+        self.dx = (d[self.n] - x) - (d[self.N] - X)
+        self.dy = (e[self.n] - y) - (e[self.N] - Y)
+        # numpy quietly turns a missing (None) variable into nan
+        bad = np.isnan(self.dx) | np.isnan(self.dy)
+        if bad.any():
+            i = int(np.nonzero(bad)[0][0])
+            raise NoRMS("Missing variable (%s, %s, %s)" %
+                        (pto.image_lines[self.n[i]].text,
+                         pto.image_lines[self.N[i]].text, self.cpl(i).text))
+        self.dist = np.sqrt(self.dx**2 + self.dy**2)
+
+    def __len__(self):
+        return len(self.dist)
+
+    def cpl(self, i):
+        '''Control point i as a ControlPointLine or row view'''
+        if self.cpa is not None:
+            return self.cpa.row(i)
+        return self.cpls[i]
+
+    def mean(self):
+        '''Mean residual distance, what get_rms() has always returned'''
+        if len(self.dist) == 0:
+            raise NoRMS("No control points")
+        return float(self.dist.mean())
+
+    def rms(self):
+        '''True root mean square residual distance'''
+        if len(self.dist) == 0:
+            raise NoRMS("No control points")
+        return float(np.sqrt((self.dist**2).mean()))
+
+    def canonical_pairs(self):
+        '''
+        Return (a, b, sign) with a > b, sign flipped where n/N were swapped
+        Same canonical form as cp.pto2cps()
+        '''
+        swap = self.N > self.n
+        a = np.where(swap, self.N, self.n)
+        b = np.where(swap, self.n, self.N)
+        sign = np.where(swap, -1.0, 1.0)
+        return a, b, sign
+
+    def pair_index(self):
+        '''Return (unique pair list [(a, b)], per point index into it)'''
+        a, b, _sign = self.canonical_pairs()
+        keys, inverse = np.unique(a * self.nimages + b, return_inverse=True)
+        pairs = [(int(k // self.nimages), int(k % self.nimages))
+                 for k in keys.tolist()]
+        return pairs, inverse.reshape(-1)
+
+    def pair_stats(self):
+        '''ret[(a, b)] = (mean distance, number of points)'''
+        pairs, inverse = self.pair_index()
+        counts = np.bincount(inverse, minlength=len(pairs))
+        sums = np.bincount(inverse, weights=self.dist, minlength=len(pairs))
+        ret = {}
+        for pair, count, dsum in zip(pairs, counts.tolist(), sums.tolist()):
+            ret[pair] = (dsum / count, count)
+        return ret
+
+    def pair_deltas(self):
+        '''ret[(a, b)] = [(dx, dy), ...] in canonical sign'''
+        a, b, sign = self.canonical_pairs()
+        ret = {}
+        for a_, b_, dx, dy in zip(a.tolist(), b.tolist(),
+                                  (self.dx * sign).tolist(),
+                                  (self.dy * sign).tolist()):
+            ret.setdefault((a_, b_), []).append((dx, dy))
+        return ret
+
+    def image_stats(self):
+        '''
+        Return (mean distance, number of points) arrays indexed by image
+        Each point counts towards both of its images
+        Images without points have mean nan
+        '''
+        counts = np.bincount(self.n, minlength=self.nimages) + np.bincount(
+            self.N, minlength=self.nimages)
+        sums = np.bincount(
+            self.n, weights=self.dist, minlength=self.nimages) + np.bincount(
+                self.N, weights=self.dist, minlength=self.nimages)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+        return means, counts
+
+    def outlier_mask(self, stdev):
+        '''True for points whose distance exceeds mean + stdev * sample stdev'''
+        if len(self.dist) < 2:
+            return np.zeros(len(self.dist), dtype=bool)
+        u = self.dist.mean()
+        sd = self.dist.std(ddof=1)
+        return self.dist > u + sd * stdev
+
+    def pair_mask(self, pairs):
+        '''True for points between any (n, N) in pairs, either order'''
+        keys = set()
+        for n, N in pairs:
+            keys.add(n * self.nimages + N)
+            keys.add(N * self.nimages + n)
+        return np.isin(self.n * self.nimages + self.N,
+                       np.array(sorted(keys), dtype=np.int64))
+
+    def remove(self, mask):
+        '''Remove points where mask is set from the project, return count'''
+        removed = int(mask.sum())
+        if self.cpa is not None:
+            self.pto.set_cp_array(self.cpa.take(~mask))
+        else:
+            self.pto.control_point_lines = [
+                cpl for cpl, rm in zip(self.cpls, mask.tolist()) if not rm
+            ]
+        return removed
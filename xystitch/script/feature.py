@@ -41,10 +41,12 @@ def run(input_image_file_names=None,
         dry=False,
         threads=None,
         algorithm=None,
+        cp_engine=None,
         log_dir=None,
         ignore_errors=False,
         skip_missing=False,
-        allow_overwrite=True):
+        allow_overwrite=True,
+        resume=True):
     # time xy-feature out.pto $( (shopt -s nullglob; echo *.jpg *.png) ) "$@" ||exit 1
     if input_image_file_names is None:
         input_image_file_names = list(glob.glob("*.jpg")) + list(
@@ -90,10 +92,12 @@ def run(input_image_file_names=None,
         print('Using %d threads' % threads)
         engine.threads = threads
         engine.skip_missing = skip_missing
+        engine.resume = resume
     else:
         raise Exception('need an algorithm / engine')
 
     engine.log_dir = log_dir
+    engine.cp_engine = cp_engine
     engine.set_output_project_file_name(output_project_file_name)
     engine.set_regular(regular)
     engine.set_dry(dry)
@@ -124,6 +128,12 @@ def main():
                         help='Output log file name')
     add_bool_arg(parser, '--grid-only', default=False, help='')
     parser.add_argument('--algorithm', default='grid', help='')
+    parser.add_argument(
+        '--cp-engine',
+        default=None,
+        help=
+        'Control point engine: panocp (default), phase (FFT, falls back to panocp), autopano-sift-c'
+    )
     parser.add_argument('--threads',
                         type=int,
                         default=multiprocessing.cpu_count())
@@ -134,6 +144,10 @@ def main():
     add_bool_arg(parser, '--dry', default=False, help='')
     add_bool_arg(parser, '--skip-missing', default=False, help='')
     add_bool_arg(parser, '--ignore-errors', default=False, help='')
+    add_bool_arg(parser,
+                 '--resume',
+                 default=True,
+                 help='Skip pairs journaled by an interrupted run')
     parser.add_argument('fns', nargs='+', help='File names')
     args = parser.parse_args()
 
@@ -154,9 +168,11 @@ def main():
         dry=args.dry,
         threads=args.threads,
         algorithm=args.algorithm,
+        cp_engine=args.cp_engine,
         log=args.log,
         ignore_errors=args.ignore_errors,
-        allow_overwrite=args.overwrite)
+        allow_overwrite=args.overwrite,
+        resume=args.resume)
 
 
 if __name__ == "__main__":
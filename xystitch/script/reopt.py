@@ -15,7 +15,7 @@ import os
 import sys
 
 
-def run(pto_in=None, pto_out=None):
+def run(pto_in=None, pto_out=None, solver=None):
     if not pto_in:
         pto_in = "out.pto"
     if not pto_out:
@@ -34,6 +34,8 @@ def run(pto_in=None, pto_out=None):
 
     print('Optimizing')
     opt = XYOptimizer2(pto)
+    if solver:
+        opt.solver = solver
     pto = opt.run()
 
     print('Saving to %s' % pto_out)
@@ -63,6 +65,10 @@ def main():
     parser.add_argument('pto_out',
                         nargs='?',
                         help='output file, default to override input')
+    parser.add_argument('--solver',
+                        default=None,
+                        choices=['spiral', 'lsq'],
+                        help='Image placement, see XYOptimizer2.solver')
     args = parser.parse_args()
     pto_in = args.pto_in
     pto_out = args.pto_out
@@ -83,7 +89,7 @@ def main():
         _outlog.out_fd.write('*' * 80 + '\n')
         _outlog.out_fd.write('*' * 80 + '\n')
 
-    run(pto_in, pto_out)
+    run(pto_in, pto_out, solver=args.solver)
 
 
 if __name__ == "__main__":
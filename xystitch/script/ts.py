@@ -15,6 +15,7 @@ from xystitch.tiler import Tiler
 from xystitch.pto.project import PTOProject
 from xystitch.config import config
 from xystitch.single import singlify, HugeImage
+from xystitch import st_store
 from xystitch.util import logwt, add_bool_arg, size2str, mksize, mem2pix, pix2mem
 from xystitch.benchmark import Benchmark
 
@@ -66,7 +67,11 @@ def make_threads_stp(args):
         stp = 2**32 / 4
 
     # Keep explicit if given
-    if not args.get("threads"):
+    # With admission control workers wait on memory instead
+    if args.get("mem_admission", True):
+        print("Memory admission: up to %u supertiles in %sB" %
+              (threads, size2str(config.max_mem())))
+    elif not args.get("threads"):
         # Estimate how many supertiles we can fit given memory
         # Try to make the largest supertiles possible
         # TODO: consider different strategies
@@ -116,6 +121,7 @@ def run(args):
         t.set_threads(threads)
         t.set_verbose(args.get("verbose", False))
         t.set_st_dir(args.get("st_dir", "st"))
+        t.set_st_format(args.get("st_format") or "npy")
         t.set_out_extension(args.get("out_ext", ".jpg"))
         t.set_ignore_errors(args.get("ignore_errors", False))
         t.set_ignore_crop(args.get("ignore_crop", True))
@@ -142,6 +148,14 @@ def run(args):
             t.recalc_step()
 
         t.set_enblend_lock(args.get("enblend_lock", True))
+        t.set_mem_admission(args.get("mem_admission", True))
+        t.set_remap_cache(args.get("remap_cache", False))
+        if args.get("pyramid"):
+            t.set_pyramid_dir(args.get("pyramid_dir") or "pyramid")
+        t.set_tile_archive(args.get("tile_archive"))
+        t.set_backend(args.get("backend") or "hugin",
+                      np_blend=args.get("np_blend"),
+                      np_levels=args.get("np_levels"))
 
         single_dir = args.get("single_dir", "single")
         if single_dir and not os.path.exists(single_dir):
@@ -171,8 +185,11 @@ def run(args):
         # this results in excessive merge, although really I should just delete the old files
         if 1:
             print('Single: using glob strategy on merge')
-            s_fns = glob.glob(
-                os.path.join(args.get("st_dir", "st"), 'st_*x_*y.jpg'))
+            s_fns = [
+                fn for fn in glob.glob(
+                    st_store.glob_pattern(args.get("st_dir", "st")))
+                if st_store.is_st_fn(fn)
+            ]
         else:
             print('Single: using output strategy')
             s_fns = t.st_fns
@@ -250,11 +267,33 @@ def main():
     parser.add_argument('--st-dir',
                         default='st',
                         help='store intermediate supertiles to given dir')
+    parser.add_argument(
+        '--st-format',
+        default='npy',
+        choices=['npy', 'jpg'],
+        help=
+        'supertile store format: npy is lossless and memory mapped, jpg is smaller'
+    )
     parser.add_argument(
         '--st-limit',
         default='inf',
         help=
         'debug (exit after # supertiles, typically --st-limit 1 --threads 1)')
+    add_bool_arg(
+        parser,
+        '--pyramid',
+        default=False,
+        help=
+        'also write zoom levels (1 / 2, 1 / 4... down to one tile) while tiling'
+    )
+    parser.add_argument('--pyramid-dir',
+                        default='pyramid',
+                        help='folder to put zoom levels in (see --pyramid)')
+    parser.add_argument(
+        '--tile-archive',
+        default=None,
+        help=
+        'write tiles (and zoom levels) to given SQLite file instead of out/')
     parser.add_argument('--single-dir',
                         default='single',
                         help='folder to put final output composite image')
@@ -267,6 +306,34 @@ def main():
         default=False,
         help=
         'use lock file to only enblend (memory intensive part) one at a time')
+    add_bool_arg(
+        parser,
+        '--mem-admission',
+        default=True,
+        help=
+        'start supertiles as predicted memory fits instead of fixing thread count by memory'
+    )
+    add_bool_arg(
+        parser,
+        '--remap-cache',
+        default=False,
+        help=
+        'remap each image once and share it between overlapping supertiles (experimental)')
+    parser.add_argument(
+        '--backend',
+        default='hugin',
+        choices=['hugin', 'numpy'],
+        help=
+        'stitch supertiles with nona + enblend or in process (translation only projects, else falls back)'
+    )
+    parser.add_argument('--np-blend',
+                        default='multiband',
+                        choices=['multiband', 'feather'],
+                        help='numpy backend blending')
+    parser.add_argument('--np-levels',
+                        type=int,
+                        default=None,
+                        help='numpy backend multiband levels')
     add_bool_arg(parser,
                  '--dry',
                  default=False,
@@ -1,5 +1,9 @@
+from xystitch import st_store
+from xystitch.config import config
+from xystitch.tiled_tiff import TiledTIFFWriter
+
 from PIL import Image
-import re
+import numpy as np
 import struct
 import os
 
@@ -23,42 +27,85 @@ class HugeTIF(HugeImage):
 def coord(fn):
     '''Return (x, y) for filename'''
     # st_021365x_005217y.jpg
-    m = re.match('.*st_([0-9]*)x_([0-9]*)y.jpg', fn)
-    return (int(m.group(1), 10), int(m.group(2), 10))
+    return st_store.coord(fn)
 
 
-def singlify(fns_in, fn_out, fn_out_alt=None):
+def placements(fns_in):
+    '''Return [(fn, x, y, w, h)] relative to the output and the output (w, h)'''
+    ret = []
+    for fn in fns_in:
+        (x, y) = coord(fn)
+        (w, h) = st_store.size(fn)
+        ret.append([fn, x, y, w, h])
+    xmin = min(x for _fn, x, _y, _w, _h in ret)
+    ymin = min(y for _fn, _x, y, _w, _h in ret)
+    print(('X: %d:%d' % (xmin, max(x for _fn, x, _y, _w, _h in ret))))
+    print(('Y: %d:%d' % (ymin, max(y for _fn, _x, y, _w, _h in ret))))
+    for this in ret:
+        this[1] -= xmin
+        this[2] -= ymin
+    width = max(x + w for _fn, x, _y, w, _h in ret)
+    height = max(y + h for _fn, _x, y, _w, h in ret)
+    return ret, width, height
+
+
+def bands(sts, width, height, band_h):
+    '''
+    Yield (y0, (h, width, 3) array) for each band_h row band of the output
+    Later supertiles overwrite earlier ones, same as pasting them in order
+    .npy supertiles are memory mapped so only the overlapping rows are read
+    A .jpg one has to be decoded in full, so it's kept only while bands still overlap it
+    '''
+    cache = {}
+    for y0 in range(0, height, band_h):
+        y1 = min(y0 + band_h, height)
+        band = np.zeros((y1 - y0, width, 3), dtype=np.uint8)
+        for fn, x, y, w, h in sts:
+            if y >= y1 or y + h <= y0:
+                continue
+            im = cache.get(fn)
+            if im is None:
+                im = st_store.load(fn)
+                cache[fn] = im
+            sy0 = max(y0, y)
+            sy1 = min(y1, y + h)
+            band[sy0 - y0:sy1 - y0, x:x + w] = im[sy0 - y:sy1 - y]
+        for fn, _x, y, _w, h in sts:
+            if y + h <= y1 and fn in cache:
+                del cache[fn]
+        yield y0, band
+
+
+def is_tif(fn):
+    return fn.lower().endswith('.tif') or fn.lower().endswith('.tiff')
+
+
+def singlify(fns_in, fn_out, fn_out_alt=None, max_mem=None):
+    '''
+    Merge supertiles into one image
+    .tif output is streamed out as a tiled (Big)TIFF a band at a time
+    Other formats need the whole image in memory
+    and switch to fn_out_alt (if given) when it doesn't fit max_mem or the format
+    '''
     if not fns_in:
         raise Exception("No input")
 
     print('Calculating dimensions...')
-    xmin = None
-    xmax = None
-    for fn in fns_in:
-        (x, y) = coord(fn)
-        if xmin is None:
-            xmin = x
-            ymin = y
-            xmax = x
-            ymax = y
-        else:
-            xmin = min(xmin, x)
-            ymin = min(ymin, y)
-            xmax = max(xmax, x)
-            ymax = max(ymax, y)
-
-    print(('X: %d:%d' % (xmin, xmax)))
-    print(('Y: %d:%d' % (ymin, ymax)))
-    #with Image.open(fns_in[0]) as im0:
-    im0 = Image.open(fns_in[0])
-    if 1:
-        print(('Supertile 0 size: %dw x %dh' % (im0.size[0], im0.size[1])))
-        w = im0.size[0] + xmax - xmin
-        h = im0.size[1] + ymax - ymin
-        print(('Output size: %dw x %dh' % (w, h)))
-        dst = Image.new(im0.mode, (w, h))
+    sts, w, h = placements(fns_in)
+    print(('Output size: %dw x %dh' % (w, h)))
+    if max_mem is None:
+        max_mem = config.max_mem() // 2
 
     def verify_format():
+        if is_tif(fn_out):
+            return fn_out
+        if w * h * 3 > max_mem:
+            if fn_out_alt:
+                print(
+                    'WARNING: image exceeds single memory budget.  Forcing alt format'
+                )
+                return fn_out_alt
+            raise HugeImage('Image exceeds single memory budget')
         if fn_out.find('.jpg') >= 0:
             if w >= 2**16 or h >= 2**16:
                 if fn_out_alt:
@@ -75,23 +122,25 @@ def singlify(fns_in, fn_out, fn_out_alt=None):
                     )
                     return fn_out_alt
                 raise HugeJPEG('Image exceeds maximum JPEG size')
-        '''
-        is this even true?  I think it was size which isn't the same since compressed
-        elif fn_out.find('.tif') >= 0:
-            if w * h >= 2**32:
-                raise HugeJPEG('Image exceeds maximum tif size')
-        '''
         return fn_out
 
     fn_out = verify_format()
 
-    for fni, fn in enumerate(fns_in):
-        print(('Merging %d/%d %s...' % (fni + 1, len(fns_in), fn)))
-        (x, y) = coord(fn)
-        im = Image.open(fn)
-        dst.paste(im, (x - xmin, y - ymin))
-    width, height = im.size
-    print(('Saving %uw x %uh %s...' % (width, height, fn_out)))
+    if is_tif(fn_out):
+        print(('Streaming %uw x %uh %s...' % (w, h, fn_out)))
+        writer = TiledTIFFWriter(fn_out, w, h)
+        for y0, band in bands(sts, w, h, writer.th):
+            print(('Band %d/%d' % (y0 // writer.th + 1, writer.rows)))
+            writer.write_band(band)
+        writer.close()
+        print('Done!')
+        return
+
+    dst = Image.new('RGB', (w, h))
+    for y0, band in bands(sts, w, h, 1024):
+        print(('Merging rows %d/%d...' % (y0, h)))
+        dst.paste(Image.fromarray(band), (0, y0))
+    print(('Saving %uw x %uh %s...' % (w, h, fn_out)))
     try:
         dst.save(fn_out, quality=95)
     # File "/usr/lib/python2.7/dist-packages/PIL/TiffImagePlugin.py", line 550, in _pack
@@ -102,6 +151,5 @@ def singlify(fns_in, fn_out, fn_out_alt=None):
             os.remove(fn_out)
         except OSError:
             pass
-        raise HugeTIF("Failed to save image of size %uw x %uh" %
-                      (width, height))
+        raise HugeTIF("Failed to save image of size %uw x %uh" % (w, h))
     print('Done!')
@@ -0,0 +1,117 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+Memory budget admission control for supertile workers
+
+xy-ts used to fix the worker count up front from pix2mem() of the largest supertile
+and otherwise rely on the enblend lock to keep several big blends from running at once
+But supertiles are not all the same size: edge ones are clipped to the canvas and have fewer images
+Instead a supertile is only handed to an idle worker if its predicted memory
+plus that of every supertile still running fits in the budget (config.max_mem())
+The prediction is learned from the peak worker RSS (nona + enblend children included)
+seen while each supertile ran:
+    mem = a * pixels + b * images + c
+Until there are enough samples fall back to the worst bytes / pixel seen so far, then pix2mem()
+The fit is scaled up to cover every sample so it errs on the side of waiting
+One supertile is always allowed to run so an oversized one still makes progress
+'''
+
+from xystitch.util import pix2mem, size2str
+
+import numpy as np
+
+# Samples needed before fitting the linear model
+MIN_FIT_SAMPLES = 4
+# Extra headroom on top of the prediction
+MARGIN = 1.1
+
+
+class MemoryModel(object):
+    def __init__(self):
+        # (pixels, images, peak RSS)
+        self.samples = []
+        # a, b, c
+        self.coef = None
+        self.bytes_per_pix = None
+
+    def add(self, pixels, images, mem):
+        self.samples.append((pixels, images, mem))
+        self.bytes_per_pix = max(1.0 * m / max(p, 1)
+                                 for p, _i, m in self.samples)
+        self.coef = None
+        if len(self.samples) < MIN_FIT_SAMPLES:
+            return
+        arr = np.array(self.samples, dtype=np.float64)
+        A = np.column_stack((arr[:, 0], arr[:, 1], np.ones(len(arr))))
+        coef, _res, rank, _sv = np.linalg.lstsq(A, arr[:, 2], rcond=None)
+        # All the same size supertile or nonsense fit => stick with bytes / pixel
+        if rank < 3 or coef[0] <= 0 or coef[1] < 0:
+            return
+        pred = A.dot(coef)
+        if np.any(pred <= 0):
+            return
+        # Upper envelope of what was seen
+        self.coef = coef * max(1.0, (arr[:, 2] / pred).max())
+
+    def predict(self, pixels, images):
+        if self.coef is not None:
+            a, b, c = self.coef
+            ret = a * pixels + b * images + c
+        elif self.bytes_per_pix is not None:
+            ret = self.bytes_per_pix * pixels
+        else:
+            ret = pix2mem(pixels)
+        return int(ret * MARGIN)
+
+    def __str__(self):
+        if self.coef is not None:
+            a, b, c = self.coef
+            return '%0.1f B / pix + %sB / image + %sB (%u samples)' % (
+                a, size2str(b), size2str(c), len(self.samples))
+        if self.bytes_per_pix is not None:
+            return '%0.1f B / pix (%u samples)' % (self.bytes_per_pix,
+                                                  len(self.samples))
+        return 'pix2mem() prior'
+
+
+class MemoryAdmission(object):
+    def __init__(self, budget, model=None):
+        self.budget = budget
+        self.model = model or MemoryModel()
+        # worker index => [pixels, images, predicted, peak RSS]
+        self.running = {}
+
+    def predict(self, pixels, images):
+        return self.model.predict(pixels, images)
+
+    def committed(self):
+        '''Memory held by running supertiles: predicted until they measure higher'''
+        return sum(max(pred, peak) for _p, _i, pred, peak in self.running.values())
+
+    def fits(self, pixels, images):
+        if not self.running:
+            return True
+        return self.committed() + self.predict(pixels, images) <= self.budget
+
+    def start(self, wi, pixels, images):
+        self.running[wi] = [pixels, images, self.predict(pixels, images), 0]
+
+    def update(self, wi, mem):
+        '''Worker wi measured at mem bytes'''
+        this = self.running.get(wi)
+        if this is not None:
+            this[3] = max(this[3], mem)
+
+    def done(self, wi, ok=True):
+        '''Worker wi finished, learn from it if it completed normally'''
+        pixels, images, _pred, peak = self.running.pop(wi)
+        if ok and peak:
+            self.model.add(pixels, images, peak)
+
+    def __str__(self):
+        return 'mem budget %sB, committed %sB over %u supertiles, model: %s' % (
+            size2str(self.budget), size2str(self.committed()),
+            len(self.running), self.model)
@@ -0,0 +1,155 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+Closed form supertile planner
+
+Tiler.sweep_st_optimizer() used to build a whole new Tiler for every candidate width
+and count supertiles by generating them, optimizing only count and then perimeter
+But gen_supertiles() is simple enough to count directly:
+along an axis of length L, supertile size s and step s - 2 clip - 2 tile
+there are 1 + ceil((L - s) / step) supertiles (1 if s >= L), the last one shifted back to the edge
+So instead walk supertile counts per axis, take the smallest size that covers the canvas with that count
+(so no trim pass is needed) and score each candidate with a rough cost model:
+-nona: every image touching a supertile gets remapped
+-enblend: each image added is a pass over the supertile and seam work grows with overlaps
+ so time is super linear in images per supertile
+-memory: supertile pixels must fit stp, smaller peak memory breaks ties
+Wasted overlap (pixels stitched more than once) shows up as extra time
+'''
+
+from xystitch.util import pix2mem, size2str
+
+import math
+
+# Rough cost model, seconds
+# Per supertile: worker setup, nona / enblend startup, intermediate files
+ST_OVERHEAD_S = 10.0
+# nona per source image megapixel
+NONA_S_PER_MP = 0.3
+# enblend per supertile megapixel per image blended in
+ENBLEND_S_PER_MP = 0.02
+# Images per supertile exponent on top of that
+ENBLEND_IMG_EXP = 1.2
+
+
+def axis_count(length, st, step):
+    '''Number of supertiles gen_supertiles() makes along one axis'''
+    if st >= length:
+        return 1
+    return 1 + int(math.ceil(1.0 * (length - st) / step))
+
+
+def axis_plan(length, n, img, tile, clip):
+    '''
+    Smallest (supertile size, clip) giving at most n supertiles along an axis
+    None if there is no valid step
+    Mirrors Tiler: clip is dropped if a supertile is no bigger than an image
+    That's only sane for a single supertile spanning the axis, otherwise seams land on tiles
+    '''
+    if n == 1:
+        clip = clip if length > img else 0
+        # gen_supertiles() clamps to the canvas but the step still has to be valid
+        return max(length, 2 * clip + 2 * tile + 1), clip
+    overlap = 2 * clip + 2 * tile
+    st = int(math.ceil(1.0 * (length + (n - 1) * overlap) / n))
+    # Each supertile has to move on by at least a tile
+    if st <= img or st - overlap < max(tile, 1):
+        return None
+    return st, clip
+
+
+class SupertilePlan(object):
+    def __init__(self, stw, sth, clip_width, clip_height, nx, ny):
+        self.stw = stw
+        self.sth = sth
+        self.clip_width = clip_width
+        self.clip_height = clip_height
+        self.nx = nx
+        self.ny = ny
+        self.n = nx * ny
+        self.images_per_st = None
+        self.time_s = None
+        self.waste_pix = None
+        self.mem = None
+
+    def cost(self):
+        return (self.time_s, self.mem)
+
+    def show(self):
+        print('Supertile plan: %u (%uw X %uh) supertiles of %uw X %uh' %
+              (self.n, self.nx, self.ny, self.stw, self.sth))
+        print('  Clip: %uw X %uh' % (self.clip_width, self.clip_height))
+        print('  Predicted: %0.1f images / supertile, %0.1f sec total' %
+              (self.images_per_st, self.time_s))
+        print('  Predicted: %s wasted overlap pixels, %sB max supertile memory' %
+              (size2str(self.waste_pix), size2str(self.mem)))
+
+
+def plan_supertiles(width,
+                    height,
+                    img_width,
+                    img_height,
+                    nimages,
+                    tile_width,
+                    tile_height,
+                    clip_width,
+                    clip_height,
+                    stp,
+                    aspect_max=2.0,
+                    verbose=False):
+    '''Return the cheapest SupertilePlan with supertiles no bigger than stp pixels'''
+    # Assume images are spread evenly over the canvas
+    pitch = (1.0 * width * height / max(nimages, 1) /
+             (img_width * img_height))**0.5
+    pitch_x = max(1.0, img_width * pitch)
+    pitch_y = max(1.0, img_height * pitch)
+    img_mp = img_width * img_height / 1e6
+
+    def axis_candidates(length, img, tile, clip):
+        ret = []
+        for n in range(1, length + 1):
+            this = axis_plan(length, n, img, tile, clip)
+            # Supertiles only get smaller with more of them
+            if this is None:
+                break
+            if not ret or ret[-1] != this:
+                ret.append(this)
+        return ret
+
+    best = None
+    checked = 0
+    xs = axis_candidates(width, img_width, tile_width, clip_width)
+    ys = axis_candidates(height, img_height, tile_height, clip_height)
+    for stw, cw in xs:
+        for sth, ch in ys:
+            # Actual size, a single supertile is clamped to the canvas
+            w = min(stw, width)
+            h = min(sth, height)
+            if w * h > stp:
+                continue
+            # Skip slivers unless the canvas forces them
+            if max(1.0 * w / h, 1.0 * h / w) > aspect_max and (w < width and
+                                                              h < height):
+                continue
+            checked += 1
+            nx = axis_count(width, stw, stw - 2 * cw - 2 * tile_width)
+            ny = axis_count(height, sth, sth - 2 * ch - 2 * tile_height)
+            plan = SupertilePlan(stw, sth, cw, ch, nx, ny)
+            plan.images_per_st = min(
+                nimages,
+                (w + img_width) / pitch_x * (h + img_height) / pitch_y)
+            st_mp = w * h / 1e6
+            plan.time_s = plan.n * (
+                ST_OVERHEAD_S + NONA_S_PER_MP * plan.images_per_st * img_mp +
+                ENBLEND_S_PER_MP * st_mp * plan.images_per_st**ENBLEND_IMG_EXP)
+            plan.waste_pix = plan.n * w * h - width * height
+            plan.mem = pix2mem(w * h)
+            if best is None or plan.cost() < best.cost():
+                best = plan
+    verbose and print('Planner checked %u supertile sizes' % checked)
+    if best is None:
+        raise Exception("Failed to find stitch solution")
+    return best
@@ -0,0 +1,104 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+Supertile store
+
+Workers used to turn each enblend TIFF into st/st_<x>x_<y>y.jpg by spawning convert -quality 90
+then poll for the file to show up
+Everything downstream (resume, singlify, st2tile.py) decoded that lossy copy again in full
+Instead a supertile is kept as a .npy: a small header + raw RGB rows
+-written by the worker itself (temp name + rename, so a partial file is never picked up)
+-lossless, no re-encode
+-np.load(mmap_mode='r') maps it so a reader only pages in the rows / columns it slices
+Raw is about 3 bytes / pixel on disk, the old .jpg format is still available where that matters
+'''
+
+from xystitch import pimage
+
+from PIL import Image
+import numpy as np
+import os
+import re
+
+FMT_NPY = 'npy'
+FMT_JPG = 'jpg'
+FORMATS = (FMT_NPY, FMT_JPG)
+
+
+def st_fn(st_dir, x0, y0, fmt=FMT_NPY):
+    # st_081357x_000587y.npy
+    return os.path.join(st_dir, 'st_%06dx_%06dy.%s' % (x0, y0, fmt))
+
+
+def coord(fn):
+    '''Return (x, y) for filename'''
+    m = re.match(r'.*st_([0-9]*)x_([0-9]*)y\.[a-z]+$', fn)
+    return (int(m.group(1), 10), int(m.group(2), 10))
+
+
+def glob_pattern(st_dir):
+    return os.path.join(st_dir, 'st_*x_*y.*')
+
+
+def is_st_fn(fn):
+    return fn.endswith('.' + FMT_NPY) or fn.endswith('.' + FMT_JPG)
+
+
+def rgb(im):
+    '''PIL image or array => (h, w, 3) uint8 array'''
+    if isinstance(im, np.ndarray):
+        return im
+    if im.mode == 'RGBA':
+        im = pimage.rgba2rgb(im)
+    elif im.mode != 'RGB':
+        im = im.convert('RGB')
+    return np.asarray(im)
+
+
+def save(fn, im):
+    '''Write supertile im (PIL image or array) to fn'''
+    tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+    if fn.endswith('.' + FMT_NPY):
+        arr = rgb(im)
+        # Straight to disk without an extra in memory copy
+        out = np.lib.format.open_memmap(tmp_fn,
+                                        mode='w+',
+                                        dtype=np.uint8,
+                                        shape=arr.shape)
+        out[...] = arr
+        out.flush()
+        del out
+    else:
+        if isinstance(im, np.ndarray):
+            im = Image.fromarray(im)
+        elif im.mode == 'RGBA':
+            im = pimage.rgba2rgb(im)
+        im.save(tmp_fn, format='JPEG', quality=90)
+    os.rename(tmp_fn, fn)
+
+
+def load(fn):
+    '''
+    Return supertile as a (h, w, 3) array
+    .npy is memory mapped so only what is sliced gets read
+    '''
+    if fn.endswith('.' + FMT_NPY):
+        return np.load(fn, mmap_mode='r')
+    return rgb(Image.open(fn))
+
+
+def size(fn):
+    '''(width, height) without reading pixels'''
+    if fn.endswith('.' + FMT_NPY):
+        shape = np.load(fn, mmap_mode='r').shape
+        return shape[1], shape[0]
+    with Image.open(fn) as im:
+        return im.size
+
+
+def region(fn, x0, x1, y0, y1):
+    '''Pixels [y0:y1, x0:x1] of a supertile as a PIL image'''
+    return Image.fromarray(np.ascontiguousarray(load(fn)[y0:y1, x0:x1]))
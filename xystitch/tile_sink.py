@@ -0,0 +1,179 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+Where output tiles go
+
+TileDir is the original layout: one file per tile in out/ (and pyramid levels in their own dirs)
+With 10**6 tiles that's slow to list on resume and painful to copy around
+TileArchive instead puts every tile (all pyramid levels) in one SQLite file
+keyed by (level, row, col), so the index is also the resume closed list
+Workers encode tiles themselves and buffer them for the supertile
+then insert them in one transaction so the write lock is only held briefly
+'''
+
+from .image_coordinate_map import ImageCoordinateMap
+
+from PIL import Image
+import io
+import os
+import sqlite3
+
+# Seconds to wait on another process holding the write lock
+ARCHIVE_TIMEOUT = 600
+
+
+def pil_format(out_extension):
+    ret = Image.registered_extensions().get(out_extension.lower())
+    if ret is None:
+        raise Exception('Unknown tile extension %s' % out_extension)
+    return ret
+
+
+class TileDir(object):
+    def __init__(self, out_dir, out_extension='.jpg', pyramid_dir=None):
+        self.out_dir = out_dir
+        self.out_extension = out_extension
+        self.pyramid_dir = pyramid_dir
+
+    def get_name(self, level, row, col):
+        if level == 0:
+            out_dir = ''
+            if self.out_dir:
+                out_dir = '%s/' % self.out_dir
+            return '%sy%03d_x%03d%s' % (out_dir, row, col, self.out_extension)
+        return os.path.join(self.pyramid_dir, '%d' % level,
+                            'y%03d_x%03d%s' % (row, col, self.out_extension))
+
+    def has_output(self):
+        return os.path.exists(self.out_dir)
+
+    def setup(self, levels=0):
+        '''levels: number of pyramid levels above the base tiles'''
+        if os.path.exists(self.out_dir):
+            print("WARNING: merging out into existing output")
+        else:
+            os.mkdir(self.out_dir)
+        for level in range(1, levels + 1):
+            level_dir = os.path.join(self.pyramid_dir, '%d' % level)
+            if not os.path.exists(level_dir):
+                os.makedirs(level_dir)
+
+    def done_rc(self):
+        '''(row, col) of base tiles already written'''
+        icm = ImageCoordinateMap.from_dir_tagged_file_names(self.out_dir)
+        return [(row, col) for (col, row) in icm.gen_set()]
+
+    def save(self, level, row, col, im):
+        # http://www.pythonware.com/library/pil/handbook/format-jpeg.htm
+        # JPEG is a good quality vs disk space compromise but beware:
+        # The image quality, on a scale from 1 (worst) to 95 (best).
+        # The default is 75.
+        # Values above 95 should be avoided;
+        # 100 completely disables the JPEG quantization stage.
+        im.save(self.get_name(level, row, col), quality=95)
+
+    def exists(self, level, row, col):
+        return os.path.exists(self.get_name(level, row, col))
+
+    def load(self, level, row, col):
+        '''PIL image or None'''
+        fn = self.get_name(level, row, col)
+        if not os.path.exists(fn):
+            return None
+        return Image.open(fn)
+
+    def flush(self):
+        pass
+
+
+class TileArchive(object):
+    def __init__(self, fn, tw, th, rows, cols, out_extension='.jpg'):
+        self.fn = fn
+        self.tw = tw
+        self.th = th
+        self.rows = rows
+        self.cols = cols
+        self.out_extension = out_extension
+        self.format = pil_format(out_extension)
+        # Connections don't survive fork, open one per process
+        self.db = None
+        self.pid = None
+        # (level, row, col) => encoded tile not yet committed
+        self.buffered = {}
+
+    def conn(self):
+        if self.db is None or self.pid != os.getpid():
+            self.db = sqlite3.connect(self.fn, timeout=ARCHIVE_TIMEOUT)
+            self.pid = os.getpid()
+        return self.db
+
+    def get_name(self, level, row, col):
+        return '%s:%d/y%03d_x%03d' % (self.fn, level, row, col)
+
+    def has_output(self):
+        return os.path.exists(self.fn)
+
+    def setup(self, levels=0):
+        if os.path.exists(self.fn):
+            print("WARNING: merging tiles into existing archive %s" % self.fn)
+        db = self.conn()
+        db.execute('''CREATE TABLE IF NOT EXISTS tiles (
+                level INTEGER, row INTEGER, col INTEGER, data BLOB,
+                PRIMARY KEY (level, row, col))''')
+        db.execute('''CREATE TABLE IF NOT EXISTS metadata (
+                name TEXT PRIMARY KEY, value TEXT)''')
+        metadata = {
+            'format': self.format.lower(),
+            'tile_width': self.tw,
+            'tile_height': self.th,
+            'rows': self.rows,
+            'cols': self.cols,
+            'levels': levels,
+        }
+        db.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)',
+                       [(k, str(v)) for k, v in metadata.items()])
+        db.commit()
+
+    def done_rc(self):
+        '''(row, col) of base tiles already written'''
+        return self.conn().execute(
+            'SELECT row, col FROM tiles WHERE level = 0').fetchall()
+
+    def save(self, level, row, col, im):
+        buf = io.BytesIO()
+        im.save(buf, format=self.format, quality=95)
+        self.buffered[(level, row, col)] = buf.getvalue()
+
+    def exists(self, level, row, col):
+        if (level, row, col) in self.buffered:
+            return True
+        return self.conn().execute(
+            'SELECT 1 FROM tiles WHERE level = ? AND row = ? AND col = ?',
+            (level, row, col)).fetchone() is not None
+
+    def load(self, level, row, col):
+        '''PIL image or None'''
+        data = self.buffered.get((level, row, col))
+        if data is None:
+            this = self.conn().execute(
+                'SELECT data FROM tiles WHERE level = ? AND row = ? AND col = ?',
+                (level, row, col)).fetchone()
+            if this is None:
+                return None
+            data = this[0]
+        return Image.open(io.BytesIO(data))
+
+    def flush(self):
+        '''Commit buffered tiles in one transaction'''
+        if not self.buffered:
+            return
+        db = self.conn()
+        with db:
+            db.executemany(
+                'INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+                [(level, row, col, data)
+                 for (level, row, col), data in self.buffered.items()])
+        self.buffered = {}
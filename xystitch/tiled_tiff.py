@@ -0,0 +1,168 @@
+'''
+xystitch
+Copyright 2026 John McMaster <JohnDMcMaster@gmail.com>
+Licensed under a 2 clause BSD license, see COPYING for details
+'''
+'''
+Streaming tiled (Big)TIFF writer
+
+PIL can only save an image it holds in full
+so the single composite needed one canvas sized buffer (tens of GB on a big die)
+Here tiles are written as they come and only their offsets / sizes are kept
+The IFD goes at the end and the header is patched to point at it
+Classic TIFF is used when the uncompressed image fits in 32 bit offsets, otherwise BigTIFF
+Tiles are deflate compressed with horizontal differencing (predictor 2), or stored raw
+'''
+
+import numpy as np
+import struct
+import zlib
+
+COMPRESSION_NONE = 1
+COMPRESSION_DEFLATE = 8
+
+# Field types
+SHORT = 3
+LONG = 4
+LONG8 = 16
+
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_PLANAR_CONFIG = 284
+TAG_PREDICTOR = 317
+TAG_TILE_WIDTH = 322
+TAG_TILE_LENGTH = 323
+TAG_TILE_OFFSETS = 324
+TAG_TILE_BYTE_COUNTS = 325
+
+PHOTOMETRIC_RGB = 2
+PREDICTOR_HORIZONTAL = 2
+
+# Leave room for the IFD and deflate expanding incompressible data
+CLASSIC_MAX = 2**32 - 2**26
+
+
+class TiledTIFFWriter(object):
+    '''
+    Write a w x h RGB image as tw x th tiles
+    Tiles must be given a whole tile row at a time, top to bottom (see write_band())
+    '''
+    def __init__(self, fn, width, height, tw=256, th=256, deflate=True):
+        assert tw % 16 == 0 and th % 16 == 0, "TIFF tiles must be multiples of 16"
+        self.fn = fn
+        self.width = width
+        self.height = height
+        self.tw = tw
+        self.th = th
+        self.deflate = deflate
+        self.cols = (width + tw - 1) // tw
+        self.rows = (height + th - 1) // th
+        # Edge tiles are padded out to full size
+        self.big = self.cols * tw * self.rows * th * 3 >= CLASSIC_MAX
+        self.offsets = []
+        self.byte_counts = []
+        self.f = open(fn, 'wb')
+        # Placeholder until the IFD offset is known
+        self.f.write(self.header(0))
+
+    def header(self, ifd_offset):
+        if self.big:
+            return struct.pack('<2sHHHQ', b'II', 43, 8, 0, ifd_offset)
+        return struct.pack('<2sHI', b'II', 42, ifd_offset)
+
+    def encode(self, tile):
+        if not self.deflate:
+            return tile.tobytes()
+        diff = tile.copy()
+        # uint8 wraps, which is what predictor 2 expects
+        diff[:, 1:] -= tile[:, :-1]
+        return zlib.compress(diff.tobytes(), 6)
+
+    def write_band(self, band):
+        '''
+        Write the next tile row
+        band: (<= th, width, 3) uint8, the last one may be short
+        '''
+        assert len(self.offsets) < self.rows * self.cols, "Too many bands"
+        h = band.shape[0]
+        assert band.shape[1] == self.width and h <= self.th
+        for col in range(self.cols):
+            x0 = col * self.tw
+            x1 = min(x0 + self.tw, self.width)
+            # Edge tiles are still full size
+            tile = np.zeros((self.th, self.tw, 3), dtype=np.uint8)
+            tile[0:h, 0:x1 - x0] = band[:, x0:x1]
+            data = self.encode(tile)
+            self.offsets.append(self.f.tell())
+            self.byte_counts.append(len(data))
+            self.f.write(data)
+            # Keep data word aligned
+            if self.f.tell() % 2:
+                self.f.write(b'\0')
+
+    def entry(self, tag, typ, values):
+        '''Return (IFD entry, out of line data or None)'''
+        fmt = {SHORT: 'H', LONG: 'I', LONG8: 'Q'}[typ]
+        data = struct.pack('<%d%s' % (len(values), fmt), *values)
+        inline = 8 if self.big else 4
+        count_fmt = '<HHQ' if self.big else '<HHI'
+        head = struct.pack(count_fmt, tag, typ, len(values))
+        if len(data) <= inline:
+            return head + data.ljust(inline, b'\0'), None
+        return head, data
+
+    def close(self):
+        assert len(self.offsets) == self.rows * self.cols, "Missing bands"
+        off_type = LONG8 if self.big else LONG
+        tags = [
+            (TAG_IMAGE_WIDTH, LONG, [self.width]),
+            (TAG_IMAGE_LENGTH, LONG, [self.height]),
+            (TAG_BITS_PER_SAMPLE, SHORT, [8, 8, 8]),
+            (TAG_COMPRESSION, SHORT,
+             [COMPRESSION_DEFLATE if self.deflate else COMPRESSION_NONE]),
+            (TAG_PHOTOMETRIC, SHORT, [PHOTOMETRIC_RGB]),
+            (TAG_SAMPLES_PER_PIXEL, SHORT, [3]),
+            (TAG_PLANAR_CONFIG, SHORT, [1]),
+        ]
+        if self.deflate:
+            tags.append((TAG_PREDICTOR, SHORT, [PREDICTOR_HORIZONTAL]))
+        tags += [
+            (TAG_TILE_WIDTH, LONG, [self.tw]),
+            (TAG_TILE_LENGTH, LONG, [self.th]),
+            (TAG_TILE_OFFSETS, off_type, self.offsets),
+            (TAG_TILE_BYTE_COUNTS, off_type, self.byte_counts),
+        ]
+
+        f = self.f
+        if f.tell() % 2:
+            f.write(b'\0')
+        # Out of line values first so the IFD can point at them
+        entries = []
+        for tag, typ, values in tags:
+            head, data = self.entry(tag, typ, values)
+            if data is not None:
+                offset = f.tell()
+                f.write(data)
+                if f.tell() % 2:
+                    f.write(b'\0')
+                head += struct.pack('<Q' if self.big else '<I', offset)
+            entries.append(head)
+        ifd_offset = f.tell()
+        if self.big:
+            f.write(struct.pack('<Q', len(entries)))
+        else:
+            f.write(struct.pack('<H', len(entries)))
+        for head in entries:
+            f.write(head)
+        # No next IFD
+        f.write(struct.pack('<Q' if self.big else '<I', 0))
+        if not self.big:
+            assert f.tell() < 2**32, "Classic TIFF overflowed, should have been BigTIFF"
+        f.seek(0)
+        f.write(self.header(ifd_offset))
+        f.close()
+        self.f = None
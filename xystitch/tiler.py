@@ -43,7 +43,6 @@ Greedy algorithm to generate a tile if its legal (and safe)
 
 from xystitch.nona import Nona
 from xystitch.enblend import Enblend
-from .image_coordinate_map import ImageCoordinateMap
 from xystitch.config import config
 from xystitch.temp_file import ManagedTempFile
 from xystitch.temp_file import ManagedTempDir
@@ -52,15 +51,23 @@ from xystitch import pimage
 from xystitch.benchmark import Benchmark
 from xystitch.geometry import ceil_mult
 from xystitch.execute import CommandFailed
-from xystitch.pto.util import dbg, rm_red_img
-from xystitch.util import IOTimestamp
+from xystitch.pto.snapshot import ProjectSnapshot
+from xystitch.pto.util import dbg
+from xystitch.st_planner import plan_supertiles, axis_count
+from xystitch.st_admission import MemoryAdmission
+from xystitch.remap_cache import RemapCache, crop_blended
+from xystitch.pyramid import TilePyramid
+from xystitch.tile_sink import TileArchive, TileDir
+from xystitch import np_stitch
+from xystitch import st_store
+from xystitch.util import IOTimestamp, size2str
 
 import datetime
 import math
+import numpy as np
 import os
 import queue
 import psutil
-import subprocess
 import sys
 import multiprocessing
 import time
@@ -68,6 +75,12 @@ import traceback
 from PIL import Image
 
 
+# Supertile stitching
+BACKEND_HUGIN = 'hugin'
+BACKEND_NUMPY = 'numpy'
+BACKENDS = (BACKEND_HUGIN, BACKEND_NUMPY)
+
+
 class InvalidClip(Exception):
     pass
 
@@ -93,7 +106,7 @@ def pid_memory_recursive(pid, indent=""):
 
 class PartialStitcher(object):
     def __init__(self,
-                 pto,
+                 snapshot,
                  bounds,
                  out,
                  worki,
@@ -102,8 +115,12 @@ class PartialStitcher(object):
                  enblend_lock=False,
                  nona_args=[],
                  enblend_args=[],
-                 enblend_cache_mb=None):
-        self.pto = pto
+                 enblend_cache_mb=None,
+                 remap_cache=None,
+                 backend=BACKEND_HUGIN,
+                 np_blend=np_stitch.BLEND_MULTIBAND,
+                 np_levels=None):
+        self.snapshot = snapshot
         self.bounds = bounds
         self.out = out
         self.nona_args = nona_args
@@ -113,6 +130,13 @@ class PartialStitcher(object):
         self.work_run = work_run
         self.pprefix = pprefix
         self.enblend_cache_mb = enblend_cache_mb
+        # remap_cache.RemapCache to share remapped images between supertiles
+        self.remap_cache = remap_cache
+        self.backend = backend
+        self.np_blend = np_blend
+        self.np_levels = np_levels
+        # Supertile as a PIL image if it was stitched in process, otherwise its in out
+        self.im = None
 
     def run(self):
         '''
@@ -122,6 +146,9 @@ class PartialStitcher(object):
         but will only generate output for those that matter
         Each one takes a noticible amount of time but its relatively small compared to the time spent actually mapping images
         '''
+        if self.backend == BACKEND_NUMPY:
+            return self.run_numpy()
+
         print("")
         print('Supertile phase 1: remapping (nona)')
         if self.out.find('.') < 0:
@@ -141,50 +168,177 @@ class PartialStitcher(object):
             prefix_mangle='st_%06dx_%06dy_' % (self.bounds[0], self.bounds[1]))
         # without the slash they go into the parent directory with that prefix
         out_name_prefix = managed_temp_dir.file_name + "/"
-        '''
-        For large projects this was too slow
-        Instead, we simply copy the project and manually fix up the relevant portion
-        '''
-        print('Copying pto')
-        pto = self.pto.copy(control_points=False)
-        #pto = self.mini_pto.copy()
-
-        print('Cropping...')
-        #sys.exit(1)
-        pl = pto.panorama_line
-        # It is fine to go out of bounds, it will be black filled
-        #pl.set_bounds(x, min(x + self.tw(), pto.right()), y, min(y + self.th(), pto.bottom()))
-        pl.set_crop(self.bounds)
-        # try to fix remapper errors due to excessive overlap
-        rm_red_img(pto)
-        # print("Clean pto images: %u" % len(pto.get_image_lines()))
-        #print('debug break') ; sys.exit(1)
-
-        print('Preparing remapper...')
-        remapper = Nona(pto, out_name_prefix, pprefix=self.pprefix)
-        remapper.args = self.nona_args
-        print('Starting remapper...')
-        remapper.remap()
+        if self.remap_cache:
+            remap_files, blend_args = self.remap_cached(out_name_prefix)
+        else:
+            remapper = self.remap(out_name_prefix)
+            remap_files = remapper.get_output_files()
+            blend_args = []
         '''
         Phase 2: blend the remapped images into an output image
         '''
         print("")
         print('Supertile phase 2: blending (enblend) w/ %u images' %
-              len(remapper.get_output_files()))
-        blender = Enblend(remapper.get_output_files(),
+              len(remap_files))
+        blender = Enblend(remap_files,
                           self.out,
                           lock=self.enblend_lock,
                           pprefix=self.pprefix,
                           cache_mb=self.enblend_cache_mb)
         blender.args = self.enblend_args
+        blender.additional_args += blend_args
         blender.run()
+        if self.remap_cache:
+            self.im = crop_blended(self.out, self.bounds, remap_files)
         # We are done with these files, they should be nuked
-        if not config.keep_temp_files():
-            for f in remapper.get_output_files():
+        # Cached ones are removed by the master once no supertile needs them
+        if not config.keep_temp_files() and not self.remap_cache:
+            for f in remap_files:
                 os.remove(f)
 
         print('Supertile ready!')
 
+    def run_numpy(self):
+        '''Place and blend in process, no temp files'''
+        print("")
+        print('Supertile phase 1+2: numpy %s blend' % self.np_blend)
+        pto = self.snapshot.sub_project(self.bounds)
+        stitcher = np_stitch.NumpyStitcher(pto,
+                                           self.bounds,
+                                           blend=self.np_blend,
+                                           levels=self.np_levels)
+        self.im = stitcher.run()
+        print('Supertile ready!')
+
+    def remap(self, out_name_prefix):
+        '''
+        For large projects copying the project per supertile was too slow
+        Instead, emit a cropped sub-project from the shared snapshot
+        Only images that overlap this supertile are kept
+        This also fixes remapper errors due to excessive overlap
+        '''
+        print('Cropping...')
+        # It is fine to go out of bounds, it will be black filled
+        pto = self.snapshot.sub_project(self.bounds)
+
+        print('Preparing remapper...')
+        remapper = Nona(pto, out_name_prefix, pprefix=self.pprefix)
+        remapper.args = self.nona_args
+        print('Starting remapper...')
+        remapper.remap()
+        return remapper
+
+    def remap_cached(self, out_name_prefix):
+        '''
+        Remap only images no earlier supertile did
+        Cached images span past this supertile so enblend output is placed at it
+        and cropped back to it afterwards (crop_blended())
+        Returns (remapped files, extra enblend args)
+        '''
+        keep = self.snapshot.select(self.bounds)
+        print('Keeping %d / %d images' % (len(keep), self.snapshot.nimages()))
+        if len(keep) == 0:
+            raise Exception("Removed all images.  remapper will fail")
+        remap_files = self.remap_cache.remap(keep,
+                                             out_name_prefix,
+                                             pprefix=self.pprefix,
+                                             nona_args=self.nona_args)
+        x0, x1, y0, y1 = self.bounds
+        return remap_files, ['-f', '%dx%d+%d+%d' % (x1 - x0, y1 - y0, x0, y0)]
+
+
+class TileCutter(object):
+    '''
+    Chops a finished supertile into output tiles
+    Runs in the worker processes so tile encoding scales with threads
+    The master only gets back (row, col) of what was written
+    '''
+    def __init__(self, tw, th, sink, dry=False, verbose=False):
+        '''sink: tile_sink.TileDir or TileArchive'''
+        self.tw = tw
+        self.th = th
+        self.sink = sink
+        self.dry = dry
+        self.verbose = verbose
+
+    def get_name(self, row, col):
+        return self.sink.get_name(0, row, col)
+
+    def make_tile(self, im, x, y, row, col):
+        '''
+        Make a tile given an image, the upper left x and y coordinates in that image, and the global row/col indices
+        Return the RGB tile written (None if dry)
+        '''
+        if self.dry:
+            if self.verbose:
+                print('Dry: not making tile w/ x%d y%d r%d c%d' %
+                      (x, y, row, col))
+            return None
+        xmin = x
+        ymin = y
+        if isinstance(im, np.ndarray):
+            height, width = im.shape[:2]
+        else:
+            width, height = im.size
+        xmax = min(xmin + self.tw, width)
+        ymax = min(ymin + self.th, height)
+        nfn = self.get_name(row, col)
+
+        if self.verbose:
+            print('Subtile %s: (x %d:%d, y %d:%d)' %
+                  (nfn, xmin, xmax, ymin, ymax))
+        if isinstance(im, np.ndarray):
+            # Memory mapped supertile: only these rows are read
+            subimage = Image.fromarray(
+                np.ascontiguousarray(im[ymin:ymax, xmin:xmax]))
+        else:
+            subimage = pimage.subimage(im, xmin, xmax, ymin, ymax)
+        '''
+        Images must be padded
+        If they aren't they will be stretched in google maps
+        '''
+        if subimage.size[0] != self.tw or subimage.size[1] != self.th:
+            dbg('WARNING: %s: expanding partial tile (%d X %d) to full tile size'
+                % (nfn, subimage.size[0], subimage.size[1]))
+            subimage = pimage.set_canvas_size(subimage, self.tw, self.th)
+        if subimage.mode != 'RGB':
+            subimage = subimage.convert('RGB')
+        self.sink.save(0, row, col, subimage)
+        return subimage
+
+    def cut(self, im, st_bounds, tiles, pyramid=None):
+        '''
+        im: PIL image or (h, w, 3) array (see st_store.load())
+        tiles: list of (y, x, row, col) wanted from this supertile
+        x and y are in whole pano coords
+        pyramid: pyramid.TilePyramid to feed tiles into
+        Return list of (row, col) written
+        '''
+        bench = Benchmark()
+        x0, _x1, y0, _y1 = st_bounds
+        print("")
+        print('Phase 4: chopping up supertile x%u:%u y%u:%u into %u tiles' %
+              (st_bounds[0], st_bounds[1], st_bounds[2], st_bounds[3],
+               len(tiles)))
+
+        # FIXME: causes issues saving .jpg
+        # think only in newer ubuntu (ie 20.04 but not 16.04)
+        if isinstance(im, Image.Image) and im.mode == "RGBA":
+            im = pimage.rgba2rgb(im)
+
+        ret = []
+        for (y, x, row, col) in tiles:
+            # we need to adjust to our frame
+            # row and col on the other hand are used for global naming
+            tile = self.make_tile(im, x - x0, y - y0, row, col)
+            if pyramid and tile is not None:
+                pyramid.add(0, row, col, np.asarray(tile))
+            ret.append((row, col))
+        self.sink.flush()
+        bench.stop()
+        print('Generated %d tiles in %s' % (len(ret), str(bench)))
+        return ret
+
 
 class Worker(object):
     def __init__(self, i, tiler, log_fn, worker_stdout=None):
@@ -204,10 +358,17 @@ class Worker(object):
         self.dry = tiler.dry
         self.ignore_errors = tiler.ignore_errors
         self.st_dir = tiler.st_dir
-        self.pto = tiler.pto
+        self.st_format = tiler.st_format
+        self.snapshot = tiler.snapshot
+        self.remap_cache = tiler.remap_cache
+        self.backend = tiler.backend
+        self.np_blend = tiler.np_blend
+        self.np_levels = tiler.np_levels
         self.enblend_lock = tiler.enblend_lock
         self.nona_args = tiler.nona_args
         self.enblend_args = tiler.enblend_args
+        self.cutter = tiler.tile_cutter()
+        self.pyramid = tiler.pyramid
         self.st_fns = multiprocessing.Queue()
         self.outdate = None
         self.errdate = None
@@ -276,7 +437,7 @@ class Worker(object):
                     continue
 
                 try:
-                    (st_bounds, ) = task
+                    (st_bounds, tiles) = task
 
                     print("")
                     print("")
@@ -288,8 +449,13 @@ class Worker(object):
                     _outlog and _outlog.flush()
 
                     try:
-                        img_fn = self.try_supertile(st_bounds)
-                        self.qo.put(('done', (st_bounds, img_fn)))
+                        # Parents that straddle supertiles go back to the master
+                        pyramid = self.pyramid and self.pyramid.local()
+                        tiles_rc = self.try_supertile(st_bounds, tiles,
+                                                      pyramid)
+                        pyramid_out = pyramid and pyramid.export()
+                        self.qo.put(
+                            ('done', (st_bounds, tiles_rc, pyramid_out)))
                         messages_tx += 1
                     except CommandFailed as e:
                         if not self.ignore_errors:
@@ -315,8 +481,13 @@ class Worker(object):
                 _outlog.close()
                 _outlog = None
 
-    def try_supertile(self, st_bounds):
-        '''x0/1 and y0/1 are global absolute coordinates'''
+    def try_supertile(self, st_bounds, tiles, pyramid=None):
+        '''
+        x0/1 and y0/1 are global absolute coordinates
+        tiles: (y, x, row, col) the master still needs from this supertile
+        pyramid: pyramid.TilePyramid to feed tiles into
+        Returns list of (row, col) tiles written
+        '''
         # First generate all of the valid tiles across this area to see if we can get any useful work done?
         # every supertile should have at least one solution or the bounds aren't good
         x0, x1, y0, y1 = st_bounds
@@ -324,24 +495,24 @@ class Worker(object):
         self.bench = Benchmark()
         try:
             if self.st_dir:
-                # nah...tiff takes up too much space
-                dst = os.path.join(self.st_dir,
-                                   'st_%06dx_%06dy.jpg' % (x0, y0))
-                if os.path.exists(dst):
-                    # normally this is a .tif so slight loss in quality
-                    # img = PImage.from_file(dst)
-                    print('supertile short circuit on already existing: %s' %
-                          (dst, ))
-                    return dst
-
-            # st_081357x_000587y.jpg
+                dst = st_store.st_fn(self.st_dir, x0, y0, self.st_format)
+                # Either format will do to resume
+                for fmt in st_store.FORMATS:
+                    fn = st_store.st_fn(self.st_dir, x0, y0, fmt)
+                    if os.path.exists(fn):
+                        print('supertile short circuit on already existing: %s'
+                              % (fn, ))
+                        return self.cutter.cut(st_store.load(fn), st_bounds,
+                                               tiles, pyramid)
+
+            # st_081357x_000587y_*.tif
             temp_file = ManagedTempFile.get(None,
                                             '.tif',
                                             prefix_mangle='st_%06dx_%06dy_' %
                                             (x0, y0))
 
             enblend_cache_mb = int(config.max_mem() / 1e6 / self.threads)
-            stitcher = PartialStitcher(self.pto,
+            stitcher = PartialStitcher(self.snapshot,
                                        st_bounds,
                                        temp_file.file_name,
                                        self.i,
@@ -350,7 +521,11 @@ class Worker(object):
                                        enblend_lock=self.enblend_lock,
                                        nona_args=self.nona_args,
                                        enblend_args=self.enblend_args,
-                                       enblend_cache_mb=enblend_cache_mb)
+                                       enblend_cache_mb=enblend_cache_mb,
+                                       remap_cache=self.remap_cache,
+                                       backend=self.backend,
+                                       np_blend=self.np_blend,
+                                       np_levels=self.np_levels)
 
             if self.dry:
                 print('dry: skipping partial stitch')
@@ -362,51 +537,22 @@ class Worker(object):
             print('phase 3: loading supertile image')
             if self.dry:
                 print('dry: skipping loading PTO')
-                img_fn = None
+                im = None
             else:
+                if stitcher.im is not None:
+                    im = stitcher.im
+                    print('Supertile done in memory')
+                else:
+                    # Tiles are cut here rather than in the master
+                    # temp_file is deleted once we return
+                    im = Image.open(temp_file.file_name)
+                    im.load()
+                    print('Supertile done w/ fn %s' %
+                          (temp_file.file_name, ))
                 if self.st_dir:
+                    st_store.save(dst, im)
                     self.st_fns.put(dst)
-
-                    #shutil.copyfile(temp_file.file_name, dst)
-                    args = [
-                        'convert', '-quality', '90', temp_file.file_name, dst
-                    ]
-                    print('going to execute: %s' % (args, ))
-                    subp = subprocess.Popen(args,
-                                            stdout=None,
-                                            stderr=None,
-                                            shell=False)
-                    subp.communicate()
-                    if subp.returncode != 0:
-                        raise Exception('Failed to copy stitched file')
-
-                    # having some problems that looks like file isn't getting written to disk
-                    # monitoring for such errors
-                    # remove if I can root cause the source of these glitches
-                    for i in range(30):
-                        if os.path.exists(dst):
-                            break
-                        if i == 0:
-                            print(
-                                'WARNING: soften missing strong blur dest file name %s, waiting a bit...'
-                                % (dst, ))
-                        time.sleep(0.1)
-                    else:
-                        raise Exception(
-                            'Missing soften strong blur output file name %s' %
-                            dst)
-
-                # FIXME: was passing loaded image object
-                # Directory should delete on exit
-                # otherwise parent can delete it
-                #img = PImage.from_file(temp_file.file_name)
-                img_fn = temp_file.file_name
-                # prevent deletion
-                temp_file.file_name = ''
-
-                #print('supertile width: %d, height: %d' % (img.width(), img.height())
-                print('Supertile done w/ fn %s' % (img_fn, ))
-            return img_fn
+            return self.cutter.cut(im, st_bounds, tiles, pyramid)
         except:
             print('supertile failed at %s' % (self.bench, ))
             raise
@@ -463,15 +609,39 @@ class Tiler:
         self.clip_width = clip_width
         self.clip_height = clip_height
         self.st_dir = None
+        self.st_format = st_store.FMT_NPY
         self.nona_args = []
         self.enblend_args = []
         self.threads = 1
         self.workers = None
+        # Admit supertiles against config.max_mem() instead of a fixed worker count
+        self.mem_admission = False
+        # st_admission.MemoryAdmission while running
+        self.admission = None
+        # Share remapped images between overlapping supertiles
+        self.use_remap_cache = False
+        # remap_cache.RemapCache while running
+        self.remap_cache = None
+        self.remap_cache_dir = None
+        # How supertiles are stitched, see set_backend()
+        self.backend = BACKEND_HUGIN
+        self.np_blend = np_stitch.BLEND_MULTIBAND
+        self.np_levels = None
+        # Write zoom levels here as tiles are cut, see set_pyramid_dir()
+        self.pyramid_dir = None
+        # pyramid.TilePyramid while running
+        self.pyramid = None
+        # Put tiles in this one file instead of out_dir, see set_tile_archive()
+        self.tile_archive = None
+        # tile_sink.TileDir or TileArchive
+        self.sink = None
 
         self.open_list_rc = None
         self.closed_list_rc = None
 
         self.st_fns = []
+        # st_planner.SupertilePlan if stp was given
+        self.st_plan = None
         self.st_limit = float('inf')
         self.log_dir = log_dir
         self.this_tiles_done = 0
@@ -564,6 +734,11 @@ class Tiler:
     def set_st_dir(self, st_dir):
         self.st_dir = str(st_dir)
 
+    def set_st_format(self, st_format):
+        if st_format not in st_store.FORMATS:
+            raise Exception('Bad supertile format %s' % st_format)
+        self.st_format = st_format
+
     def set_out_extension(self, out_extension):
         self.out_extension = str(out_extension)
 
@@ -597,122 +772,72 @@ class Tiler:
     def set_enblend_lock(self, enblend_lock):
         self.enblend_lock = bool(enblend_lock)
 
+    def set_mem_admission(self, mem_admission):
+        self.mem_admission = bool(mem_admission)
+
+    def set_remap_cache(self, use_remap_cache):
+        self.use_remap_cache = bool(use_remap_cache)
+
+    def set_pyramid_dir(self, pyramid_dir):
+        '''
+        Also build a zoom pyramid in pyramid_dir (None to disable)
+        With a tile archive the levels go in the archive instead
+        '''
+        self.pyramid_dir = pyramid_dir and str(pyramid_dir)
+
+    def set_tile_archive(self, tile_archive):
+        '''Write tiles to SQLite file tile_archive instead of out_dir (None for out_dir)'''
+        self.tile_archive = tile_archive and str(tile_archive)
+
+    def set_backend(self, backend, np_blend=None, np_levels=None):
+        '''
+        backend: BACKEND_HUGIN (nona + enblend) or BACKEND_NUMPY (in process, translation only)
+        np_blend / np_levels: see np_stitch.NumpyStitcher
+        '''
+        if backend not in BACKENDS:
+            raise Exception('Bad backend %s' % backend)
+        self.backend = backend
+        if np_blend:
+            self.np_blend = np_blend
+        self.np_levels = np_levels
+
     def calc_stp(self, stp):
         if self.stw or self.sth:
             raise ValueError("Can't manually specify width/height and do auto")
         '''
         Given an area and a length and width, find the optimal tile sizes
-        such that there are the least amount of tiles but they cover all area
-        with each tile being as small as possible
-        
+        See st_planner for the cost model
+
         Generally get better results if things remain square
         Long rectangular sections that can fit a single tile easily should
             Idea: don't let tile sizes get past aspect ratio of 2:1
-        
-        Take the smaller dimension
         '''
         # Maximum h / w or w / h
         aspect_max = 2.0
         w = self.width()
         h = self.height()
         a = w * h
-        '''
-        w = h / a
-        p = w * h = (h / a) * h
-        p * a = h**2, h = (p * a)**0.5
-        '''
-        min_stwh = int((stp / aspect_max)**0.5)
-        max_stwh = int((stp * aspect_max)**0.5)
         print('Maximum supertile width/height: %d w/ square @ %d' %
-              (max_stwh, int(stp**0.5)))
+              (int((stp * aspect_max)**0.5), int(stp**0.5)))
         # Theoretical number of tiles if we had no overlap
         theoretical_tiles = a * 1.0 / stp
         print('Net area %d (%dw X %dh) requires at least ceil(%g) tiles' % \
                 (a, w, h, theoretical_tiles))
-        aspect = 1.0 * w / h
-        # Why not just run a bunch of sims and take the best...
-        if 0:
-            '''
-            Take a rough shape of the canvas and then form rectangles to match
-            '''
-            if aspect >= 2.0:
-                print('width much larger than height')
-            elif aspect <= 0.5:
-                print('Height much larger than width')
-            else:
-                print('Squarish canvas, forming squares')
-        self.sweep_st_optimizer(stp, min_stwh, max_stwh)
-        self.trim_stwh()
-
-    def sweep_st_optimizer(self, stp, min_stwh, max_stwh):
-        # Keep each tile size constant
-        print('Sweeping tile size optimizer')
-        best_w = None
-        best_h = None
-        self.best_n = None
-        best_sts = None
-        # Get the lowest perimeter among n
-        # Errors occur around edges
-        best_p = None
-        # Arbitrary step at 1000
-        # Even for large sets we want to optimize
-        # for small sets we don't care
-        for check_w in range(min_stwh, max_stwh, 100):
-            check_h = stp / check_w
-            self.verbose and print(
-                'Checking supertile size %dw X %dh (area %d)' %
-                (check_w, check_h, check_w * check_h))
-            try:
-                tiler = Tiler(pto=self.pto,
-                              out_dir=self.out_dir,
-                              tile_width=self.tw,
-                              tile_height=self.th,
-                              dry=True,
-                              stw=check_w,
-                              sth=check_h,
-                              stp=None,
-                              clip_width=self.clip_width,
-                              clip_height=self.clip_height)
-            except InvalidClip as e:
-                print('Discarding: invalid clip: %s' % (e, ))
-                print()
-                continue
-
-            # The area will float around a little due to truncation
-            # Its better to round down than up to avoid running out of memory
-            n_expected = tiler.expected_sts()
-            # XXX: is this a bug or something that I should just skip?
-            if n_expected == 0:
-                print('Invalid STs 0')
-                print()
-                continue
-
-            p = (check_w + check_h) * 2
-            self.verbose and print(
-                'Would generate %d supertiles each with perimeter %d' %
-                (n_expected, p))
-            # TODO: there might be some optimizations within this for trimming...
-            # Add a check for minimum total mapped area
-            if self.best_n is None or self.best_n > n_expected or (
-                    self.best_n == n_expected and best_p > p):
-                self.best_n = n_expected
-                best_w = check_w
-                best_h = check_h
-                best_p = p
-                best_sts = list(tiler.gen_supertiles())
-                if n_expected == 1:
-                    print('Only 1 ST: early break')
-                    break
-            self.verbose and print("")
-
-        if self.best_n is None:
-            raise Exception("Failed to find stitch solution")
-        print('Best n %d w/ %dw X %dh' % (self.best_n, best_w, best_h))
-        for x0, x1, y0, y1 in best_sts:
-            print("  st %ux0 %ux1 %uy0 %uy1" % (x0, x1, y0, y1))
-
-        self.stw = best_w
-        self.sth = best_h
+        self.st_plan = plan_supertiles(width=w,
+                                       height=h,
+                                       img_width=self.img_width,
+                                       img_height=self.img_height,
+                                       nimages=len(self.pto.image_lines),
+                                       tile_width=self.tw,
+                                       tile_height=self.th,
+                                       clip_width=self.clip_width,
+                                       clip_height=self.clip_height,
+                                       stp=stp,
+                                       aspect_max=aspect_max,
+                                       verbose=self.verbose)
+        self.st_plan.show()
+        self.stw = self.st_plan.stw
+        self.sth = self.st_plan.sth
 
     def msg(self, s, l):
         '''print(message s at verbosity level l'''
@@ -721,77 +846,9 @@ class Tiler:
 
     def expected_sts(self):
         '''Number of expected supertiles'''
-        return len(list(self.gen_supertiles()))
-
-    def trim_stwh(self):
-        '''
-        Supertiles may be larger than the margins
-        If so it just slows down stitching with a lot of stuff getting thrown away
-        
-        Each time a supertile is added we lose one overlap unit
-        ideally canvas w = n * stw - (n - 1) * overlap
-        Before running this function stw may be oversized
-        '''
-        self.recalc_step()
-        orig_st_area = self.stw * self.sth
-        orig_net_area = self.expected_sts() * orig_st_area
-        orig_stw = self.stw
-        orig_sth = self.sth
-
-        # eliminate corner cases by only trimming when it can do any good
-        print('Trimming %d supertiles' % self.best_n)
-        if self.best_n <= 1:
-            print('Only one ST: not trimming')
-            return
-
-        if 0:
-            # First one is normal but each additional takes a clip
-            w_sts = int(1 + math.ceil(1.0 * (self.width() - self.stw) /
-                                      (self.stw - self.super_t_xstep)))
-            h_sts = int(1 + math.ceil(1.0 * (self.height() - self.sth) /
-                                      (self.sth - self.super_t_ystep)))
-            print('%dw X %dh supertiles originally' % (w_sts, h_sts))
-            #total_clip_width = self.clip_width *
-        else:
-            h_sts = 0
-            h_extra = 0
-            for y in range(self.top(), self.bottom(), self.super_t_ystep):
-                h_sts += 1
-                y1 = y + self.sth
-                if y1 >= self.bottom():
-                    h_extra = y1 - self.bottom()
-                    break
-
-            w_sts = 0
-            w_extra = 0
-            for x in range(self.left(), self.right(), self.super_t_xstep):
-                w_sts += 1
-                x1 = x + self.stw
-                if x1 >= self.right():
-                    w_extra = x1 - self.right()
-                    break
-            print('  %u width tiles waste %u pixels' % (w_sts, w_extra))
-            self.stw = int(math.ceil(self.stw - w_extra / w_sts))
-            print('  %u height tiles waste %u pixels' % (h_sts, h_extra))
-            self.sth = int(math.ceil(self.sth - h_extra / h_sts))
-            # Since we messed with the tile width the step needs recalc
-            self.recalc_step()
-
-        new_st_area = self.stw * self.sth
-        new_net_area = self.expected_sts() * new_st_area
-        print('Final supertile trim results:')
-        print('  Width %d => %d (%g%% of original)' %
-              (orig_stw, self.stw, 100.0 * self.stw / orig_stw))
-        print('  Height %d => %d (%g%% of original)' %
-              (orig_sth, self.sth, 100.0 * self.sth / orig_sth))
-        print('  ST area %d => %d (%g%% of original)' %
-              (orig_st_area, new_st_area, 100.0 * new_st_area / orig_st_area))
-        print('  Net area %d => %d (%g%% of original)' %
-              (orig_net_area, new_net_area,
-               100.0 * new_net_area / orig_net_area))
-        # Should not have changed how many
-        assert self.best_n == self.expected_sts(), (
-            "Optimizer went too far :(", self.best_n, self.expected_sts())
+        return axis_count(self.width(), self.stw,
+                          self.super_t_xstep) * axis_count(
+                              self.height(), self.sth, self.super_t_ystep)
 
     def make_full(self):
         '''Stitch a single supertile'''
@@ -903,30 +960,38 @@ class Tiler:
                     continue
                 yield (y, x)
 
-    def process_image(self, img_fn, im, st_bounds):
+    def tile_sink(self):
+        if self.sink is None:
+            if self.tile_archive:
+                self.sink = TileArchive(self.tile_archive,
+                                        self.tw,
+                                        self.th,
+                                        self.rows(),
+                                        self.cols(),
+                                        out_extension=self.out_extension)
+            else:
+                self.sink = TileDir(self.out_dir,
+                                    out_extension=self.out_extension,
+                                    pyramid_dir=self.pyramid_dir)
+        return self.sink
+
+    def tile_cutter(self):
+        return TileCutter(self.tw,
+                          self.th,
+                          self.tile_sink(),
+                          dry=self.dry,
+                          verbose=self.verbose)
+
+    def supertile_tiles_todo(self, st_bounds):
         '''
         A tile is valid if its in a safe location
         There are two ways for the location to be safe:
         -No neighboring tiles as found on canvas edges
         -Sufficiently inside the blend area that artifacts should be minimal
-        '''
-        bench = Benchmark()
-        [x0, x1, y0, y1] = st_bounds
-        gen_tiles = 0
-        print("")
-        # TODO: get the old info back if I miss it after yield refactor
-        print('Phase 4: chopping up supertile x%u:%u y%u:%u' %
-              (x0, x1, y0, y1))
-        print("  Supertile: %s" % (img_fn, ))
-        self.msg('step(x: %d, y: %d)' % (self.tw, self.th), 3)
-        #self.msg('x in xrange(%d, %d, %d)' % (xt0, xt1, self.tw), 3)
-        #self.msg('y in xrange(%d, %d, %d)' % (yt0, yt1, self.th), 3)
-
-        # FIXME: causes issues saving .jpg
-        # think only in newer ubuntu (ie 20.04 but not 16.04)
-        if im.mode == "RGBA":
-            im = pimage.rgba2rgb(im)
 
+        Return (y, x, row, col) for valid tiles not yet done
+        '''
+        ret = []
         for (y, x) in self.gen_supertile_tiles(st_bounds):
             # If we made it this far the tile can be constructed with acceptable enblend artifacts
             row = self.y2row(y)
@@ -939,62 +1004,33 @@ class Tiler:
                     print('Rejecting tile x%d, y%d / r%d, c%d: already done' %
                           (x, y, row, col))
                 continue
+            ret.append((y, x, row, col))
+        return ret
 
-            # note that x and y are in whole pano coords
-            # we need to adjust to our frame
-            # row and col on the other hand are used for global naming
-            self.make_tile(im, x - x0, y - y0, row, col)
-            gen_tiles += 1
-        bench.stop()
-        print('Generated %d new tiles for a total of %d / %d in %s' %
-              (gen_tiles, len(
-                  self.closed_list_rc), self.net_expected_tiles, str(bench)))
-        if gen_tiles == 0:
+    def process_tiles_rc(self, tiles_rc):
+        '''Master side bookkeeping for tiles written by a worker'''
+        for (row, col) in tiles_rc:
+            self.mark_done_rc(row, col)
+        print('Generated %d new tiles for a total of %d / %d' %
+              (len(tiles_rc), len(self.closed_list_rc),
+               self.net_expected_tiles))
+        if len(tiles_rc) == 0:
             raise NoTilesGenerated("Didn't generate any tiles")
-        # temp_file should be automatically deleted upon exit
-        # WARNING: not all are tmp files, some may be recycled supertiles
+
+    def process_image(self, img_fn, im, st_bounds):
+        '''Chop up a supertile in this process (ex: recovering from a supertile dir)'''
+        print("  Supertile: %s" % (img_fn, ))
+        self.msg('step(x: %d, y: %d)' % (self.tw, self.th), 3)
+        tiles = self.supertile_tiles_todo(st_bounds)
+        tiles_rc = self.tile_cutter().cut(im, st_bounds, tiles, self.pyramid)
+        self.process_tiles_rc(tiles_rc)
 
     def get_name(self, row, col):
-        out_dir = ''
-        if self.out_dir:
-            out_dir = '%s/' % self.out_dir
-        return '%sy%03d_x%03d%s' % (out_dir, row, col, self.out_extension)
+        return self.tile_cutter().get_name(row, col)
 
     def make_tile(self, im, x, y, row, col):
         '''Make a tile given an image, the upper left x and y coordinates in that image, and the global row/col indices'''
-        if self.dry:
-            if self.verbose:
-                print('Dry: not making tile w/ x%d y%d r%d c%d' %
-                      (x, y, row, col))
-            return
-        xmin = x
-        ymin = y
-        width, height = im.size
-        xmax = min(xmin + self.tw, width)
-        ymax = min(ymin + self.th, height)
-        nfn = self.get_name(row, col)
-
-        if self.verbose:
-            print('Subtile %s: (x %d:%d, y %d:%d)' %
-                  (nfn, xmin, xmax, ymin, ymax))
-        subimage = pimage.subimage(im, xmin, xmax, ymin, ymax)
-        '''
-        Images must be padded
-        If they aren't they will be stretched in google maps
-        '''
-        if subimage.size[0] != self.tw or subimage.size[1] != self.th:
-            dbg('WARNING: %s: expanding partial tile (%d X %d) to full tile size'
-                % (nfn, subimage.size[0], subimage.size[1]))
-            subimage = pimage.set_canvas_size(subimage, self.tw, self.th)
-        # http://www.pythonware.com/library/pil/handbook/format-jpeg.htm
-        # JPEG is a good quality vs disk space compromise but beware:
-        # The image quality, on a scale from 1 (worst) to 95 (best).
-        # The default is 75.
-        # Values above 95 should be avoided;
-        # 100 completely disables the JPEG quantization stage.
-        if subimage.mode != 'RGB':
-            subimage = subimage.convert('RGB')
-        subimage.save(nfn, quality=95)
+        self.tile_cutter().make_tile(im, x, y, row, col)
         self.mark_done_rc(row, col)
 
     def x2col(self, x):
@@ -1157,13 +1193,12 @@ class Tiler:
 
     def seed_merge(self):
         '''Add all already generated tiles to the closed list'''
-        icm = ImageCoordinateMap.from_dir_tagged_file_names(self.out_dir)
-        # may be incomplete, but it shouldn't be larger
-        assert icm.rows <= self.rows() and icm.cols <= self.cols(
-        ), "%u rows, %u cols but icm %u rows, %u cols" % (
-            self.rows(), self.cols(), icm.rows, icm.cols)
         already_done = 0
-        for (col, row) in icm.gen_set():
+        for (row, col) in self.tile_sink().done_rc():
+            # may be incomplete, but it shouldn't be larger
+            assert row < self.rows() and col < self.cols(
+            ), "%u rows, %u cols but have tile r%u c%u" % (
+                self.rows(), self.cols(), row, col)
             self.mark_done_rc(row, col, False)
             already_done += 1
         print('Map seeded with %d already done tiles' % already_done)
@@ -1256,10 +1291,12 @@ class Tiler:
 
     def profile(self):
         mem_net = 0
-        for worker in self.workers:
+        for wi, worker in enumerate(self.workers):
             # mem_worker = worker.process.memory_info().rss
             mem_worker = pid_memory_recursive(worker.process.pid)
             self.mem_worker_max = max(self.mem_worker_max, mem_worker)
+            if self.admission:
+                self.admission.update(wi, mem_worker)
             mem_net += mem_worker
         self.mem_net_max = max(self.mem_net_max, mem_net)
         self.mem_net_last = mem_net
@@ -1293,6 +1330,8 @@ class Tiler:
         print("  mem_net_last %0.3f GB" % (self.mem_net_last / 1e9, ))
         print("  mem_net_max %0.3f GB" % (self.mem_net_max / 1e9, ))
         print("  mem_worker_max %0.3f GB" % (self.mem_worker_max / 1e9, ))
+        if self.admission:
+            print("  %s" % (self.admission, ))
 
     def loop_setup(self):
         self.mem_net_last = 0
@@ -1318,7 +1357,7 @@ class Tiler:
 
         print('Input images width %d, height %d' %
               (self.img_width, self.img_height))
-        print('Output to %s' % self.out_dir)
+        print('Output to %s' % (self.tile_archive or self.out_dir, ))
         print('Super tile width %d, height %d' % (self.stw, self.sth))
         print('Super tile x step %d, y step %d' %
               (self.super_t_xstep, self.super_t_ystep))
@@ -1342,15 +1381,16 @@ class Tiler:
 
         self.main_bench = Benchmark()
 
-        if os.path.exists(self.out_dir):
+        if self.tile_sink().has_output():
             self.seed_merge()
 
         if not self.dry:
+            if self.pyramid_dir:
+                self.pyramid = TilePyramid(self.rows(), self.cols(), self.tw,
+                                           self.th, self.tile_sink())
+                print('Pyramid: %u levels' % (self.pyramid.top(), ))
             # Scrub old dir if we don't want it
-            if os.path.exists(self.out_dir):
-                print("WARNING: merging out into existing output")
-            else:
-                os.mkdir(self.out_dir)
+            self.tile_sink().setup(self.pyramid.top() if self.pyramid else 0)
             if os.path.exists(self.st_dir):
                 print("WARNING: merging st into existing output")
             else:
@@ -1368,6 +1408,27 @@ class Tiler:
             print("Reducing max worker threads %u to match ST count %u" %
                   (self.threads, self.n_expected_sts))
             self.threads = self.n_expected_sts
+        # Build before forking so all workers share one copy
+        print('Building project snapshot')
+        self.snapshot = ProjectSnapshot(self.pto)
+        if self.backend == BACKEND_NUMPY:
+            reason = np_stitch.unsupported(self.pto)
+            if reason:
+                print('WARNING: numpy backend needs a translation only project (%s)' %
+                      reason)
+                print('Falling back to nona + enblend')
+                self.backend = BACKEND_HUGIN
+            else:
+                print('Stitching supertiles in process (numpy %s blend)' %
+                      self.np_blend)
+        if self.use_remap_cache and self.backend == BACKEND_HUGIN:
+            self.remap_cache_dir = ManagedTempDir.get2(prefix_mangle='remap_')
+            self.remap_cache = RemapCache(self.remap_cache_dir.file_name,
+                                          self.snapshot)
+            for st_bounds in self.gen_supertiles():
+                self.remap_cache.add_refs(self.snapshot.select(st_bounds))
+            print('Remap cache: %s, %u images' %
+                  (self.remap_cache_dir.file_name, len(self.remap_cache.refs)))
         print("Initializing %d workers" % self.threads)
         self.workers = []
         for ti in range(self.threads):
@@ -1398,6 +1459,11 @@ class Tiler:
         #temp_file = 'partial.tif'
         self.n_supertiles_allocated = 0
         self.st_gen = self.gen_supertiles()
+        # [st_bounds, tiles, st number, pixels, images, times passed over] waiting for memory
+        self.st_pending = []
+        if self.mem_admission:
+            self.admission = MemoryAdmission(config.max_mem())
+            print('Memory admission: %s' % (self.admission, ))
 
         self.all_allocated = False
         self.last_progress = time.time()
@@ -1406,6 +1472,108 @@ class Tiler:
         self.pair_complete = 0
         self.idle = False
 
+    def next_supertile(self):
+        '''Return the next (st_bounds, tiles, st number) with tiles still to do, None when out'''
+        while True:
+            try:
+                st_bounds = next(self.st_gen)
+            except StopIteration:
+                return None
+
+            [x0, x1, y0, y1] = st_bounds
+            self.n_supertiles_allocated += 1
+            tiles = self.supertile_tiles_todo(st_bounds)
+            print('M: check st %u (x(%d:%d) y(%d:%d)) want %u / %u tiles' %
+                  (self.n_supertiles_allocated, x0, x1, y0, y1, len(tiles),
+                   self.n_supertile_tiles(st_bounds)))
+            if not tiles:
+                print(
+                    'WARNING: skipping supertile %d as it would not generate any new tiles'
+                    % self.n_supertiles_allocated)
+                self.closed_sts.add(tuple(st_bounds))
+                self.st_release(st_bounds)
+                continue
+            return st_bounds, tiles, self.n_supertiles_allocated
+
+    def st_release(self, st_bounds):
+        '''Supertile is finished one way or another'''
+        if self.remap_cache:
+            self.remap_cache.release(self.snapshot.select(st_bounds))
+
+    def submit(self, wi, st_bounds, tiles, sti):
+        [x0, x1, y0, y1] = st_bounds
+        print('*' * 80)
+        #print('W%d: submit %s (%d / %d)' % (wi, repr(pair), self.pair_submit, n_pairs)
+        print("Creating supertile %d / %d with x%d:%d, y%d:%d" %
+              (sti, self.n_expected_sts, x0, x1, y0, y1))
+        print('W%d: submit' % (wi, ))
+
+        self.workers[wi].qi.put((st_bounds, tiles))
+        self.pair_submit += 1
+
+    def allocate(self):
+        '''Keep every worker queue fed'''
+        progress = False
+        for wi, worker in enumerate(self.workers):
+            if self.all_allocated:
+                break
+            if worker.qi.empty():
+                st = self.next_supertile()
+                if st is None:
+                    print('All tasks allocated')
+                    self.all_allocated = True
+                    break
+                progress = True
+                self.submit(wi, *st)
+        return progress
+
+    def allocate_admission(self):
+        '''
+        Hand supertiles to idle workers while they fit in the memory budget
+        Looks a few supertiles ahead so small (edge) ones can run next to a big one
+        But once the oldest one has been passed over enough nothing else jumps it
+        '''
+        progress = False
+        while len(self.st_pending) < len(self.workers):
+            st = self.next_supertile()
+            if st is None:
+                break
+            st_bounds, tiles, sti = st
+            (x0, x1, y0, y1) = st_bounds
+            pixels = (x1 - x0) * (y1 - y0)
+            images = len(self.snapshot.select(st_bounds))
+            self.st_pending.append([st_bounds, tiles, sti, pixels, images, 0])
+        if not self.st_pending:
+            if not self.all_allocated:
+                print('All tasks allocated')
+                self.all_allocated = True
+            return progress
+
+        for wi in range(len(self.workers)):
+            if wi in self.admission.running:
+                continue
+            for pi, (st_bounds, tiles, sti, pixels, images,
+                     _skips) in enumerate(self.st_pending):
+                if self.st_pending[0][5] >= len(self.workers) and pi:
+                    break
+                if not self.admission.fits(pixels, images):
+                    continue
+                print('M: admit %u images, %s pix, predict %sB' %
+                      (images, size2str(pixels),
+                       size2str(self.admission.predict(pixels, images))))
+                for skipped in self.st_pending[:pi]:
+                    skipped[5] += 1
+                del self.st_pending[pi]
+                self.admission.start(wi, pixels, images)
+                self.submit(wi, st_bounds, tiles, sti)
+                print('M: %s' % (self.admission, ))
+                progress = True
+                break
+            else:
+                # Nothing fits, wait for something to finish
+                break
+        return progress
+
     def loop(self):
         progress = False
         self.profile()
@@ -1425,24 +1593,26 @@ class Tiler:
             self.pair_complete += 1
             what = out[0]
             progress = True
+            if self.admission:
+                self.admission.done(wi, ok=what == 'done')
+            if what == 'done':
+                self.st_release(out[1][0])
+            elif what == 'exception':
+                self.st_release(out[1][0][0])
 
             if what == 'done':
-                (st_bounds, img_fn) = out[1]
+                (st_bounds, tiles_rc, pyramid_out) = out[1]
+                if pyramid_out:
+                    self.pyramid.merge(*pyramid_out)
+                    self.tile_sink().flush()
                 print('MW%d: done w/ submit %d, complete %d' %
                       (wi, self.pair_submit, self.pair_complete))
                 self.closed_sts.add(tuple(st_bounds))
-                # Dry run
-                if img_fn is None:
-                    im = None
-                else:
-                    im = Image.open(img_fn)
-                # hack
-                # ugh remove may be an already existing supertile (not a temp file)
-                #os.remove(img_fn)
                 try:
-                    self.process_image(img_fn, im, st_bounds)
+                    self.process_tiles_rc(tiles_rc)
                 except NoTilesGenerated:
-                    print("WARNING: image did not generate tiles %s" % img_fn)
+                    print("WARNING: supertile did not generate tiles %s" %
+                          (st_bounds, ))
             elif what == 'exception':
                 if not self.ignore_errors:
                     for worker in self.workers:
@@ -1473,44 +1643,10 @@ class Tiler:
                 break
 
         # Any workers need more work?
-        for wi, worker in enumerate(self.workers):
-            if self.all_allocated:
-                break
-            if worker.qi.empty():
-                while True:
-                    try:
-                        st_bounds = next(self.st_gen)
-                    except StopIteration:
-                        print('All tasks allocated')
-                        self.all_allocated = True
-                        break
-
-                    progress = True
-
-                    [x0, x1, y0, y1] = st_bounds
-                    self.n_supertiles_allocated += 1
-                    (st_solves, st_net) = self.should_try_supertile(st_bounds)
-                    print(
-                        'M: check st %u (x(%d:%d) y(%d:%d)) want %u / %u tiles'
-                        % (self.n_supertiles_allocated, x0, x1, y0, y1,
-                           st_solves, st_net))
-                    if not st_solves:
-                        print(
-                            'WARNING: skipping supertile %d as it would not generate any new tiles'
-                            % self.n_supertiles_allocated)
-                        self.closed_sts.add(tuple(st_bounds))
-                        continue
-
-                    print('*' * 80)
-                    #print('W%d: submit %s (%d / %d)' % (wi, repr(pair), self.pair_submit, n_pairs)
-                    print("Creating supertile %d / %d with x%d:%d, y%d:%d" %
-                          (self.n_supertiles_allocated, self.n_expected_sts,
-                           x0, x1, y0, y1))
-                    print('W%d: submit' % (wi, ))
-
-                    worker.qi.put((st_bounds, ))
-                    self.pair_submit += 1
-                    break
+        if self.admission:
+            progress = self.allocate_admission() or progress
+        else:
+            progress = self.allocate() or progress
 
         if time.time() - self.last_print > 5 * 60:
             self.print_status()
@@ -1569,6 +1705,9 @@ class Tiler:
                     break
                 self.st_fns.append(st_fn)
 
+        if self.pyramid:
+            self.pyramid.finish()
+
     def run(self):
 
         try: